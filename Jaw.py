@@ -1,4 +1,4 @@
-from dicom_loader import dicom_from_dicomdir
+from dicom_loader import dicom_from_dicomdir, parallel_dicom_from_dicomdir, DICOM_WORKERS
 import numpy as np
 from pydicom.filereader import read_dicomdir
 from pydicom.pixel_data_handlers.numpy_handler import pack_bits
@@ -11,37 +11,52 @@ from scipy.ndimage import affine_transform
 OVERLAY_ADDR = 0x6004
 MIN_QUANTILE = 0.02
 MAX_QUANTILE = 0.98
+COLUMNS_PER_CHUNK = 4096  # max number of z-columns interpolated together by line_slice
+
+# interp_fn names accepted by line_slice and plane_slice and their batched implementation
+BATCHED_2D_INTERPOLATIONS = {
+    'nearest': 'nearest_columns',
+    'bilinear_interpolation': 'bilinear_columns',
+    'bicubic_interpolation': 'bicubic_columns',
+}
+BATCHED_3D_INTERPOLATIONS = {
+    'nearest': 'nearest_points',
+    'trilinear_interpolation': 'trilinear_points',
+    'bicubic_interpolation_3d': 'bicubic_points',
+}
 
 
 class Jaw:
 
-    def __init__(self, dicomdir_path):
+    def __init__(self, dicomdir_path, parallel=False, num_workers=DICOM_WORKERS, release_pixel_data=False, dtype=np.float32):
         """
         initialize a jaw object from a dicomdir path
         Args:
             dicomdir_path (String): path to the dicomdir file, MUST include the final DICOMDIR,
+            parallel (bool): if true the slices are decoded by a pool of threads, see parallel_dicom_from_dicomdir
+            num_workers (int): number of decoding threads, used if parallel is true
+            release_pixel_data (bool): drop the raw pixel data of the dicom files once decoded, used if parallel is true.
+                save_dicom is not available for this jaw if this flag is set.
+            dtype (numpy dtype): dtype of the windowed volume, float64 gives the values of the old full-volume pipeline
         """
         basename = os.path.basename(dicomdir_path)
         if basename.lower() != 'dicomdir':
             raise Exception("ERROR: DICOMDIR PATH HAS TO END WITH DICOMDIR")
 
         self.dicom_dir = read_dicomdir(os.path.join(dicomdir_path))
-        self.filenames, self.dicom_files, self.raw_volume = dicom_from_dicomdir(self.dicom_dir)
+        if parallel:
+            self.filenames, self.dicom_files, self.raw_volume = parallel_dicom_from_dicomdir(
+                self.dicom_dir, num_workers=num_workers, release_pixel_data=release_pixel_data
+            )
+        else:
+            self.filenames, self.dicom_files, self.raw_volume = dicom_from_dicomdir(self.dicom_dir)
 
         w = self.dicom_files[0].WindowWidth
         c = self.dicom_files[0].WindowCenter
-        ymax = c + (w / 2)
-        ymin = c - (w / 2)
 
-        # scale/intercept
+        # scale/intercept and windowing in a single volume
         self.HU_intercept, self.HU_slope = self.__get_HU_rescale_params()
-        tmp = self.raw_volume * self.HU_slope + self.HU_intercept
-
-        # windowing
-        self.volume = tmp.copy()
-        self.volume = ((self.volume - (c - .5)) / (w - 1) + .5) * (ymax - ymin) + ymin
-        self.volume[tmp < (c - .5 - (w - 1) / 2)] = ymin
-        self.volume[tmp > (c - .5 + (w - 1) / 2)] = ymax
+        self.volume = processing.hu_windowing(self.raw_volume, self.HU_slope, self.HU_intercept, c, w, dtype=dtype)
 
         self.Z, self.H, self.W = self.volume.shape
 
@@ -178,44 +193,45 @@ class Jaw:
         is used (we just want 0-1 values). if cut_gt is set to False then the cut is performed on the jawbone volume and
         the interpolation methods can be one of the available interpolation functions.
         xy_set can be one or more set of xy coordinates, the function create an image or a volume of cuts automatically.
+        the columns of many cuts are interpolated together, chunks of COLUMNS_PER_CHUNK columns at a time.
 
         Args:
             xy_set (2D or 3D numpy array):
             cut_gt (bool): if true cuts the ground truth image, if false cuts the original volume.
-                Possible values are: bilinear_interpolation, bicubic_interpolation
             interp_fn (str): name of the interpolation function
+                Possible values are: nearest, bilinear_interpolation, bicubic_interpolation
+            step_fn (callable): optional progress callback, called as step_fn(current_cut, num_cuts)
 
         Returns:
             a 2D or 3D numpy array with the cuts
         """
 
         if cut_gt:
-            interp_fn = lambda x, y: self.gt_volume[:, int(y), int(x)]  # nearest
-        else:
-            interp_fn = getattr(self, interp_fn)
+            interp_fn = 'nearest'  # we just want 0-1 values on the annotated volume
+        columns_fn = self.__batched_interpolation(interp_fn, BATCHED_2D_INTERPOLATIONS)
 
         if len(xy_set.shape) == 2:  # one xy set or many?
             xy_set = xy_set[np.newaxis]
 
-        h = self.Z  # depth of the volume
-        w = max([len(points) for points in xy_set])
-        num_cuts = xy_set.shape[0]
+        num_cuts, w = xy_set.shape[:2]
+        cuts_per_chunk = max(1, COLUMNS_PER_CHUNK // w)  # bound the size of the (Z, columns) temporaries
 
-        cut = np.zeros((num_cuts, h, w), np.float32)  # result image
-        for num_cut in range(num_cuts):
-            step_fn is not None and step_fn(num_cut, num_cuts)
-            for w_id, (x, y) in enumerate(xy_set[num_cut]):
-                if (x - 2) < 0 or (y - 2) < 0 or (x + 2) >= self.W or (y + 2) >= self.H:
-                    cut[num_cut, :, w_id] = np.zeros(shape=self.Z)  # fill the array with zeros if overflowing
-                else:
-                    cut[num_cut, :, w_id] = interp_fn(x, y)  # interpolation
+        cut = np.zeros((num_cuts, self.Z, w), np.float32)  # result image
+        for start in range(0, num_cuts, cuts_per_chunk):
+            step_fn is not None and step_fn(start, num_cuts)
+            chunk = xy_set[start:start + cuts_per_chunk]
+            x, y = chunk[..., 0].reshape(-1), chunk[..., 1].reshape(-1)
+            # columns overflowing the volume are left to zero
+            valid = ((x - 2) >= 0) & ((y - 2) >= 0) & ((x + 2) < self.W) & ((y + 2) < self.H)
+            columns = np.zeros((self.Z, x.size), np.float32)
+            columns[:, valid] = columns_fn(x[valid], y[valid])
+            cut[start:start + chunk.shape[0]] = np.moveaxis(columns.reshape(self.Z, *chunk.shape[:2]), 0, 1)
 
         if not cut_gt:
-            cut = cut.astype(np.float32) / self.max_value  # quick 0-1 norm for the data cut
+            cut = cut / self.max_value  # quick 0-1 norm for the data cut
 
         # fixing possible overflows
-        cut[cut > 1] = 1
-        cut[cut < 0] = 0
+        np.clip(cut, 0, 1, out=cut)
 
         return np.squeeze(cut)  # clean axis 0 in case of just one cut
 
@@ -223,12 +239,14 @@ class Jaw:
         """
         cut the volumes according to a plane of coordinates. the resulting image has the shape of the plane.
         each point of the plane contains the set of zxy coordinates where the function perform the interpolation.
+        all the points of the plane are interpolated at once.
 
         Args:
             plane (3D numpy array): shape is 3xZxW where W is the len of the xy set of coordinates.
-                values are ordered as follow: [0] z coords, [1] x coords, [2] y coords
+                values are ordered as follow: [0] x coords, [1] y coords, [2] z coords
             cut_gt (bool): if true cuts is performed on the ground truth volume
             interp_fn (string): name of the interpolation function, if cut_gt is True the interp_fn is nearest.
+                Possible values are: nearest, trilinear_interpolation, bicubic_interpolation_3d
 
         Returns:
             cut (2D numpy array)
@@ -238,15 +256,11 @@ class Jaw:
             plane = plane.get_plane()
 
         if cut_gt:
-            interp_fn = lambda z, x, y: self.gt_volume[int(z), int(y), int(x)]  # nearest
-        else:
-            interp_fn = getattr(self, interp_fn)
+            interp_fn = 'nearest'
+        points_fn = self.__batched_interpolation(interp_fn, BATCHED_3D_INTERPOLATIONS)
 
-        cut = np.zeros((self.Z, plane.shape[2]))
-        for row in range(self.Z):
-            for col in range(plane.shape[2]):
-                cut[row, col] = interp_fn(plane[2, row, col], plane[0, row, col], plane[1, row, col])  # z, x, y
-        return cut
+        x, y, z = plane[0, :self.Z].reshape(-1), plane[1, :self.Z].reshape(-1), plane[2, :self.Z].reshape(-1)
+        return points_fn(z, x, y).reshape(-1, plane.shape[2]).astype(np.float64)
 
     def create_panorex(self, coords, include_annotations=False):
         """
@@ -313,6 +327,20 @@ class Jaw:
     def set_gt_volume(self, volume):
         self.gt_volume = volume
 
+    def set_overlay(self, volume, overlay_addr=OVERLAY_ADDR, overlay_desc="Marker"):
+        """
+        write a binary volume (e.g. the predicted canal) as overlay of the dicom files, see save_dicom to export them.
+        not available if the jaw has been created with release_pixel_data.
+
+        Args:
+            volume (np.ndarray): binary volume with the same shape of the jaw volume
+            overlay_addr (int): address
+            overlay_desc (str): description
+        """
+        if volume.shape != (self.Z, self.H, self.W):
+            raise Exception(f"overlay shape {volume.shape} does not match the volume shape {(self.Z, self.H, self.W)}")
+        self.__overwrite_address(volume, overlay_addr, overlay_desc)
+
     ################
     # INTERPOLATIONS
     ################
@@ -375,12 +403,12 @@ class Jaw:
             p1 (numpy array or float): column of values or value for coord x1
             p2 (numpy array or float): column of values or value for coord x2
             p3 (numpy array or float): column of values or value for coord x3
-            coord: oordinate to interpolate on
+            coord (float or numpy array): coordinate to interpolate on, arrays are broadcasted against the p values
 
         Returns:
             (float) cubic interpolation according to https://www.paulinternet.nl/?page=bicubic
         """
-        if coord == 0:
+        if np.ndim(coord) == 0 and coord == 0:
             return p1  # if we already have an int coord we don't need to interpolate this stripe
         return p1 + 0.5 * coord * (
                 p2 - p0 + coord * (2 * p0 - 5 * p1 + 4 * p2 - p3 + coord * (3. * (p1 - p2) + p3 - p0)))
@@ -451,6 +479,149 @@ class Jaw:
             iy.append(self.cubic_interpolation(*ix, y_func - int(y_func)))
         return self.cubic_interpolation(*iy, z_func - int(z_func))
 
+    ########################
+    # BATCHED INTERPOLATIONS
+    ########################
+
+    def __batched_interpolation(self, interp_fn, available):
+        """
+        get the batched version of an interpolation function from its name
+        Args:
+            interp_fn (str): name of the interpolation function
+            available (dict): map from the names to the batched implementations
+
+        Returns:
+            (callable) batched interpolation function
+        """
+        if interp_fn not in available:
+            raise Exception(f"interpolation {interp_fn} not available, choose one of {list(available.keys())}")
+        return getattr(self, available[interp_fn])
+
+    def nearest_columns(self, x_func, y_func):
+        """
+        nearest neighbour interpolation of the z-columns of the ground truth volume
+        Args:
+            x_func (float numpy array): x coords, shape P
+            y_func (float numpy array): y coords, shape P
+
+        Returns:
+            (numpy array) interpolated columns, shape ZxP
+        """
+        return self.gt_volume[:, y_func.astype(int), x_func.astype(int)]
+
+    def bilinear_columns(self, x_func, y_func):
+        """
+        batched version of bilinear_interpolation, all the z-columns are interpolated at once
+        Args:
+            x_func (float numpy array): x coords, shape P
+            y_func (float numpy array): y coords, shape P
+
+        Returns:
+            (numpy array) interpolated columns, shape ZxP
+        """
+        x1, y1 = np.floor(x_func).astype(int), np.floor(y_func).astype(int)
+        x2, y2 = x1 + 1, y1 + 1
+        dx, dy = x_func - x1, y_func - y1
+        P1 = self.volume[:, y1, x1] * ((1 - dx) * (1 - dy))
+        P2 = self.volume[:, y2, x1] * ((1 - dx) * dy)
+        P3 = self.volume[:, y1, x2] * (dx * (1 - dy))
+        P4 = self.volume[:, y2, x2] * (dx * dy)
+        return P1 + P2 + P3 + P4
+
+    def bicubic_columns(self, x_func, y_func):
+        """
+        batched version of bicubic_interpolation, all the z-columns are interpolated at once
+        Args:
+            x_func (float numpy array): x coords, shape P
+            y_func (float numpy array): y coords, shape P
+
+        Returns:
+            (numpy array) interpolated columns, shape ZxP
+        """
+        xs = self.__cubic_neighbours(x_func)
+        ys = self.__cubic_neighbours(y_func)
+        x_frac, y_frac = x_func - x_func.astype(int), y_func - y_func.astype(int)
+
+        iy = [self.cubic_interpolation(*[self.volume[:, y, x] for x in xs], x_frac) for y in ys]
+        return self.cubic_interpolation(*iy, y_frac)
+
+    def nearest_points(self, z_func, x_func, y_func):
+        """
+        nearest neighbour interpolation of a set of points of the ground truth volume
+        Args:
+            z_func (float numpy array): z coords
+            x_func (float numpy array): x coords
+            y_func (float numpy array): y coords
+
+        Returns:
+            (numpy array) interpolated values, same shape of the coords
+        """
+        return self.gt_volume[z_func.astype(int), y_func.astype(int), x_func.astype(int)]
+
+    def trilinear_points(self, z_func, x_func, y_func):
+        """
+        batched version of trilinear_interpolation, all the points are interpolated at once
+        Args:
+            z_func (float numpy array): z coords
+            x_func (float numpy array): x coords
+            y_func (float numpy array): y coords
+
+        Returns:
+            (numpy array) interpolated values, same shape of the coords
+        """
+        # avoid possible overflows
+        x_func = np.where(x_func + 1 >= self.W, self.W - 2, x_func)
+        z_func = np.where(z_func + 1 >= self.Z, self.Z - 2, z_func)
+        y_func = np.where(y_func + 1 >= self.H, self.H - 2, y_func)
+
+        x1, y1, z1 = np.floor(x_func).astype(int), np.floor(y_func).astype(int), np.floor(z_func).astype(int)
+        x2, y2, z2 = x1 + 1, y1 + 1, z1 + 1
+
+        xd, yd, zd = x_func - x1, y_func - y1, z_func - z1
+        c11 = self.volume[z1, y1, x1] * (1 - xd) + self.volume[z1, y1, x2] * xd
+        c12 = self.volume[z2, y1, x1] * (1 - xd) + self.volume[z2, y1, x2] * xd
+        c21 = self.volume[z1, y2, x1] * (1 - xd) + self.volume[z1, y2, x2] * xd
+        c22 = self.volume[z2, y2, x1] * (1 - xd) + self.volume[z2, y2, x2] * xd
+        c1 = c11 * (1 - yd) + c21 * yd
+        c2 = c12 * (1 - yd) + c22 * yd
+        return c1 * (1 - zd) + c2 * zd
+
+    def bicubic_points(self, z_func, x_func, y_func):
+        """
+        batched version of bicubic_interpolation_3d, all the points are interpolated at once
+        Args:
+            z_func (float numpy array): z coords
+            x_func (float numpy array): x coords
+            y_func (float numpy array): y coords
+
+        Returns:
+            (numpy array) interpolated values, same shape of the coords
+        """
+        zs = self.__cubic_neighbours(z_func)
+        zs[3] = np.minimum(zs[3], self.volume.shape[0] - 1)  # avoid overflow as in bicubic_interpolation_3d
+        xs = self.__cubic_neighbours(x_func)
+        ys = self.__cubic_neighbours(y_func)
+        z_frac, x_frac, y_frac = z_func - z_func.astype(int), x_func - x_func.astype(int), y_func - y_func.astype(int)
+
+        iy = []
+        for z in zs:
+            ix = [self.cubic_interpolation(*[self.volume[z, y, x] for x in xs], x_frac) for y in ys]
+            iy.append(self.cubic_interpolation(*ix, y_frac))
+        return self.cubic_interpolation(*iy, z_frac)
+
+    @staticmethod
+    def __cubic_neighbours(coords):
+        """
+        indices of the four samples used by the cubic interpolations
+        Args:
+            coords (float numpy array): coordinates to interpolate on
+
+        Returns:
+            (list of int numpy arrays) floor - 1, floor, ceil, ceil + 1
+        """
+        low, high = np.floor(coords).astype(int), np.ceil(coords).astype(int)
+        return [low - 1, low, high, high + 1]
+
     ###############
     # PRIVATE UTILS
     ###############
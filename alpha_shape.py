@@ -8,7 +8,7 @@ from scipy.ndimage import binary_fill_holes
 import os
 import pathlib
 from glob import glob
-from scipy.spatial import cKDTree
+from surface_distance import SurfaceDistances
 
 
 def alpha_shape_3D(pos, alpha):
@@ -68,23 +68,7 @@ def concave_hull(coords, shape, alpha=5):
     return alpha_vol.astype(int), binary_fill_holes(alpha_vol).astype(int)
 
 def hausdorff_pair(image0, image1):
-    a_points = np.transpose(np.nonzero(image0))
-    b_points = np.transpose(np.nonzero(image1))
-
-    # If either of the sets are empty, there is no corresponding pair of points
-    if len(a_points) == 0 or len(b_points) == 0:
-        return (), ()
-
-    nearest_dists_from_b, nearest_a_point_indices_from_b = cKDTree(a_points).query(b_points)
-    nearest_dists_from_a, nearest_b_point_indices_from_a = cKDTree(b_points).query(a_points)
-
-    max_index_from_a = nearest_dists_from_b.argmax()
-    max_index_from_b = nearest_dists_from_a.argmax()
-
-    max_dist_from_a = nearest_dists_from_b[max_index_from_a]
-    max_dist_from_b = nearest_dists_from_a[max_index_from_b]
-
-    if max_dist_from_b > max_dist_from_a:
-        return a_points[max_index_from_b], b_points[nearest_b_point_indices_from_a[max_index_from_b]]
-    else:
-        return a_points[nearest_a_point_indices_from_b[max_index_from_a]], b_points[max_index_from_a]
\ No newline at end of file
+    """
+    pair of foreground voxels (one for each volume) which realizes the hausdorff distance, see SurfaceDistances
+    """
+    return SurfaceDistances(image0, image1, return_indices=True, surfaces=False).hausdorff_pair()
\ No newline at end of file
@@ -122,53 +122,73 @@ class RandomRotate:
         return data
 
 
-# it's relatively slow, i.e. ~1s per patch of size 64x200x200, so use multiple workers in the DataLoader
 # remember to use spline_order=0 when transforming the labels
 class ElasticDeformation:
     """
-    Apply elasitc deformations of 3D patches on a per-voxel mesh. Assumes ZYX axis order (or CZYX if the data is 4D).
+    Apply elastic deformations of 3D patches. Assumes ZYX axis order (or CZYX if the data is 4D).
+    A coarse grid of random displacements is drawn once per call and upsampled to the patch with trilinear
+    interpolation, all the channels of the image and the mask are then sampled on the same deformed grid,
+    so labels follow the image.
+    alpha and sigma keep the meaning of the old transform, which smoothed white noise with a gaussian filter:
+    the displacements have the std of that noise (alpha / (2 sqrt(pi) sigma)) and the control points are
+    2 * sigma voxels apart, unless grid_spacing is given. as before they are drawn once, when the transform is built.
     Based on: https://github.com/fcalvet/image_tools/blob/master/image_augmentation.py#L62
     """
 
-    def __init__(self, spline_order=2, alpha=1, sigma=5, execution_probability=0.1,
+    def __init__(self, spline_order=2, alpha=1, sigma=5, execution_probability=0.1, apply_3d=True, grid_spacing=None,
                  **kwargs):
         """
-        :param spline_order: the order of spline interpolation (use 0 for labeled images)
+        :param spline_order: the order of spline interpolation of the image, labels always use 0
         :param alpha: scaling factor for deformations (random -> between 0 and alfa)
-        :param sigma: smoothing factor for Gaussian filter (random -> between 0 and sigma)
+        :param sigma: smoothing factor of the deformations, as the std of a gaussian filter (random -> between 0 and sigma)
         :param execution_probability: probability of executing this transform
-        :param apply_3d: if True apply deformations in each axis
+        :param apply_3d: if True apply deformations in each axis, otherwise just in the H, W plane
+        :param grid_spacing: voxels between two control points, default is 2 * sigma
         """
         self.spline_order = spline_order
         self.alpha = np.random.uniform() * alpha
         self.sigma = np.random.uniform() * sigma
         self.execution_probability = execution_probability
+        self.apply_3d = apply_3d
+        self.grid_spacing = grid_spacing
 
-    def deformate(self, volume, spline_order=0):
-        y_dim, x_dim = volume[0].shape
-        y, x = np.meshgrid(np.arange(y_dim), np.arange(x_dim), indexing='ij')
-
-        C = volume.shape[0]
-        for i in range(C):
-            dy, dx = [
-                gaussian_filter(
-                    np.random.randn(*volume[0].shape),
-                    self.sigma, mode="reflect"
-                ) * self.alpha for _ in range(2)
-            ]
-            indices = y + dy, x + dx
-            volume[i] = map_coordinates(volume[i], indices, order=spline_order, mode='reflect')
-        return volume
+    def displacement(self, shape):
+        """
+        Args:
+            shape (tuple): Z, H, W of the patch
+
+        Returns:
+            (numpy array) displacements in voxels with shape 3, Z, H, W (dz, dy, dx)
+        """
+        # std of white noise filtered by a 2D gaussian, at most 1 (no filter)
+        std = self.alpha * min(1., 1 / (2 * np.sqrt(np.pi) * max(self.sigma, 1e-6)))
+        spacing = max(self.grid_spacing or 2 * self.sigma, 1)
+        coarse_shape = [int(np.ceil(dim / spacing)) + 1 for dim in shape]
+        coarse = np.random.randn(3, *coarse_shape).astype(np.float32) * std
+        if not self.apply_3d:
+            coarse[0] = 0
+        return interpolate(
+            torch.from_numpy(coarse)[None], size=tuple(shape), mode='trilinear', align_corners=True
+        )[0].numpy()
+
+    def deformate(self, volume, coords, spline_order=0):
+        if volume.ndim == 3:
+            return map_coordinates(volume, coords, order=spline_order, mode='reflect')
+        return np.stack([map_coordinates(channel, coords, order=spline_order, mode='reflect') for channel in volume])
 
     def __call__(self, data):
         if np.random.uniform(0, 1) < self.execution_probability:
             image, mask = data
 
             # assert image.shape == mask.shape
-            assert image.ndim == 3
-
-            image = self.deformate(image.copy(), self.spline_order)
-            mask = self.deformate(mask.copy(), 0)
+            assert image.ndim in (3, 4)
+
+            shape = image.shape[-3:]
+            coords = self.displacement(shape)
+            for axis, grid in enumerate(np.ogrid[:shape[0], :shape[1], :shape[2]]):
+                coords[axis] += grid
+            image = self.deformate(image, coords, self.spline_order)
+            mask = self.deformate(mask, coords, 0)
             return [image, mask]
         return data
 
@@ -349,37 +369,134 @@ class CenterCrop:
         return crop_img
 
 
-class CropAndPad:
+def centered_offsets(size, target):
+    """
+    Returns:
+        (int) first voxel of the source kept by a centered crop (0 if the source is padded)
+        (int) first voxel of the result filled by the source (0 if the source is cropped)
+    """
+    return max(size - target, 0) // 2, max(target - size, 0) // 2
 
-    def __init__(self, target_shape, pad_val=None):
-        self.target_shape = target_shape
-        self.pad_val = pad_val
 
-    def __call__(self, image):
-        was_numpy = not torch.is_tensor(image)
+def crop(volume, target_shape):
+    """
+    centered crop of the last three axes of a tensor, a view
+    """
+    slices = [slice(centered_offsets(s, t)[0], centered_offsets(s, t)[0] + t) for s, t in zip(volume.shape[-3:], target_shape)]
+    return volume[(..., *slices)]
 
-        # CROPPING
-        z_offset = max(image.shape[-3] - self.target_shape[0], 0)
-        y_offset = max(image.shape[-2] - self.target_shape[1], 0)
-        x_offset = max(image.shape[-1] - self.target_shape[2], 0)
-        z_offset = int(np.floor(z_offset / 2.)), image.shape[-3] - int(np.ceil(z_offset / 2.))
-        y_offset = int(np.floor(y_offset / 2.)), image.shape[-2] - int(np.ceil(y_offset / 2.))
-        x_offset = int(np.floor(x_offset / 2.)), image.shape[-1] - int(np.ceil(x_offset / 2.))
 
-        img = image[..., z_offset[0]:z_offset[1], y_offset[0]:y_offset[1], x_offset[0]:x_offset[1]]
+def paste(volume, target_shape, pad_val=None):
+    """
+    centered crop/pad of the last three axes of a tensor, the kept voxels are copied once into the result.
+    the padding value is the min of the kept voxels if pad_val is None (the min of the cropped volume)
+    """
+    source, dest = [], []
+    for size, target in zip(volume.shape[-3:], target_shape):
+        (start, offset), length = centered_offsets(size, target), min(size, target)
+        source.append(slice(start, start + length))
+        dest.append(slice(offset, offset + length))
+    kept = volume[(..., *source)]
+    pad_val = kept.min() if pad_val is None else pad_val
+    result = torch.full((*volume.shape[:-3], *target_shape), float(pad_val), dtype=volume.dtype)
+    result[(..., *dest)] = kept
+    return result
+
+
+def resample(volume, shape, mode='trilinear'):
+    """
+    interpolation of the last three axes of a tensor to shape, labels keep their dtype with mode nearest
+    """
+    batch = volume.reshape(1, -1, *volume.shape[-3:])
+    if mode == 'nearest':
+        batch = interpolate(batch, size=tuple(shape), mode=mode)
+    else:
+        batch = interpolate(batch if batch.is_floating_point() else batch.float(), size=tuple(shape), mode=mode, align_corners=False)
+    return batch.reshape(*volume.shape[:-3], *shape)
+
+
+class Geometry:
+    """
+    resample of a volume to inner_shape followed by a centered crop/pad to target_shape, computed once for a pair of
+    shapes and executed with a single copy: the kept voxels of the resampled volume (of the source itself if there
+    is nothing to resample) are written straight into the padded result. numpy volumes are used as tensors without
+    copies and results have the type of the input, there is no state between calls.
+    the inverse crops/pads back to inner_shape (a view if the forward just padded) and resamples to the source shape,
+    without resampling it gives back the source voxels exactly.
+
+    usage:
+        geometry = Geometry.keep_aspect(data.shape, (168, 280, 360))
+        data = geometry(data)  # (C,) 168, 280, 360
+        prediction = geometry.inverse()(prediction)  # (C,) Z, H, W of the source
+    """
+
+    def __init__(self, source_shape, target_shape, inner_shape=None, inverted=False):
+        """
+        Args:
+            source_shape (tuple): Z, H, W of the volumes
+            target_shape (tuple): Z, H, W of the results
+            inner_shape (tuple): Z, H, W of the resampled source, default is no resampling
+            inverted (bool): crop/pad to inner_shape first and then resample to target_shape
+        """
+        self.source_shape = tuple(int(s) for s in source_shape)
+        self.target_shape = tuple(int(s) for s in target_shape)
+        default = self.target_shape if inverted else self.source_shape
+        self.inner_shape = default if inner_shape is None else tuple(int(s) for s in inner_shape)
+        self.inverted = inverted
+
+    @classmethod
+    def keep_aspect(cls, source_shape, target_shape):
+        """
+        geometry of the 2D dataset: the source is rescaled by the factor which brings it inside target_shape with
+        its aspect ratio, then padded to target_shape
+        """
+        D, H, W = source_shape
+        rD, rH, rW = target_shape
+        pad_factor = np.array((D / W, H / W, 1)) / np.array((rD / rW, rH / rW, 1))
+        pad_factor /= np.max(pad_factor)
+        canvas = np.round(np.array((D, H, W)) / pad_factor)  # source padded to the aspect ratio of the target
+        inner = np.round(np.array((D, H, W)) * np.array(target_shape) / canvas).astype(int)
+        return cls(source_shape, target_shape, np.minimum(inner, target_shape))
+
+    def inverse(self):
+        return Geometry(self.target_shape, self.source_shape, self.inner_shape, not self.inverted)
+
+    def __call__(self, volume, pad_val=None, mode='trilinear'):
+        """
+        Args:
+            volume (numpy array or torch.Tensor): volume with shape (C,) Z, H, W of source_shape
+            pad_val (float): value of the padding, default is the min of the volume after the crop (and the resample)
+            mode (str): interpolation of the resample, trilinear or nearest (labels)
+
+        Returns:
+            (numpy array or torch.Tensor) volume with shape (C,) Z, H, W of target_shape
+        """
+        was_numpy = not torch.is_tensor(volume)
+        volume = torch.from_numpy(np.ascontiguousarray(volume)) if was_numpy else volume
+        if tuple(volume.shape[-3:]) != self.source_shape:
+            raise Exception(f"geometry of a volume {self.source_shape}, got {tuple(volume.shape)}")
+
+        if self.inverted:
+            if all(i <= s for i, s in zip(self.inner_shape, self.source_shape)):
+                volume = crop(volume, self.inner_shape)  # the forward geometry just padded
+            else:
+                volume = paste(volume, self.inner_shape, pad_val)
+            result = resample(volume, self.target_shape, mode) if self.inner_shape != self.target_shape else volume
+        else:
+            if self.inner_shape != self.source_shape:
+                volume = resample(volume, self.inner_shape, mode)
+            result = paste(volume, self.target_shape, pad_val)
+        return result.numpy() if was_numpy else result
 
-        # PADDING
-        z_offset = -min(image.shape[-3] - self.target_shape[0], 0)
-        y_offset = -min(image.shape[-2] - self.target_shape[1], 0)
-        x_offset = -min(image.shape[-1] - self.target_shape[2], 0)
-        z_offset = int(np.floor(z_offset / 2.)), z_offset - int(np.floor(z_offset / 2.))
-        y_offset = int(np.floor(y_offset / 2.)), y_offset - int(np.floor(y_offset / 2.))
-        x_offset = int(np.floor(x_offset / 2.)), x_offset - int(np.floor(x_offset / 2.))
 
-        img = img if torch.is_tensor(img) else torch.from_numpy(img)
-        self.pad_val = self.pad_val if self.pad_val else img.min()
-        img = pad(img, (x_offset[0], x_offset[1], y_offset[0], y_offset[1], z_offset[0], z_offset[1]), value=self.pad_val)
+class CropAndPad:
+    """
+    centered crop/pad to target_shape, see Geometry. the padding value is the min of each cropped volume if pad_val is None
+    """
 
-        if was_numpy:
-            return img.numpy()
-        return img
\ No newline at end of file
+    def __init__(self, target_shape, pad_val=None):
+        self.target_shape = target_shape
+        self.pad_val = pad_val
+
+    def __call__(self, image):
+        return Geometry(image.shape[-3:], self.target_shape)(image, self.pad_val)
@@ -0,0 +1,223 @@
+import math
+import torch
+import torch.nn.functional as F
+
+
+class BatchTransform:
+    """
+    random transform of collated patches, applied on the device of the batch after the transfer.
+    each patch of the batch draws its own parameters, image and label of a patch get the same spatial transform.
+    subclasses implement apply on the patches drawn with probability p, it returns new tensors (the batches can be
+    views of the slots of the patch pipeline, they are never changed in place).
+
+    usage:
+        transform = Compose([RandomFlip(axes=(0, 1, 2)), RandomAffine(degrees=10, p=0.3)])
+        images, labels = transform(images, labels)  # B, C, Z, H, W
+    """
+
+    def __init__(self, p=1):
+        """
+        Args:
+            p (float): probability of transforming each patch
+        """
+        self.p = p
+
+    def __call__(self, images, labels, selected=None):
+        """
+        Args:
+            images (torch.Tensor): float batch with shape B, C, Z, H, W
+            labels (torch.Tensor): label maps with shape B, C, Z, H, W
+            selected (torch.Tensor): bool mask of the patches this transform can change, all of them if None
+
+        Returns:
+            (torch.Tensor) transformed images
+            (torch.Tensor) transformed labels
+        """
+        draw = torch.rand(len(images), device=images.device) < self.p
+        if selected is not None:
+            draw &= selected
+        if draw.all():
+            return self.apply(images, labels)
+        index = torch.nonzero(draw).flatten()
+        if len(index) == 0:
+            return images, labels
+        images, labels = images.clone(), labels.clone()
+        images[index], labels[index] = self.apply(images[index], labels[index])
+        return images, labels
+
+    def apply(self, images, labels):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(f'{k}={v}' for k, v in vars(self).items())})"
+
+
+def value_range(value, around=0):
+    """
+    (min, max) interval of a parameter given as a single value v, meaning (around - v, around + v), or as a pair
+    """
+    if isinstance(value, (list, tuple)):
+        return float(value[0]), float(value[-1])
+    return around - value, around + value
+
+
+def uniform(count, interval, device):
+    low, high = interval
+    return torch.rand(count, device=device) * (high - low) + low
+
+
+def identity_grid(shape, count, device):
+    """
+    sampling grid of grid_sample which leaves a volume of spatial shape Z, H, W as it is
+    """
+    theta = torch.eye(3, 4, device=device).expand(count, 3, 4)
+    return F.affine_grid(theta, (count, 1, *shape), align_corners=True)
+
+
+def resample(images, labels, grid):
+    """
+    images and labels sampled on the same grid: linear for the images, nearest for the labels
+    """
+    images = F.grid_sample(images, grid.to(images.dtype), mode='bilinear', padding_mode='border', align_corners=True)
+    sampled = F.grid_sample(labels.float(), grid.float(), mode='nearest', padding_mode='zeros', align_corners=True)
+    return images, sampled.to(labels.dtype)
+
+
+class RandomFlip(BatchTransform):
+    """
+    flip of the spatial axes (0 is Z), each axis of each patch is flipped with probability flip_probability
+    """
+
+    def __init__(self, axes=(0, 1, 2), flip_probability=0.5, p=1):
+        super().__init__(p)
+        self.axes = (axes,) if isinstance(axes, int) else tuple(axes)
+        self.flip_probability = flip_probability
+
+    def apply(self, images, labels):
+        flips = (torch.rand(len(images), len(self.axes)) < self.flip_probability).tolist()
+        # dims of the single patches, channels first
+        dims = [[axis + 1 for axis, flip in zip(self.axes, flip) if flip] for flip in flips]
+        images = torch.stack([image.flip(d) if d else image for image, d in zip(images, dims)])
+        labels = torch.stack([label.flip(d) if d else label for label, d in zip(labels, dims)])
+        return images, labels
+
+
+class RandomAffine(BatchTransform):
+    """
+    rotation (degrees) and scaling around the center of the patches, with affine_grid and grid_sample.
+    ranges follow tio.RandomAffine: a single value v means (-v, v) for degrees and translation (voxels),
+    (1 - v, 1 + v) for scales. angles are around the Z, H and W axes.
+    """
+
+    def __init__(self, scales=0.1, degrees=10, translation=0, isotropic=False, p=1, **kwargs):
+        super().__init__(p)
+        self.scales = value_range(scales, around=1)
+        self.degrees = value_range(degrees)
+        self.translation = value_range(translation)
+        self.isotropic = isotropic
+
+    def matrices(self, count, shape, device):
+        """
+        Returns:
+            (torch.Tensor) theta of affine_grid with shape count, 3, 4
+        """
+        angles = [uniform(count, self.degrees, device) * math.pi / 180 for _ in range(3)]
+        rotation = torch.eye(3, device=device).repeat(count, 1, 1)
+        # grid coordinates are ordered as x (W), y (H), z (Z)
+        for angle, (i, j) in zip(angles, [(0, 1), (0, 2), (1, 2)]):
+            step = torch.eye(3, device=device).repeat(count, 1, 1)
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            step[:, i, i], step[:, i, j], step[:, j, i], step[:, j, j] = cos, -sin, sin, cos
+            rotation = rotation @ step
+        scales = uniform(count, self.scales, device)[:, None].expand(count, 3) if self.isotropic else \
+            torch.stack([uniform(count, self.scales, device) for _ in range(3)], dim=1)
+        # normalized coordinates are in [-1, 1] on each axis, the rotation is done in voxels
+        half = torch.tensor([(s - 1) / 2 for s in reversed(shape)], device=device, dtype=torch.float)
+        linear = (rotation / scales[:, None, :]) * half[None, None, :] / half[None, :, None]
+        shift = torch.stack([uniform(count, self.translation, device) for _ in range(3)], dim=1) / half
+        return torch.cat((linear, shift[..., None]), dim=2)
+
+    def apply(self, images, labels):
+        theta = self.matrices(len(images), images.shape[2:], images.device)
+        grid = F.affine_grid(theta, (len(images), 1, *images.shape[2:]), align_corners=True)
+        return resample(images, labels, grid)
+
+
+class RandomElasticDeformation(BatchTransform):
+    """
+    random displacements of a coarse grid of control points, upsampled to a smooth field with trilinear interpolation.
+    each patch gets its own field, shared by all the channels of the image and by the label.
+    max_displacement is in voxels, for each axis if it is a tuple (Z, H, W).
+    """
+
+    def __init__(self, num_control_points=7, max_displacement=7.5, p=1, **kwargs):
+        super().__init__(p)
+        self.num_control_points = num_control_points
+        self.max_displacement = max_displacement if isinstance(max_displacement, (list, tuple)) else (max_displacement,) * 3
+
+    def apply(self, images, labels):
+        count, shape, device = len(images), images.shape[2:], images.device
+        coarse = (torch.rand(count, 3, *(self.num_control_points,) * 3, device=device) * 2 - 1)
+        # voxels to normalized coordinates, channels ordered as the grid (x, y, z)
+        scale = torch.tensor([2 * d / max(s - 1, 1) for d, s in zip(reversed(self.max_displacement), reversed(shape))], device=device)
+        displacement = F.interpolate(coarse * scale[None, :, None, None, None], size=tuple(shape), mode='trilinear', align_corners=True)
+        grid = identity_grid(shape, count, device) + displacement.permute(0, 2, 3, 4, 1)
+        return resample(images, labels, grid)
+
+
+class RandomGamma(BatchTransform):
+    """
+    intensity changes as tio.RandomGamma: image ** exp(log_gamma), labels are not affected. images are expected >= 0
+    """
+
+    def __init__(self, log_gamma=0.3, p=1, **kwargs):
+        super().__init__(p)
+        self.log_gamma = value_range(log_gamma)
+
+    def apply(self, images, labels):
+        gamma = torch.exp(uniform(len(images), self.log_gamma, images.device))
+        return images.clamp(min=0) ** gamma.view(-1, 1, 1, 1, 1).to(images.dtype), labels
+
+
+class RandomContrast(BatchTransform):
+    """
+    linear contrast around the mean intensity of each patch, factor drawn from alpha. labels are not affected
+    """
+
+    def __init__(self, alpha=(0.8, 1.2), p=1, **kwargs):
+        super().__init__(p)
+        self.alpha = value_range(alpha, around=1)
+
+    def apply(self, images, labels):
+        alpha = uniform(len(images), self.alpha, images.device).view(-1, 1, 1, 1, 1).to(images.dtype)
+        mean = images.mean(dim=(1, 2, 3, 4), keepdim=True)
+        return (images - mean) * alpha + mean, labels
+
+
+class Compose(BatchTransform):
+
+    def __init__(self, transforms):
+        super().__init__()
+        self.transforms = transforms
+
+    def __call__(self, images, labels, selected=None):
+        for transform in self.transforms:
+            images, labels = transform(images, labels, selected)
+        return images, labels
+
+
+class OneOf(BatchTransform):
+    """
+    each patch gets one of the transforms, chosen at random
+    """
+
+    def __init__(self, transforms):
+        super().__init__()
+        self.transforms = transforms
+
+    def __call__(self, images, labels, selected=None):
+        choice = torch.randint(len(self.transforms), (len(images),), device=images.device)
+        for n, transform in enumerate(self.transforms):
+            mask = choice == n
+            images, labels = transform(images, labels, mask if selected is None else mask & selected)
+        return images, labels
@@ -0,0 +1,85 @@
+"""
+throughput and memory of the PadUNet3D training step in fp32, mixed precision and channels_last_3d.
+memory is the size of the activations saved for the backward pass (on cuda also the peak allocated memory).
+run it from the project root with: python -m benchmarks.amp
+"""
+import time
+import argparse
+import torch
+from models.PadUNet3D import padUNet3D
+from losses import LossFn
+from train import MixedPrecision
+
+
+def saved_bytes(fn):
+    """
+    bytes of the tensors stored by autograd while running fn
+    """
+    total = [0]
+
+    def pack(tensor):
+        total[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        res = fn()
+    return res, total[0]
+
+
+def run(precision, batch_size, patch_shape, steps, device):
+    torch.manual_seed(0)
+    model = precision.prepare(padUNet3D(n_classes=1, in_ch=1).to(device)).train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss_fn = LossFn({'name': 'Jaccard'}, {'labels': {'BACKGROUND': 0, 'INSIDE': 1}}, weights=None)
+
+    images = torch.rand((batch_size, 1, *patch_shape), device=device)
+    labels = (images > .7).long()
+    weights = torch.ones(batch_size, device=device)
+
+    def forward():
+        with precision.autocast():
+            outputs = model(precision.format(images), None)
+        return loss_fn(outputs.float(), labels, weights)
+
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    losses, activations = [], 0
+    for step in range(steps + 1):
+        if step == 1:  # first step is a warm up
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        loss, activations = saved_bytes(forward)
+        losses.append(loss.item())
+        precision.step(loss, optimizer)
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device == 'cuda' else None
+    return losses, steps * batch_size / elapsed, activations / 2 ** 20, peak
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--batch_size', type=int, default=2)
+    arg_parser.add_argument('--steps', type=int, default=3)
+    arg_parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = arg_parser.parse_args()
+
+    dtypes = ['float16', 'bfloat16'] if args.device == 'cuda' else ['bfloat16']
+    modes = [('fp32', MixedPrecision(device=args.device))]
+    for dtype in dtypes:
+        modes.append((dtype, MixedPrecision(amp=True, dtype=dtype, device=args.device)))
+        modes.append((f'{dtype} + channels_last', MixedPrecision(amp=True, dtype=dtype, channels_last=True, device=args.device)))
+
+    print(f"PadUNet3D, batch {args.batch_size}x{tuple(args.patch_shape)} on {args.device}")
+    reference = None
+    for name, precision in modes:
+        losses, throughput, activations, peak = run(precision, args.batch_size, args.patch_shape, args.steps, args.device)
+        reference = losses if reference is None else reference
+        drift = max(abs(a - b) for a, b in zip(losses, reference))
+        print(f"{name:>26}: {throughput:6.2f} patches/s, saved activations {activations:7.1f}MB"
+              f"{'' if peak is None else f', peak {peak:.0f}MB'}, loss drift from fp32 {drift:.1e}")
@@ -0,0 +1,125 @@
+"""
+arch tracking with the arc length parametrization against the old step by step walk along the spline:
+coordinates of processing.arch_lines, utils.arch_stats and the pixels of utils.paralines_mask on synthetic arches.
+run it from the project root with: python -m benchmarks.arch_lines
+"""
+import time
+import argparse
+import numpy as np
+import processing
+import utils
+
+
+def loop_arch_lines(func, start, end, offset=50, d=1):
+    """
+    reference implementation: old processing.arch_lines
+    """
+    delta = 0.3
+    coords = []
+    x = start + 1
+    while x < end:
+        coords.append((x, func(x)))
+        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta
+        x = x + d * np.sqrt(1 / (alfa ** 2 + 1))
+    high_offset, low_offset, derivative = [], [], []
+    for x, y in coords:
+        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta
+        alfa = -1 / alfa
+        cos = np.sqrt(1 / (alfa ** 2 + 1))
+        sin = np.sqrt(alfa ** 2 / (alfa ** 2 + 1))
+        if alfa > 0:
+            low_offset.append((x + offset * cos, y + offset * sin))
+            high_offset.append((x - offset * cos, y - offset * sin))
+        else:
+            low_offset.append((x - offset * cos, y + offset * sin))
+            high_offset.append((x + offset * cos, y - offset * sin))
+        derivative.append(alfa)
+    return low_offset, coords, high_offset, derivative
+
+
+def loop_arch_stats(func, start, end):
+    """
+    reference implementation: old utils.arch_stats
+    """
+    x, counter, delta, peak = start, 0, 0.3, 100
+    while x < end:
+        y = func(x)
+        peak = peak if y > peak else y
+        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta
+        x = x + 1 * np.sqrt(1 / (alfa ** 2 + 1))
+        counter = counter + 1
+    return counter, peak
+
+
+def loop_paralines_mask(func, start, end, slice_dim, offset=50):
+    """
+    reference implementation: old utils.paralines_mask
+    """
+    low, _, high, _ = loop_arch_lines(func, start, end, offset)
+    (lx, ly), (hx, hy) = zip(*low), zip(*high)
+    H, W = slice_dim
+    hp = np.poly1d(np.polyfit(hx, hy, 6))
+    lp = np.poly1d(np.polyfit(lx, ly, 6))
+    mask = np.zeros((H, W))
+    start = max(int(hx[0]), 0)
+    end = min(int(hx[-1]), W - 1)
+    hy2 = np.clip([hp(x) for x in range(start, end)], a_min=0, a_max=H - 1)
+    ly2 = np.clip([lp(x) for x in range(start, end)], a_min=0, a_max=H - 1)
+    for idx in range(start, end):
+        mask[int(hy2[idx - start]):int(ly2[idx - start]), int(idx)] = 1
+    return mask.astype(bool)
+
+
+def make_arch(rng, shape, degree):
+    """
+    polynomial fitted on the noisy skeleton of a dental arch, as processing.arch_detection does
+    """
+    H, W = shape
+    x = np.arange(W // 10, W - W // 10)
+    center = W / 2 + rng.uniform(-20, 20)
+    y = 60 + (H - 210) * ((x - center) / (W / 2 - W // 10)) ** 2 + rng.normal(0, 2, len(x))
+    return np.poly1d(np.polyfit(x, y, degree)), x.min(), x.max()
+
+
+def timeit(fn, *args, repeat=3):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        res = fn(*args)
+    return res, (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=2, default=[400, 500], help='H W of the slices')
+    arg_parser.add_argument('--arches', type=int, default=10)
+    args = arg_parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    times = np.zeros((2, 3))
+    worst = np.zeros(4)
+    for n in range(args.arches):
+        func, start, end = make_arch(rng, args.shape, 12 if n % 2 else 8)
+
+        (old, old_time), (new, new_time) = timeit(loop_arch_lines, func, start, end), timeit(processing.arch_lines, func, start, end)
+        assert abs(len(old[1]) - len(new[1])) <= 1, f"{len(old[1])} vs {len(new[1])} points"
+        size = min(len(old[1]), len(new[1]))
+        worst[0] = max(worst[0], max(np.abs(np.array(o[:size]) - np.array(v[:size])).max() for o, v in zip(old[:3], new[:3])))
+        times[:, 0] += old_time, new_time
+
+        (old, old_time), (new, new_time) = timeit(loop_arch_stats, func, start, end), timeit(utils.arch_stats, func, start, end)
+        worst[1] = max(worst[1], abs(old[0] - new[0]))
+        worst[2] = max(worst[2], abs(old[1] - new[1]))
+        times[:, 1] += old_time, new_time
+
+        (old, old_time), (new, new_time) = (timeit(loop_paralines_mask, func, start, end, args.shape, 40),
+                                            timeit(utils.paralines_mask, func, start, end, args.shape, 40))
+        worst[3] = max(worst[3], (old != new).mean())
+        times[:, 2] += old_time, new_time
+
+    print(f"arch_lines: max coordinate difference {worst[0]:.4f}px")
+    print(f"arch_stats: max length difference {worst[1]:.0f} steps, max peak difference {worst[2]:.4f}px")
+    print(f"paralines_mask: at most {worst[3]:.4%} of the pixels differ")
+    for i, name in enumerate(['arch_lines', 'arch_stats', 'paralines_mask']):
+        old_time, new_time = times[:, i] / args.arches
+        print(f"{name:15s} loop {old_time * 1000:8.2f}ms | vectorized {new_time * 1000:6.2f}ms | x{old_time / new_time:.1f}")
@@ -0,0 +1,82 @@
+"""
+batched augmentations of batch_augmentations.py against the torchio transforms, on cpu: patches per second of each
+transform, torchio applied to each patch and to each subject (as the patch workers do, its cost is split among the
+patches of the subject). image and label of each patch are checked to get the same spatial transform.
+run it from the project root with: python -m benchmarks.augmentations
+"""
+import time
+import argparse
+import numpy as np
+import torch
+import torchio as tio
+import batch_augmentations as ba
+from loaders.dataset3D import AugFactory
+from benchmarks.sampler import make_subject
+
+TRANSFORMS = {
+    'RandomFlip': {'axes': (0, 1, 2), 'flip_probability': 0.5},
+    'RandomAffine': {'scales': (0.9, 1.1), 'degrees': 10},
+    'RandomElasticDeformation': {'num_control_points': 7, 'max_displacement': 7.5},
+    'RandomGamma': {'log_gamma': 0.3},
+}
+
+
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def check(patch_shape):
+    """
+    labels sampled as the images: a patch whose image is its label must keep them equal (flips) or almost equal
+    (interpolated transforms, where linear and nearest sampling differ on the borders of the labels)
+    """
+    labels = torch.from_numpy(np.stack([make_subject(patch_shape, f'P{n}')['label'][tio.DATA].numpy() for n in range(4)]))
+    images = labels.float()
+    flipped = ba.RandomFlip(flip_probability=0.5)(images, labels)
+    assert torch.equal(flipped[0], flipped[1].float()), "image and label flipped differently"
+    same = ba.RandomAffine(scales=0, degrees=0)(images, labels)
+    assert torch.allclose(same[0], images, atol=1e-4) and torch.equal(same[1], labels), "identity affine changed the patches"
+    for transform in [ba.RandomAffine(degrees=15), ba.RandomElasticDeformation(max_displacement=10)]:
+        image, label = transform(images, labels)
+        changed = (label != labels).float().mean()
+        mismatch = ((image > 0.5).to(label.dtype) != label).float().mean()
+        assert changed > 0 and mismatch < 0.1 * changed, f"{transform.__class__.__name__}: labels do not follow images"
+        print(f"{transform.__class__.__name__}: {changed:.3%} of the label changed, {mismatch:.4%} differs from the image")
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[168, 280, 360], help='Z H W of the volumes')
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--batch_size', type=int, default=6)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    np.random.seed(0)
+    patch_shape = tuple(args.patch_shape)
+    check(patch_shape)
+
+    subject = make_subject(tuple(args.shape), 'P0')
+    subject['data'] = tio.ScalarImage(tensor=subject['label'][tio.DATA].float() * 0.5 + torch.rand(1, *args.shape) * 0.5)
+    patches = [tio.GridSampler(subject, patch_shape)[n] for n in range(args.batch_size)]
+    patches_per_subject = int(np.prod([np.round(i / j) for i, j in zip(args.shape, patch_shape)]))
+    images = torch.stack([p['data'][tio.DATA] for p in patches])
+    labels = torch.stack([p['label'][tio.DATA] for p in patches])
+
+    print(f"patches/s on one cpu thread, patches {patch_shape}, batches of {args.batch_size}, "
+          f"{patches_per_subject} patches per subject {tuple(args.shape)}")
+    for name, kwargs in [*TRANSFORMS.items(), ('all', None)]:
+        augmentations = TRANSFORMS if kwargs is None else {name: kwargs}
+        tio_transform = AugFactory(augmentations).get_transform()
+        batch_transform = AugFactory({'backend': 'torch', **augmentations}).get_batch_transform()
+        per_patch = timeit(lambda: [tio_transform(p) for p in patches], args.repeat) / args.batch_size
+        per_subject = timeit(lambda: tio_transform(subject), 1 if name == 'all' else args.repeat) / patches_per_subject
+        batched = timeit(lambda: batch_transform(images, labels), args.repeat) / args.batch_size
+        print(f"{name:25s} torchio on patches {1 / per_patch:7.1f} | torchio on subjects {1 / per_subject:7.1f} | "
+              f"batched {1 / batched:7.1f} | x{per_patch / batched:.1f} (patches) x{per_subject / batched:.1f} (subjects)")
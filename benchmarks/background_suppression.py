@@ -0,0 +1,153 @@
+"""
+batched background suppression against the old slice by slice arch detection, on synthetic volumes with a dental arch:
+time of the candidate slices, agreement of the masks, and the per patient masks of Loader3D.suppression_masks
+computed by the process pool and then read from the cache.
+run it from the project root with: python -m benchmarks.background_suppression
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import cv2
+import utils
+from loaders.cache import VolumeCache
+from loaders.dataset3D import Loader3D
+from benchmarks.arch_lines import loop_arch_stats, loop_paralines_mask
+
+DICOM_MIN, DICOM_MAX = 0, 2100
+
+
+def loop_skeleton(img):
+    """
+    reference implementation: old utils.compute_skeleton
+    """
+    img = img.astype(np.uint8)
+    skel = np.zeros(img.shape, np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+    while True:
+        eroded = cv2.erode(img, kernel)
+        skel = np.bitwise_or(skel, cv2.subtract(img, cv2.dilate(eroded, kernel)))
+        img = eroded.copy()
+        if cv2.countNonZero(img) == 0:
+            return skel
+
+
+def loop_fill_holes(img):
+    """
+    reference implementation: old utils.fill_holes
+    """
+    _, labels, stats, _ = cv2.connectedComponentsWithStats(img.astype(np.int8))
+    return (labels == np.argsort(-stats[1:, -1])[0] + 1).astype(np.int8)
+
+
+def loop_arch_detection(slice):
+    """
+    reference implementation: old utils.arch_detection
+    """
+    arch = cv2.morphologyEx(slice, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5)))
+    values, bins = np.histogram(arch, bins=40)
+    suitable_idx = np.abs(np.cumsum(values) / arch.size - 0.86).argmin()
+    arch = cv2.threshold(arch, bins[suitable_idx], 1, cv2.THRESH_BINARY)[1]
+    arch = loop_fill_holes(arch.astype(np.int8))
+    arch = 1 - loop_fill_holes(1 - arch)
+    coords = np.argwhere(loop_skeleton(arch) > 0)
+    y, x = list(coords[:, 0]), list(coords[:, 1])
+    return np.poly1d(np.polyfit(x, y, 8)), min(x), max(x)
+
+
+def loop_suppression_mask(data):
+    """
+    reference implementation: mask of the old utils.background_suppression
+    """
+    Z_center = data.shape[0] // 2
+    best, setup = 100, []
+    for i in range(Z_center - 40, Z_center + 40, 4):
+        p, start, end = loop_arch_detection(data[i])
+        mid = (start + end) // 2
+        new_start = start + np.argmax([p(i) for i in range(start, mid)])
+        new_end = mid + np.argmax([p(i) for i in range(mid, end)])
+        score = abs(p(new_start) - p(new_end))
+        lenght, peak = loop_arch_stats(p, new_start, new_end)
+        if new_start < 100 and new_end > data.shape[-1] - 100 and p(new_start) > data.shape[-2] - 200 and p(new_end) > data.shape[-2] - 200:
+            if score < best and lenght > 500 and peak < 80:
+                best, setup = score, [p, new_start, new_end]
+    if not setup:
+        return None
+    f, start, end = setup
+    mask = loop_paralines_mask(f, start, end, data.shape[-2:], offset=40)
+    mask[int(max(f(start), f(end))):, :] = False
+    return mask
+
+
+def make_volume(shape, rng):
+    """
+    raw volume with a bright band along a dental arch (lower on the sides), noise and a few bright spots
+    """
+    Z, H, W = shape
+    y, x = np.mgrid[:H, :W]
+    center = W / 2 + rng.uniform(-15, 15)
+    arch_y = 60 + (H - 210) * ((x - center) / (W / 2 - W // 10)) ** 2
+    band = (np.abs(y - arch_y) < 30) & (x > W // 10) & (x < W - W // 10)
+    volume = rng.uniform(0, 700, (Z, H, W)).astype(np.float32)
+    volume[:, band] += 1300
+    for _ in range(5):
+        cz, cy, cx = rng.randint(Z), rng.randint(H), rng.randint(W)
+        volume[max(cz - 3, 0):cz + 3, max(cy - 4, 0):cy + 4, max(cx - 4, 0):cx + 4] = 2000
+    return volume
+
+
+def normalize(volume):
+    return (np.clip(volume, DICOM_MIN, DICOM_MAX) + DICOM_MIN) / (DICOM_MAX + DICOM_MIN)
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[120, 400, 500], help='Z H W of the volumes')
+    arg_parser.add_argument('--patients', type=int, default=4)
+    arg_parser.add_argument('--workers', type=int, default=2)
+    args = arg_parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    volumes = [make_volume(tuple(args.shape), rng) for _ in range(args.patients)]
+
+    # skeleton of a stack against the skeleton of each slice
+    masks = np.stack([loop_fill_holes((s > 0.5).astype(np.int8)) for s in normalize(volumes[0])[:8]])
+    assert np.array_equal(utils.compute_skeleton(masks), np.stack([loop_skeleton(m) for m in masks]))
+
+    times = np.zeros(2)
+    for volume in volumes:
+        data = normalize(volume)
+        start = time.perf_counter()
+        old = loop_suppression_mask(data)
+        times[0] += time.perf_counter() - start
+        start = time.perf_counter()
+        new = utils.suppression_mask(data[utils.suppression_slices(data.shape[0])])
+        times[1] += time.perf_counter() - start
+        assert old is not None and new is not None, "no arch found"
+        print(f"mask of the arch: {old.mean():.1%} of the slice, {(old != new).sum()} pixels differ")
+    # blank slices have no skeleton and are skipped, the arch is found on the others. a blank volume has no mask
+    data = normalize(volumes[0])[utils.suppression_slices(len(volumes[0]))]
+    data[::2] = 0
+    assert utils.arch_detection_batch(data)[0] is None
+    assert utils.suppression_mask(data) is not None, "no arch found with blank slices"
+    assert utils.suppression_mask(np.zeros_like(data)) is None
+    old_time, new_time = times / args.patients
+    print(f"candidate slices of a patient: loop {old_time * 1000:.0f}ms | batched {new_time * 1000:.0f}ms | x{old_time / new_time:.1f}")
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for n, volume in enumerate(volumes):
+            paths.append(os.path.join(folder, f'P{n}.npy'))
+            np.save(paths[-1], volume)
+        loader = Loader3D.__new__(Loader3D)  # just the preprocessing stage, without a dataset
+        loader.config = {'preprocessing_workers': args.workers}
+        loader.dicom_min, loader.dicom_max = DICOM_MIN, DICOM_MAX
+        loader.cache = VolumeCache(os.path.join(folder, 'cache'), params={'background_suppression': True})
+        for run in ['cold', 'warm']:
+            start = time.perf_counter()
+            masks = loader.suppression_masks(paths)
+            print(f"{run} cache: {args.patients} patients in {time.perf_counter() - start:.2f}s")
+        for path, volume in zip(paths, volumes):
+            assert np.array_equal(masks[path], utils.suppression_mask(normalize(volume)[utils.suppression_slices(len(volume))]))
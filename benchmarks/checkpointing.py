@@ -0,0 +1,76 @@
+"""
+memory and speed of the PadUNet3D training step with activation checkpointing, and parity of the gradients.
+memory is the size of the activations kept for the backward pass: tensors saved by autograd (but the weights)
+plus the inputs of the checkpointed blocks. on cuda the peak allocated memory is reported too, on cpu the peak of
+the process is dominated by the im2col buffers of the convolutions and it is not meaningful.
+run it from the project root with: python -m benchmarks.checkpointing
+"""
+import time
+import argparse
+import torch
+from models.PadUNet3D import padUNet3D
+from models.checkpointing import CheckpointedBlock
+
+
+def step(checkpointing, batch_size, patch_shape, device, seed=0):
+    """
+    one training step from a fixed init
+
+    Returns:
+        (dict) gradients and batch norm buffers after the step
+        (float) seconds of the step
+        (float) activations in MB
+        (float) peak memory in MB, cuda only
+    """
+    torch.manual_seed(seed)
+    model = padUNet3D(n_classes=2, in_ch=1, checkpointing=checkpointing).to(device).train()
+    images = torch.rand((batch_size, 1, *patch_shape), device=device)
+    labels = (images[:, 0] > .7).long()
+
+    # weights are saved by the convolutions too, they are not activations. tensors saved twice are counted once
+    kept = {p.data_ptr(): 0 for p in model.parameters()}
+
+    def count(tensor):
+        kept.setdefault(tensor.data_ptr(), tensor.numel() * tensor.element_size())
+        return tensor
+
+    def count_input(module, inputs):
+        count(inputs[0])
+
+    for module in model.modules():
+        if isinstance(module, CheckpointedBlock):
+            module.register_forward_pre_hook(count_input)
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with torch.autograd.graph.saved_tensors_hooks(count, lambda tensor: tensor):
+        loss = torch.nn.functional.cross_entropy(model(images, None), labels)
+    loss.backward()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device == 'cuda' else None
+    state = {name: p.grad.cpu() for name, p in model.named_parameters()}
+    state.update({name: b.cpu() for name, b in model.named_buffers()})
+    return state, elapsed, sum(kept.values()) / 2 ** 20, peak
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[64, 64, 64])
+    arg_parser.add_argument('--batch_size', type=int, default=1)
+    arg_parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = arg_parser.parse_args()
+
+    print(f"PadUNet3D, batch {args.batch_size}x{tuple(args.patch_shape)} on {args.device}")
+    reference = None
+    for checkpointing in [None, ['ec0', 'ec1', 'dc2', 'dc1'], 'encoder', 'all']:
+        state, elapsed, activations, peak = step(checkpointing, args.batch_size, args.patch_shape, args.device)
+        reference = state if reference is None else reference
+        diff = max((state[k].float() - reference[k].float()).abs().max().item() for k in reference)
+        print(f"{str(checkpointing):>28}: step {elapsed:6.2f}s, activations {activations:7.1f}MB"
+              f"{'' if peak is None else f', peak {peak:.0f}MB'}, max diff from no checkpointing {diff:.1e}")
@@ -0,0 +1,36 @@
+"""
+throughput (slices/s) of the serial and the parallel DICOM loaders.
+run it from the project root with: python -m benchmarks.dicom_loader --dicomdir path/to/DICOMDIR [path/to/DICOMDIR ...]
+"""
+import time
+import argparse
+import numpy as np
+from pydicom.filereader import read_dicomdir
+from dicom_loader import dicom_from_dicomdir, parallel_dicom_from_dicomdir, DICOM_WORKERS
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--dicomdir', nargs='+', required=True, help='one or more paths to DICOMDIR files')
+    arg_parser.add_argument('--num_workers', type=int, nargs='+', default=[1, 2, 4, DICOM_WORKERS], help='pool sizes to test')
+    args = arg_parser.parse_args()
+
+    for path in args.dicomdir:
+        dicom_dir = read_dicomdir(path)
+
+        start = time.perf_counter()
+        filenames, _, reference = dicom_from_dicomdir(dicom_dir)
+        elapsed = time.perf_counter() - start
+        print(f"{path}: serial {reference.shape[0] / elapsed:8.1f} slices/s")
+        reference = dict(zip(filenames, reference))
+
+        for num_workers in args.num_workers:
+            for release in [False, True]:
+                start = time.perf_counter()
+                filenames, datasets, volume = parallel_dicom_from_dicomdir(dicom_dir, num_workers=num_workers, release_pixel_data=release)
+                elapsed = time.perf_counter() - start
+                assert all(np.array_equal(reference[f], v) for f, v in zip(filenames, volume)), "volumes are not matching"
+                if not release:  # the datasets can still decode their slices
+                    assert all(np.array_equal(ds.pixel_array, v) for ds, v in zip(datasets, volume)), "pixel_array of the datasets is not matching"
+                print(f"{path}: parallel {num_workers:2d} workers, release {release!s:<5} {volume.shape[0] / elapsed:8.1f} slices/s")
@@ -0,0 +1,111 @@
+"""
+test3D split among ranks (gloo, cpu processes) against a single process: the gathered metrics must be the same,
+in the same order, and the work of each rank goes down with the number of ranks.
+cpu time of each rank is reported, wall time only scales when the ranks have their own devices.
+run it from the project root with: python -m benchmarks.distributed_eval
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torchio as tio
+from torch import nn
+from eval import Eval
+from inference import SlidingWindow
+from test import test3D
+from benchmarks.sampler import make_subject
+
+CONFIG = {'labels': {'BACKGROUND': 0, 'INSIDE': 1}}
+
+
+class ThresholdModel(nn.Module):
+    """
+    a convolution which predicts the canal of make_subject from the label stored in the input, with some noise
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv3d(1, 1, 3, padding=1)
+        nn.init.constant_(self.conv.weight, 1 / 27)
+        nn.init.constant_(self.conv.bias, -0.6)
+
+    def forward(self, x, emb_codes=None):
+        return self.conv(x) * 10
+
+
+def make_subjects(folder, count, shape):
+    """
+    subjects as returned by SubjectLoader, with labels and images also on disk
+    """
+    subjects = []
+    for n in range(count):
+        subject = make_subject(shape, f'P{n}')
+        label = subject['label'][tio.DATA][0].numpy()
+        data = (label + np.random.RandomState(n).rand(*shape) * 0.6).astype(np.float32)
+        np.save(os.path.join(folder, f'P{n}_gt.npy'), label)
+        np.save(os.path.join(folder, f'P{n}_data.npy'), data)
+        subjects.append(tio.Subject(
+            data=tio.ScalarImage(tensor=torch.from_numpy(data[None])),
+            gt_path=os.path.join(folder, f'P{n}_gt.npy'),
+            data_path=os.path.join(folder, f'P{n}_data.npy'),
+            folder=f'P{n}',
+        ))
+    return subjects
+
+
+def run(rank, world_size, folder, subjects, patch_shape, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = '29517'
+    torch.set_num_threads(1)
+    if world_size > 1:
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    evaluator = Eval(CONFIG, folder, skip_dump=True, rank=rank, world_size=world_size)
+    engine = SlidingWindow(patch_shape, batch_size=4, device='cpu')
+    evaluator.reset_eval()
+
+    # test3D resets the lists in mean_metric, they are kept here to be checked
+    mean_metric = evaluator.mean_metric
+    kept = {}
+
+    def keep(phase):
+        kept.update(ids=list(evaluator.test_ids), iou=list(evaluator.iou_list), hd=list(evaluator.hausdorf_list))
+        return mean_metric(phase)
+
+    evaluator.mean_metric = keep
+    start = time.process_time()
+    scores = test3D(ThresholdModel(), subjects[rank::world_size], 0, None, evaluator, 'Validation', engine)
+    results[rank] = (scores, kept, time.process_time() - start)
+    if world_size > 1:
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[64, 96, 128], help='Z H W of the volumes')
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[32, 48, 64])
+    arg_parser.add_argument('--subjects', type=int, default=8)
+    arg_parser.add_argument('--world_size', type=int, nargs='+', default=[1, 2, 4])
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        subjects = make_subjects(folder, args.subjects, tuple(args.shape))
+        reference = None
+        for world_size in args.world_size:
+            results = mp.Manager().dict()
+            mp.spawn(run, args=(world_size, folder, subjects, args.patch_shape, results), nprocs=world_size)
+            scores, kept, _ = results[0]
+            if reference is None:
+                reference = scores, kept
+            for rank in range(world_size):
+                assert results[rank][0] == reference[0], "ranks got different scores"
+                assert results[rank][1] == reference[1], "gathered metrics are not in the order of the subjects"
+            times = [results[rank][2] for rank in range(world_size)]
+            print(
+                f"{world_size} ranks: iou {scores[0]:.4f} dice {scores[1]:.4f} haus {scores[2]:.2f}, "
+                f"max cpu time of a rank {max(times):.2f}s ({len(subjects[::world_size])} subjects)"
+            )
@@ -0,0 +1,89 @@
+"""
+size and wall-clock of the Final dump: old npy files + zip of the numpy folder against the ArchiveWriter of Eval.
+the time spent by the evaluation loop is measured separately from the total, the writer works in background.
+run it from the project root with: python -m benchmarks.dump
+"""
+import os
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import numpy as np
+from eval import ArchiveWriter
+
+
+def make_patient(shape, rng):
+    """
+    a canal-like prediction (a tube along the W axis), a noisy ground truth and a float input volume
+    """
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center_z = shape[0] / 2 + shape[0] / 8 * np.sin(x / shape[2] * np.pi)
+    pred = ((z - center_z) ** 2 + (y - shape[1] / 2) ** 2 < 36).astype(np.int64)  # argmax output
+    gt = np.roll(pred, 1, axis=0).astype(np.int64)
+    images = rng.random(shape)  # float64 as the volumes loaded from storage
+    return gt, pred, images
+
+
+def old_dump(project_dir, patients):
+    """
+    reference implementation: old Eval.dump and Eval.save_zip
+    """
+    start = time.perf_counter()
+    for name, (gt, pred, images) in patients.items():
+        save_dir = os.path.join(project_dir, 'numpy', name)
+        os.makedirs(save_dir, exist_ok=True)
+        np.save(os.path.join(save_dir, 'gt.npy'), gt)
+        np.save(os.path.join(save_dir, 'pred.npy'), pred)
+        np.save(os.path.join(save_dir, 'input.npy'), images)
+    loop = time.perf_counter() - start
+    zipf = zipfile.ZipFile(os.path.join(project_dir, 'numpy.zip'), 'w', zipfile.ZIP_DEFLATED)
+    for root, dirs, files in os.walk(os.path.join(project_dir, 'numpy')):
+        for file in files:
+            zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), project_dir))
+    zipf.close()
+    return loop, time.perf_counter() - start
+
+
+def new_dump(project_dir, patients):
+    start = time.perf_counter()
+    writer = ArchiveWriter(os.path.join(project_dir, 'numpy.zip'))
+    for name, (gt, pred, images) in patients.items():
+        writer.write(f'numpy/{name}', gt=gt.astype(np.uint8), pred=pred.astype(np.uint8), input=images.astype(np.float32))
+    loop = time.perf_counter() - start
+    writer.close()
+    return loop, time.perf_counter() - start
+
+
+def folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[168, 280, 360], help='Z H W of the volumes')
+    arg_parser.add_argument('--patients', type=int, default=4)
+    args = arg_parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    patients = {f'P{n}': make_patient(tuple(args.shape), rng) for n in range(args.patients)}
+
+    results = {}
+    for name, fn in [('npy + zip', old_dump), ('archive writer', new_dump)]:
+        project_dir = tempfile.mkdtemp(prefix='dump_bench_')
+        loop, total = fn(project_dir, patients)
+        results[name] = project_dir
+        print(f"{name:>15}: eval loop {loop:.2f}s, total {total:.2f}s, "
+              f"disk {folder_size(project_dir) / 2 ** 20:.1f}MB, zip {os.path.getsize(os.path.join(project_dir, 'numpy.zip')) / 2 ** 20:.1f}MB")
+
+    # the archives must unzip to the same layout and labels
+    with zipfile.ZipFile(os.path.join(results['npy + zip'], 'numpy.zip')) as old, \
+            zipfile.ZipFile(os.path.join(results['archive writer'], 'numpy.zip')) as new:
+        assert sorted(old.namelist()) == sorted(new.namelist()), "different archive layout"
+        for entry in old.namelist():
+            with old.open(entry) as a, new.open(entry) as b:
+                assert np.allclose(np.load(a), np.load(b), atol=1e-6), f"{entry} differs"
+    print("same layout and content")
+    for project_dir in results.values():
+        shutil.rmtree(project_dir)
@@ -0,0 +1,92 @@
+"""
+augmentations.ElasticDeformation with a coarse displacement grid shared by all the channels and by the mask, against
+the old one which filtered two dense random fields for each channel, once for the image and again for the mask.
+time on a patch and agreement of image and mask: the image of the check is the mask itself, so after the deformation
+the two must still match.
+run it from the project root with: python -m benchmarks.elastic_deformation
+"""
+import time
+import argparse
+import numpy as np
+from scipy.ndimage import map_coordinates, gaussian_filter
+from augmentations import ElasticDeformation
+
+
+class LoopElasticDeformation:
+    """
+    reference implementation: old augmentations.ElasticDeformation, with fixed alpha and sigma
+    """
+
+    def __init__(self, spline_order=2, alpha=1, sigma=5):
+        self.spline_order = spline_order
+        self.alpha = alpha
+        self.sigma = sigma
+
+    def deformate(self, volume, spline_order=0):
+        y_dim, x_dim = volume[0].shape
+        y, x = np.meshgrid(np.arange(y_dim), np.arange(x_dim), indexing='ij')
+        for i in range(volume.shape[0]):
+            dy, dx = [
+                gaussian_filter(np.random.randn(*volume[0].shape), self.sigma, mode="reflect") * self.alpha
+                for _ in range(2)
+            ]
+            volume[i] = map_coordinates(volume[i], (y + dy, x + dx), order=spline_order, mode='reflect')
+        return volume
+
+    def __call__(self, data):
+        image, mask = data
+        return [self.deformate(image.copy(), self.spline_order), self.deformate(mask.copy(), 0)]
+
+
+def make_mask(shape):
+    """
+    a canal-like tube along the W axis
+    """
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center_z = shape[0] / 2 + shape[0] / 8 * np.sin(x / shape[2] * np.pi)
+    return ((z - center_z) ** 2 + (y - shape[1] / 2) ** 2 < 64).astype(np.float32)
+
+
+def agreement(transform, mask, repeat):
+    """
+    Returns:
+        (float) seconds of each call
+        (float) share of the voxels of the mask moved by the deformation
+        (float) share of the voxels where deformed image and deformed mask disagree
+    """
+    moved, mismatch = 0, 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        image, label = transform([mask.copy(), mask.copy()])
+        moved += (label != mask).mean() / repeat
+        mismatch += ((image > 0.5) != (label > 0.5)).mean() / repeat
+    return (time.perf_counter() - start) / repeat, moved, mismatch
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--displacement', type=float, default=3, help='std of the displacements in voxels')
+    arg_parser.add_argument('--sigma', type=float, default=4)
+    arg_parser.add_argument('--spline_order', type=int, nargs='+', default=[2, 1], help='orders of the image')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    np.random.seed(0)
+    mask = make_mask(tuple(args.patch_shape))
+    print(f"patch {tuple(args.patch_shape)}, image and mask")
+    for order in args.spline_order:
+        # std of white noise filtered by a 2D gaussian is 1 / (2 sqrt(pi) sigma): same alpha and sigma for both
+        alpha = args.displacement * 2 * np.sqrt(np.pi) * args.sigma
+        old = LoopElasticDeformation(order, alpha=alpha, sigma=args.sigma)
+        new = ElasticDeformation(order, execution_probability=1)
+        new.alpha, new.sigma = alpha, args.sigma  # fixed instead of drawn
+        old_time, old_moved, old_mismatch = agreement(old, mask, args.repeat)
+        new_time, new_moved, new_mismatch = agreement(new, mask, args.repeat)
+        print(f"spline order {order} | old (per slice) {old_time * 1000:4.0f}ms, {old_moved:.2%} of the voxels moved, "
+              f"{old_mismatch:.2%} image/mask mismatch | new (shared 3D) {new_time * 1000:4.0f}ms, {new_moved:.2%} "
+              f"moved, {new_mismatch:.2%} mismatch | x{old_time / new_time:.1f}")
+
+    image, label = new([mask[None].repeat(3, 0), mask.copy()])  # CZYX: the same field for each channel
+    assert image.shape == (3, *mask.shape) and all(np.array_equal(image[0], c) for c in image[1:])
@@ -0,0 +1,133 @@
+"""
+augmentations.Geometry against the old geometry ops: CropAndPad of Loader3D and its inverse in test3D, CenterPad +
+Rescale of the 2D dataset and the interpolate + CenterCrop of test2D. 3D results must be the same voxels, 2D ones
+are compared on a smooth volume (the resample is done before the padding, offsets move by a fraction of a voxel).
+run it from the project root with: python -m benchmarks.geometry
+"""
+import time
+import argparse
+import numpy as np
+import torch
+from torch.nn.functional import interpolate, pad
+from augmentations import Geometry, CenterCrop, CenterPad, Rescale
+
+
+class LoopCropAndPad:
+    """
+    reference implementation: old augmentations.CropAndPad
+    """
+
+    def __init__(self, target_shape, pad_val=None):
+        self.target_shape = target_shape
+        self.pad_val = pad_val
+
+    def __call__(self, image):
+        was_numpy = not torch.is_tensor(image)
+        z_offset = max(image.shape[-3] - self.target_shape[0], 0)
+        y_offset = max(image.shape[-2] - self.target_shape[1], 0)
+        x_offset = max(image.shape[-1] - self.target_shape[2], 0)
+        z_offset = int(np.floor(z_offset / 2.)), image.shape[-3] - int(np.ceil(z_offset / 2.))
+        y_offset = int(np.floor(y_offset / 2.)), image.shape[-2] - int(np.ceil(y_offset / 2.))
+        x_offset = int(np.floor(x_offset / 2.)), image.shape[-1] - int(np.ceil(x_offset / 2.))
+        img = image[..., z_offset[0]:z_offset[1], y_offset[0]:y_offset[1], x_offset[0]:x_offset[1]]
+        z_offset = -min(image.shape[-3] - self.target_shape[0], 0)
+        y_offset = -min(image.shape[-2] - self.target_shape[1], 0)
+        x_offset = -min(image.shape[-1] - self.target_shape[2], 0)
+        z_offset = int(np.floor(z_offset / 2.)), z_offset - int(np.floor(z_offset / 2.))
+        y_offset = int(np.floor(y_offset / 2.)), y_offset - int(np.floor(y_offset / 2.))
+        x_offset = int(np.floor(x_offset / 2.)), x_offset - int(np.floor(x_offset / 2.))
+        img = img if torch.is_tensor(img) else torch.from_numpy(img)
+        self.pad_val = self.pad_val if self.pad_val else img.min()
+        img = pad(img, (x_offset[0], x_offset[1], y_offset[0], y_offset[1], z_offset[0], z_offset[1]), value=self.pad_val)
+        if was_numpy:
+            return img.numpy()
+        return img
+
+
+def old_pad_rescale(data, reshape_size):
+    """
+    reference implementation: geometry of the old AlveolarDataloader.preprocessing
+    Returns:
+        (numpy array) rescaled volume
+        (tuple) shape of the padded volume, needed by the inverse
+    """
+    D, H, W = data.shape[-3:]
+    rD, rH, rW = reshape_size
+    pad_factor = np.array((D / W, H / W, 1)) / np.array((rD / rW, rH / rW, 1))
+    pad_factor /= np.max(pad_factor)
+    new_shape = np.round(np.array((D, H, W)) / pad_factor).astype(int)
+    return Rescale(size=reshape_size)(CenterPad(new_shape)(data)), tuple(new_shape)
+
+
+def old_inverse_2d(output, new_shape, shape):
+    """
+    reference implementation: geometry of the old test2D
+    """
+    output = interpolate(output.unsqueeze(0), size=new_shape, mode='trilinear', align_corners=False).squeeze()
+    return CenterCrop(shape)(output)
+
+
+def smooth_volume(shape, rng):
+    z, y, x = np.meshgrid(*[np.linspace(0, np.pi, s) for s in shape], indexing='ij')
+    phase = rng.uniform(0, np.pi, 3)
+    return (1 + np.sin(2 * z + phase[0]) * np.cos(3 * y + phase[1]) * np.sin(2 * x + phase[2])).astype(np.float32) * 1000
+
+
+def timeit(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        res = fn()
+    return res, (time.perf_counter() - start) / repeat
+
+
+def row(name, old_time, new_time, note):
+    print(f"{name:22s} old {old_time * 1000:7.1f}ms | Geometry {new_time * 1000:7.1f}ms | x{old_time / new_time:.1f} | {note}")
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[178, 423, 463], help='Z H W of the raw volumes')
+    arg_parser.add_argument('--resize_shape', type=int, nargs=3, default=[168, 280, 360])
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    torch.set_num_threads(1)
+    rng = np.random.RandomState(0)
+    shape, resize_shape = tuple(args.shape), tuple(args.resize_shape)
+    data = rng.rand(*shape).astype(np.float32)
+    gt = (rng.rand(*shape) > 0.99).astype(np.uint8)
+
+    # 3D: crop/pad of Loader3D.preprocessing and its inverse in test3D
+    geometry = Geometry(shape, resize_shape)
+    (old, old_time), (new, new_time) = timeit(lambda: LoopCropAndPad(resize_shape)(data), args.repeat), timeit(lambda: geometry(data), args.repeat)
+    assert np.array_equal(old, new) and new.dtype == np.float32
+    assert np.array_equal(LoopCropAndPad(resize_shape, 0)(gt), geometry(gt, pad_val=0))
+    row('crop/pad', old_time, new_time, 'same voxels')
+    # one axis cropped and the others padded: the padding is the min of the cropped voxels
+    mixed = (shape[0] + 8, shape[1] - 8, shape[2] // 2)
+    assert np.array_equal(LoopCropAndPad(mixed)(data), Geometry(shape, mixed)(data))
+
+    output = torch.from_numpy(rng.rand(2, *resize_shape).astype(np.float32))
+    (old, old_time), (new, new_time) = (timeit(lambda: LoopCropAndPad(shape)(output), args.repeat),
+                                        timeit(lambda: geometry.inverse()(output), args.repeat))
+    assert torch.equal(old, new)
+    row('crop/pad inverse', old_time, new_time, 'same voxels')
+    small = tuple(s - 10 for s in resize_shape)  # just padding, the inverse gives back the source
+    volume = rng.rand(*small).astype(np.float32)
+    assert np.array_equal(Geometry(small, resize_shape).inverse()(Geometry(small, resize_shape)(volume)), volume)
+
+    # 2D: pad to the aspect ratio and rescale, inverse in test2D
+    volume = smooth_volume(shape, rng)
+    geometry = Geometry.keep_aspect(shape, resize_shape)
+    ((old, new_shape), old_time), (new, new_time) = (timeit(lambda: old_pad_rescale(volume, resize_shape), args.repeat),
+                                                     timeit(lambda: geometry(volume), args.repeat))
+    inside = (slice(None), *[slice(s // 10, s - s // 10) for s in resize_shape[1:]])
+    row('pad + rescale', old_time, new_time, f'max difference {np.abs(old - new)[inside].max() / 2000:.2%} of the range')
+
+    output = torch.from_numpy(np.stack([new, -new]))
+    (old, old_time), (back, new_time) = (timeit(lambda: old_inverse_2d(output, new_shape, shape), args.repeat),
+                                         timeit(lambda: geometry.inverse()(output), args.repeat))
+    error = (np.abs(back[0].numpy() - volume) / 2000)[1:-1, 1:-1, 1:-1]
+    row('pad + rescale inverse', old_time, new_time, f'round trip: mean error {error.mean():.3%}, max {error.max():.2%} of the range')
+    assert back.shape == (2, *shape) and error.mean() < 0.01
@@ -0,0 +1,57 @@
+"""
+share of empty patches queued by tio.GridSampler and by ForegroundGridSampler, the same subjects and augmentations.
+run it from the project root with: python -m benchmarks.grid_sampler
+"""
+import time
+import argparse
+import numpy as np
+import torch
+import torchio as tio
+from loaders.samplers import ForegroundGridSampler
+from benchmarks.sampler import make_subject
+
+
+def epoch(sampler, subjects, samples_per_volume, transform):
+    """
+    one epoch through a tio.Queue
+
+    Returns:
+        (float) seconds of the epoch
+        (float) share of the patches with labels
+    """
+    queue = tio.Queue(
+        tio.SubjectsDataset(subjects, transform=transform),
+        max_length=samples_per_volume * 2,
+        samples_per_volume=samples_per_volume,
+        sampler=sampler,
+        num_workers=0,
+        shuffle_subjects=False,
+    )
+    start = time.perf_counter()
+    with_fg = [bool(queue[i]['label'][tio.DATA].any()) for i in range(len(queue))]
+    return time.perf_counter() - start, np.mean(with_fg)
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[168, 280, 360], help='Z H W of the volumes')
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--background_ratio', type=float, default=0.1)
+    arg_parser.add_argument('--subjects', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    np.random.seed(0)
+    torch.manual_seed(0)
+    subjects = [make_subject(tuple(args.shape), f'P{n}') for n in range(args.subjects)]
+    samples_per_volume = int(np.prod([np.round(i / j) for i, j in zip(args.shape, args.patch_shape)]))
+    transform = tio.RandomFlip(axes=2, flip_probability=0.7)
+
+    samplers = [
+        ('tio.GridSampler', tio.GridSampler(patch_size=args.patch_shape)),
+        ('ForegroundGridSampler', ForegroundGridSampler(args.patch_shape, background_ratio=args.background_ratio)),
+    ]
+    for name, sampler in samplers:
+        for n in range(2):
+            seconds, fg = epoch(sampler, subjects, samples_per_volume, transform)
+            print(f"{name:>22} epoch {n}: {seconds:.2f}s, {fg:.0%} of {samples_per_volume * len(subjects)} patches with labels")
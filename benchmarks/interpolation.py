@@ -0,0 +1,93 @@
+"""
+benchmark of the batched line_slice / plane_slice against the old per-voxel loops.
+run it from the project root with: python -m benchmarks.interpolation
+"""
+import time
+import argparse
+import numpy as np
+from Jaw import Jaw
+from Plane import Plane
+import processing
+
+
+def synthetic_jaw(shape, seed=47):
+    """
+    create a Jaw object on top of a random volume, no DICOM is needed
+    Args:
+        shape (tuple): Z, H, W of the volume
+        seed (int): random seed
+
+    Returns:
+        (Jaw) jaw object ready for the cut functions
+    """
+    rng = np.random.default_rng(seed)
+    jaw = Jaw.__new__(Jaw)
+    jaw.volume = rng.uniform(0, 2100, size=shape)
+    jaw.gt_volume = (rng.uniform(size=shape) > .99).astype(np.uint8)
+    jaw.Z, jaw.H, jaw.W = shape
+    jaw.max_value = jaw.volume.max()
+    return jaw
+
+
+def loop_line_slice(jaw, xy_set, interp_fn):
+    """
+    reference implementation: one interpolation call for each column of each cut
+    """
+    interp_fn = getattr(jaw, interp_fn)
+    cut = np.zeros((xy_set.shape[0], jaw.Z, xy_set.shape[1]), np.float32)
+    for num_cut in range(xy_set.shape[0]):
+        for w_id, (x, y) in enumerate(xy_set[num_cut]):
+            if (x - 2) < 0 or (y - 2) < 0 or (x + 2) >= jaw.W or (y + 2) >= jaw.H:
+                continue
+            cut[num_cut, :, w_id] = interp_fn(x, y)
+    return np.clip(cut / jaw.max_value, 0, 1)
+
+
+def loop_plane_slice(jaw, plane, interp_fn):
+    """
+    reference implementation: one interpolation call for each point of the plane
+    """
+    interp_fn = getattr(jaw, interp_fn)
+    cut = np.zeros((jaw.Z, plane.shape[2]))
+    for row in range(jaw.Z):
+        for col in range(plane.shape[2]):
+            cut[row, col] = interp_fn(plane[2, row, col], plane[0, row, col], plane[1, row, col])
+    return cut
+
+
+def timeit(fn, *args, **kwargs):
+    start = time.perf_counter()
+    res = fn(*args, **kwargs)
+    return res, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[400, 400, 500], help='Z H W of the synthetic volume')
+    arg_parser.add_argument('--cuts', type=int, default=100, help='number of side cuts')
+    args = arg_parser.parse_args()
+
+    jaw = synthetic_jaw(tuple(args.shape))
+
+    # side cuts along a synthetic dental arch
+    p = np.poly1d([1 / 300, -(jaw.W / 300), jaw.H * .8])
+    loff, coords, hoff, der = processing.arch_lines(p, 60, jaw.W - 60, offset=50)
+    side_coords = processing.generate_side_coords(hoff, loff, der, offset=100)[:args.cuts]
+
+    print(f"volume {args.shape}, {side_coords.shape[0]} side cuts of {side_coords.shape[1]} columns")
+    for interp_fn in ['bilinear_interpolation', 'bicubic_interpolation']:
+        ref, loop_time = timeit(loop_line_slice, jaw, side_coords, interp_fn)
+        res, batch_time = timeit(jaw.line_slice, side_coords, interp_fn=interp_fn)
+        assert np.allclose(ref, res, atol=1e-5), f"line_slice {interp_fn} is not matching the reference"
+        print(f"line_slice {interp_fn:<24} loop: {loop_time:8.3f}s batched: {batch_time:8.3f}s speedup: {loop_time / batch_time:6.1f}x")
+
+    plane = Plane(jaw.Z, side_coords.shape[1])
+    plane.from_line(side_coords[side_coords.shape[0] // 2])
+    plane.tilt_z(10)
+    plane.tilt_x(5)
+    for interp_fn in ['trilinear_interpolation', 'bicubic_interpolation_3d']:
+        ref, loop_time = timeit(loop_plane_slice, jaw, plane.get_plane(), interp_fn)
+        res, batch_time = timeit(jaw.plane_slice, plane, interp_fn=interp_fn)
+        assert np.allclose(ref, res), f"plane_slice {interp_fn} is not matching the reference"
+        print(f"plane_slice {interp_fn:<24} loop: {loop_time:8.3f}s batched: {batch_time:8.3f}s speedup: {loop_time / batch_time:6.1f}x")
@@ -0,0 +1,133 @@
+"""
+losses of LossFn computed from the logits and the integer labels against the old ones built on one-hot tensors:
+values and gradients must match, memory is the size of the tensors saved for the backward pass by the loss stage
+(labels are uint8 as in the batches of the patch pipeline, the old losses get them as int64 which they need).
+run it from the project root with: python -m benchmarks.losses
+"""
+import time
+import argparse
+import torch
+from torch import nn
+import torch.nn.functional as F
+from losses import LossFn, JaccardLoss
+
+
+class LoopDiceLoss(nn.Module):
+    """
+    reference implementation: old losses.DiceLoss
+    """
+
+    def __init__(self, classes, device, partition_weights):
+        super().__init__()
+        self.eps = 1e-06
+        self.classes = classes
+        self.weights = partition_weights.to(device)
+
+    def forward(self, pred, gt):
+        included = [v for k, v in self.classes.items() if k not in ['UNLABELED']]
+        gt_onehot = torch.nn.functional.one_hot(gt.squeeze().long(), num_classes=len(self.classes))
+        if gt.shape[0] == 1:
+            gt_onehot = gt_onehot.unsqueeze(0)
+        gt_onehot = torch.movedim(gt_onehot, -1, 1)
+        input_soft = F.softmax(pred, dim=1)
+        dims = (2, 3, 4)
+        intersection = torch.sum(input_soft * gt_onehot, dims)
+        cardinality = torch.sum(input_soft + gt_onehot, dims)
+        dice_score = 2. * intersection / (cardinality + self.eps)
+        dice_score = self.weights * dice_score
+        return 1. - dice_score[:, included]
+
+
+def saved_bytes(fn):
+    """
+    bytes of the distinct tensors stored by autograd while running fn (labels and logits are saved by more ops)
+    """
+    storages = {}
+
+    def pack(tensor):
+        storages[(tensor.data_ptr(), tensor.dtype)] = max(storages.get((tensor.data_ptr(), tensor.dtype), 0), tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        res = fn()
+    return res, sum(storages.values())
+
+
+def old_loss(pred, gt, name, classes, partition_weights):
+    """
+    reference implementation: old LossFn.factory_loss, with the device of the batch
+    """
+    device = pred.device
+    if name == 'BCEWithLogitsLoss':
+        B, C, Z, H, W = pred.shape
+        gt_flat = gt.reshape(-1).unsqueeze(dim=1)
+        gt_onehot = torch.zeros(size=(B * Z * H * W, C), dtype=torch.float).to(device)
+        gt_onehot.scatter_(1, gt_flat, 1)
+        gt = torch.squeeze(gt_onehot).reshape(B, Z, H, W, C)
+        pred = pred.permute(0, 2, 3, 4, 1)
+        loss_fn = nn.BCEWithLogitsLoss(pos_weight=None).to(device)
+    elif name == 'Jaccard':
+        loss_fn = JaccardLoss(apply_sigmoid=True, per_volume=True)
+    else:
+        loss_fn = LoopDiceLoss(classes, device, partition_weights)
+    loss = loss_fn(pred, gt) * partition_weights
+    return loss.mean()
+
+
+def old_loss_fn(names, classes):
+    def loss_fn(pred, gt, partition_weights):
+        return torch.sum(torch.stack([old_loss(pred, gt, name, classes, partition_weights) for name in names]))
+    return loss_fn
+
+
+def run(loss_fn, pred, gt, weights, repeat):
+    """
+    Returns:
+        (float) loss
+        (torch.Tensor) gradient of the logits
+        (int) bytes saved for the backward pass
+        (float) seconds of forward and backward
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        logits = pred.detach().requires_grad_()
+        loss, saved = saved_bytes(lambda: loss_fn(logits, gt, weights))
+        loss.backward()
+    return loss.item(), logits.grad, saved, (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--batch_size', type=int, default=3)
+    arg_parser.add_argument('--classes', type=int, default=3, help='classes of the multi class losses')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    torch.manual_seed(0)
+    torch.set_num_threads(1)
+    B, C = args.batch_size, args.classes
+    classes = {'BACKGROUND': 0, **{f'CLASS{c}': c for c in range(1, C)}}
+    weights = torch.ones(B)
+
+    cases = [
+        (['Jaccard'], 1),
+        (['BCEWithLogitsLoss'], C),
+        (['DiceLoss'], C),
+        (['DiceLoss', 'BCEWithLogitsLoss'], C),
+    ]
+    for names, channels in cases:
+        labels = {'BACKGROUND': 0, 'INSIDE': 1} if channels == 1 else classes
+        pred = torch.randn(B, channels, *args.patch_shape)
+        gt = torch.randint(0, max(channels, 2), (B, 1, *args.patch_shape), dtype=torch.uint8)
+        # the old dice broadcast the weights of the volumes over its classes
+        weights_old = torch.ones(channels) if 'DiceLoss' in names else weights
+        old, old_grad, old_saved, old_time = run(old_loss_fn(names, labels), pred, gt.long(), weights_old, args.repeat)
+        new, new_grad, new_saved, new_time = run(LossFn({'name': names}, {'labels': labels}, weights=None), pred, gt,
+                                                 weights, args.repeat)
+        assert abs(old - new) < 1e-4 * max(abs(old), 1), f"{names}: {old} vs {new}"
+        assert torch.allclose(old_grad, new_grad, atol=1e-9, rtol=1e-3), f"{names}: gradients differ"
+        print(f"{'+'.join(names):28s} C={channels} | one-hot {old_saved / 2 ** 20:6.1f}MB {old_time * 1000:6.0f}ms | "
+              f"labels {new_saved / 2 ** 20:6.1f}MB {new_time * 1000:6.0f}ms | memory /{old_saved / new_saved:.1f}, "
+              f"time x{old_time / new_time:.1f}")
@@ -0,0 +1,62 @@
+"""
+micro-benchmark of the confusion matrix metrics against the old per-class argwhere implementation.
+run it from the project root with: python -m benchmarks.metrics
+"""
+import time
+import argparse
+import numpy as np
+import torch
+from eval import confusion_matrix, class_scores
+
+
+def loop_scores(pred, gt, labels, eps=1e-06):
+    """
+    reference implementation: old Eval.iou and Eval.dice_coefficient
+    """
+    iou, dice = [], []
+    for c in labels:
+        gt_class_idx = np.argwhere(gt.flatten() == c)
+        intersection = np.sum(pred.flatten()[gt_class_idx] == c)
+        union = np.argwhere(gt.flatten() == c).size + np.argwhere(pred.flatten() == c).size - intersection
+        iou.append((intersection + eps) / (union + eps))
+    for c in labels:
+        gt_class_idx = np.argwhere(gt.flatten() == c)
+        intersection = np.sum(pred.flatten()[gt_class_idx] == c)
+        dice_union = np.argwhere(gt.flatten() == c).size + np.argwhere(pred.flatten() == c).size
+        dice.append((2 * intersection + eps) / (dice_union + eps))
+    return sum(iou) / len(labels), sum(dice) / len(labels)
+
+
+def timeit(fn, *args, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        res = fn(*args)
+    return res, (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs='+', default=[4, 120, 120, 120], help='BS Z H W of the batch')
+    arg_parser.add_argument('--num_classes', type=int, default=4, help='BACKGROUND, INSIDE, CONTOUR, UNLABELED')
+    args = arg_parser.parse_args()
+
+    rng = np.random.default_rng(47)
+    gt = rng.integers(0, args.num_classes, size=args.shape).astype(np.uint8)
+    pred = np.where(rng.uniform(size=args.shape) > .2, gt, rng.integers(0, args.num_classes, size=args.shape)).astype(np.int64)
+    labels = list(range(1, args.num_classes - 1))  # no background and unlabeled
+
+    def vectorized(pred, gt):
+        scores = [class_scores(confusion_matrix(p, g, args.num_classes), labels) for p, g in zip(pred, gt)]
+        return [(s['iou'].mean(), s['dice'].mean()) for s in scores]
+
+    ref, loop_time = timeit(lambda p, g: [loop_scores(a, b, labels) for a, b in zip(p, g)], pred, gt)
+    res, np_time = timeit(vectorized, pred, gt)
+    assert np.allclose(ref, res), "confusion matrix metrics are not matching the reference"
+    print(f"batch {args.shape}: per-class loops {loop_time * 1000:8.1f}ms, bincount {np_time * 1000:8.1f}ms, speedup {loop_time / np_time:5.1f}x")
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    pred_t, gt_t = torch.from_numpy(pred).to(device), torch.from_numpy(gt).to(device)
+    res, torch_time = timeit(vectorized, pred_t, gt_t)
+    assert np.allclose(ref, res), "torch confusion matrix metrics are not matching the reference"
+    print(f"batch {args.shape}: torch bincount on {device} {torch_time * 1000:8.1f}ms, speedup {loop_time / torch_time:5.1f}x")
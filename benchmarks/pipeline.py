@@ -0,0 +1,81 @@
+"""
+batches per second of PatchPipeline against tio.Queue + DataLoader, with a fake training step of fixed length.
+the content of the batches is checked against the subjects (no augmentations), and the length of the epochs with
+the finite grid sampler against the batches it yields.
+run it from the project root with: python -m benchmarks.pipeline
+"""
+import time
+import logging
+import argparse
+import numpy as np
+import torch
+import torchio as tio
+from torch.utils.data import DataLoader
+from loaders.pipeline import PatchPipeline
+from loaders.samplers import LabelIndexSampler
+from loaders.dataset3D import Loader3D
+from benchmarks.sampler import make_subject
+
+
+def consume(batches, step, subjects=None):
+    """
+    Returns:
+        (float) batches per second
+        (int) patches
+    """
+    labels = {s['folder']: s['label'][tio.DATA] for s in subjects} if subjects is not None else None
+    start = time.perf_counter()
+    patches = 0
+    for batch in batches:
+        images = batch['data'][tio.DATA].float()
+        if labels is not None:
+            for label, location, folder in zip(batch['label'][tio.DATA], batch[tio.LOCATION], batch['folder']):
+                z0, y0, x0, z1, y1, x1 = location.tolist()
+                assert torch.equal(label, labels[folder][:, z0:z1, y0:y1, x0:x1]), "patch and location do not match"
+        patches += len(images)
+        time.sleep(step)  # forward and backward passes
+    return patches / (time.perf_counter() - start), patches
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[168, 280, 360], help='Z H W of the volumes')
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--subjects', type=int, default=4)
+    arg_parser.add_argument('--batch_size', type=int, default=6)
+    arg_parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    arg_parser.add_argument('--step', type=float, default=0.05, help='seconds of the fake training step')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')  # starvation metrics of the pipeline
+    np.random.seed(0)
+    subjects = [make_subject(tuple(args.shape), f'P{n}') for n in range(args.subjects)]
+    samples_per_volume = int(np.prod([np.round(i / j) for i, j in zip(args.shape, args.patch_shape)]))
+    dataset = tio.SubjectsDataset(subjects)
+    sampler = LabelIndexSampler(args.patch_shape, {0: 0.1, 1: 0.9})
+    loader3D = Loader3D.__new__(Loader3D)  # just the patches of the subjects, without a dataset
+    loader3D.subjects, loader3D.reshape_size, loader3D.lazy = {'train': subjects, 'syntetic': []}, tuple(args.shape), False
+    loader3D.patches_per_subject(sampler, samples_per_volume)  # the workers get the index with the sampler
+    assert sorted(sampler.indices) == sorted(s['folder'] for s in subjects), "labels are not indexed before the workers"
+
+    for workers in args.workers:
+        queue = tio.Queue(dataset, samples_per_volume * 4, samples_per_volume, sampler, num_workers=workers)
+        loader = DataLoader(queue, args.batch_size, num_workers=0)
+        speed, patches = consume(loader, args.step)
+        print(f"tio.Queue, {workers} workers: {speed:6.1f} patches/s ({patches} patches)")
+
+        pipeline = PatchPipeline(dataset, sampler, samples_per_volume, args.batch_size, args.patch_shape, num_workers=workers)
+        for epoch in range(2):
+            speed, patches = consume(pipeline, args.step, subjects if epoch == 0 else None)
+            print(f"PatchPipeline, {workers} workers, epoch {epoch}: {speed:6.1f} patches/s ({patches} patches)")
+        pipeline.close()
+
+    # tio.GridSampler gives the grid locations at most, the epoch must not count more patches
+    grid = tio.GridSampler(patch_size=args.patch_shape)
+    counts = loader3D.patches_per_subject(grid, samples_per_volume * 4)
+    pipeline = PatchPipeline(dataset, grid, counts, args.batch_size, args.patch_shape, num_workers=max(args.workers))
+    batches = sum(1 for _ in pipeline)
+    assert batches == len(pipeline), f"grid epoch: {batches} batches, {len(pipeline)} expected"
+    pipeline.close()
+    print(f"grid sampler: {counts[0]} patches of each subject, {batches} batches as expected")
@@ -0,0 +1,99 @@
+"""
+train3D with and without StepProfiler on a small PadUNet3D: the stage table of the epoch is logged, the scalars of
+each step must reach the writer and a torch.profiler trace is saved when asked. the overhead is the slow down of the
+epoch with the profiler enabled (on cuda it also includes the synchronization of the stages).
+run it from the project root with: python -m benchmarks.profiler
+"""
+import os
+import time
+import logging
+import argparse
+import tempfile
+from collections import defaultdict
+import torch
+import torchio as tio
+from models.PadUNet3D import padUNet3D
+from losses import LossFn
+from eval import Eval
+from train import train3D, MixedPrecision
+from profiler import StepProfiler, STAGES
+from batch_augmentations import RandomFlip
+
+CONFIG = {'labels': {'BACKGROUND': 0, 'INSIDE': 1}}
+
+
+class ScalarWriter:
+    """
+    SummaryWriter keeping the scalars in memory
+    """
+
+    def __init__(self):
+        self.scalars = defaultdict(list)
+
+    def add_scalar(self, tag, value, step):
+        self.scalars[tag].append((step, value))
+
+
+def make_batches(count, batch_size, patch_shape):
+    """
+    batches as collated by the patch pipeline
+    """
+    batches = []
+    for n in range(count):
+        images = torch.rand((batch_size, 1, *patch_shape))
+        batches.append({
+            'data': {tio.DATA: images},
+            'label': {tio.DATA: (images > .7).to(torch.uint8)},
+            tio.LOCATION: torch.zeros((batch_size, 6), dtype=torch.long),
+            'weight': torch.ones(batch_size),
+            'folder': [f'P{n}_{b}' for b in range(batch_size)],
+        })
+    return batches
+
+
+def run(batches, profiler, device, epochs):
+    torch.manual_seed(0)
+    model = padUNet3D(n_classes=1, in_ch=1).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss_fn = LossFn({'name': 'Jaccard'}, CONFIG, weights=None)
+    evaluator = Eval(CONFIG, tempfile.gettempdir(), skip_dump=True)
+    writer = ScalarWriter()
+    start = time.perf_counter()
+    for epoch in range(epochs):
+        train3D(model, batches, loss_fn, optimizer, epoch, writer, evaluator, precision=MixedPrecision(device=device),
+                augment=RandomFlip(), profiler=profiler)
+    return writer, (time.perf_counter() - start) / epochs
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[32, 32, 32])
+    arg_parser.add_argument('--batch_size', type=int, default=2)
+    arg_parser.add_argument('--steps', type=int, default=6, help='steps of each epoch')
+    arg_parser.add_argument('--epochs', type=int, default=2)
+    arg_parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    torch.set_num_threads(1)
+    batches = make_batches(args.steps, args.batch_size, args.patch_shape)
+
+    _, disabled_time = run(batches, None, args.device, args.epochs)
+    writer, enabled_time = run(batches, StepProfiler(device=args.device), args.device, args.epochs)
+    for name in STAGES:
+        assert len(writer.scalars[f'Profile/{name}_ms']) == args.steps * args.epochs, f"missing scalars of {name}"
+    assert len(writer.scalars['Profile/epoch_patches_per_s']) == args.epochs
+    shares = sum(writer.scalars[f'Profile/epoch_{name}_share'][-1][1] for name in STAGES)
+    assert 0.5 < shares <= 1, f"stages cover {shares:.0%} of the epoch"
+
+    with tempfile.TemporaryDirectory() as folder:
+        trace_dir = os.path.join(folder, 'trace')
+        _, traced_time = run(batches, StepProfiler(device=args.device, trace_dir=trace_dir, trace_steps=2), args.device, 1)
+        traces = os.listdir(trace_dir)
+        assert traces, "torch.profiler trace was not saved"
+
+    print(f"epoch of {args.steps} steps, batch {args.batch_size}x{tuple(args.patch_shape)} on {args.device}: "
+          f"profiler disabled {disabled_time:.2f}s, enabled {enabled_time:.2f}s "
+          f"(overhead {enabled_time / disabled_time - 1:+.1%}), stages cover {shares:.1%} of the epoch, "
+          f"first epoch traced in {traced_time:.2f}s ({len(traces)} trace file)")
@@ -0,0 +1,67 @@
+"""
+speed of LabelIndexSampler against tio.LabelSampler and share of the patches which contain the canal.
+run it from the project root with: python -m benchmarks.sampler
+"""
+import time
+import argparse
+import numpy as np
+import torch
+import torchio as tio
+from loaders.samplers import LabelIndexSampler
+
+
+def make_subject(shape, folder):
+    """
+    a canal-like label map (a tube along the W axis) over a random volume
+    """
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center_z = shape[0] / 2 + shape[0] / 8 * np.sin(x / shape[2] * np.pi)
+    label = ((z - center_z) ** 2 + (y - shape[1] / 2) ** 2 < 16).astype(np.uint8)
+    return tio.Subject(
+        data=tio.ScalarImage(tensor=torch.rand((1, *shape))),
+        label=tio.LabelMap(tensor=torch.from_numpy(label[None])),
+        folder=folder,
+    )
+
+
+def sample(sampler, subjects, patches_per_subject):
+    """
+    Returns:
+        (float) seconds per patch
+        (float) share of the patches with foreground
+    """
+    start = time.perf_counter()
+    with_fg = total = 0
+    for subject in subjects:
+        for patch in sampler(subject, patches_per_subject):
+            with_fg += int(patch['label'][tio.DATA].any())
+            total += 1
+    return (time.perf_counter() - start) / total, with_fg / total
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[168, 280, 360], help='Z H W of the volumes')
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--patches', type=int, default=20, help='patches per subject')
+    arg_parser.add_argument('--epochs', type=int, default=2)
+    args = arg_parser.parse_args()
+
+    np.random.seed(0)
+    subjects = [make_subject(tuple(args.shape), f'P{n}') for n in range(2)]
+    probabilities = {0: 0.1, 1: 0.9}
+
+    label_sampler = tio.LabelSampler(args.patch_shape, 'label', label_probabilities=probabilities)
+    index_sampler = LabelIndexSampler(args.patch_shape, probabilities, background=0)
+    for name, sampler in [('tio.LabelSampler', label_sampler), ('LabelIndexSampler', index_sampler)]:
+        for epoch in range(args.epochs):
+            seconds, fg = sample(sampler, subjects, args.patches)
+            print(f"{name:>18} epoch {epoch}: {seconds * 1000:7.1f}ms per patch, {fg:.0%} patches with canal")
+
+    # flipped subjects reuse the cached index: patches drawn on the canal must still contain it
+    flipped = [tio.Flip(axes=(0, 2))(subject) for subject in subjects]
+    _, fg = sample(LabelIndexSampler(args.patch_shape, {1: 1.}), flipped, args.patches)
+    _, fg_cached = sample(index_sampler.__class__(args.patch_shape, {1: 1.}), subjects + flipped, args.patches)
+    assert fg == fg_cached == 1, "patches drawn on the canal without canal"
+    print("flipped subjects: all the foreground patches contain the canal")
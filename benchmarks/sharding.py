@@ -0,0 +1,133 @@
+"""
+balance of the training patches among the ranks: the old split of the subjects (subjects[rank::world_size]) against
+the split of PatchPipeline, with the rounds of ForegroundGridSampler as the patches of each subject.
+the split is also checked: every subject on one rank, the same split computed by all the ranks, equal steps,
+and a batch without gt skipped by one rank is skipped by all of them (gloo, cpu processes).
+run it from the project root with: python -m benchmarks.sharding
+"""
+import os
+import argparse
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torchio as tio
+from train import empty_batch
+from loaders.pipeline import PatchPipeline
+from loaders.samplers import ForegroundGridSampler
+
+
+def make_label_subject(shape, folder, rng):
+    """
+    a canal-like label map whose length along the W axis changes from subject to subject
+    """
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    center_z = shape[0] / 2 + shape[0] / 8 * np.sin(x / shape[2] * np.pi)
+    start, length = rng.randint(shape[2] // 2), rng.randint(shape[2] // 8, shape[2])
+    label = ((z - center_z) ** 2 + (y - shape[1] / 2) ** 2 < 16) & (x >= start) & (x < start + length)
+    return tio.Subject(
+        label=tio.LabelMap(tensor=torch.from_numpy(label[None].astype(np.uint8))),
+        folder=folder,
+    )
+
+
+def old_split(patches, world_size):
+    """
+    patches of each rank with the subjects split as subjects[rank::world_size]
+    """
+    return np.array([sum(patches[i] for i in range(rank, len(patches), world_size)) for rank in range(world_size)])
+
+
+def check(patches, world_size, batch_size, epochs):
+    """
+    Returns:
+        (numpy array) patches of each rank for each epoch, shape epochs, world_size
+        (list of int) batches of each rank, for each epoch
+    """
+    dataset = [None] * len(patches)
+    loads, batches = [], []
+    for epoch in range(epochs):
+        pipelines = [
+            PatchPipeline(dataset, None, patches, batch_size, (1, 1, 1), pin_memory=False, seed=47, rank=rank,
+                          world_size=world_size)
+            for rank in range(world_size)
+        ]
+        splits = [pipeline.assignment(epoch) for pipeline in pipelines]
+        subjects = sorted(i for workers, _, _ in splits for tasks in workers for i, _ in tasks)
+        assert subjects == list(range(len(patches))), "every subject must be on exactly one rank"
+        assert all(np.array_equal(split[2], splits[0][2]) for split in splits), "ranks computed different splits"
+        assert len({split[1] for split in splits}) == 1, "ranks run a different number of steps"
+        for split in splits:
+            assert split[1] * batch_size <= sum(n for tasks in split[0] for _, n in tasks)
+        loads.append(splits[0][2])
+        batches.append(splits[0][1])
+    return np.array(loads), batches
+
+
+def iterate(world_size, batch_size):
+    """
+    real patches from two ranks of small subjects: the batches of each rank are read until the end of the epoch
+    """
+    rng = np.random.RandomState(1)
+    subjects = [make_label_subject((32, 48, 64), f'P{n}', rng) for n in range(6)]
+    for subject in subjects:
+        subject['data'] = tio.ScalarImage(tensor=torch.rand((1, 32, 48, 64)))
+    sampler = ForegroundGridSampler((16, 16, 16), background_ratio=0.1)
+    patches = [sampler.round_size(s) for s in subjects]
+    folders = []
+    for rank in range(world_size):
+        pipeline = PatchPipeline(tio.SubjectsDataset(subjects), sampler, patches, batch_size, (16, 16, 16),
+                                 pin_memory=False, rank=rank, world_size=world_size)
+        batches = list(pipeline)
+        assert len(batches) == len(pipeline)
+        folders.append({folder for batch in batches for folder in batch['folder']})
+    assert not set.intersection(*folders), "a subject was sampled by more ranks"
+    return [len(f) for f in folders]
+
+
+def skip_together(rank, world_size, results):
+    """
+    steps of train3D where the batch of the last rank has no gt: every rank has to skip them
+    """
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = '29518'
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    steps = [torch.tensor([3, 0]), torch.tensor([0, 0]) if rank == world_size - 1 else torch.tensor([5, 1])]
+    results[rank] = [empty_batch(gt_count) for gt_count in steps]
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[168, 280, 360], help='Z H W of the volumes')
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[80, 80, 80])
+    arg_parser.add_argument('--subjects', type=int, default=30)
+    arg_parser.add_argument('--world_size', type=int, nargs='+', default=[2, 4, 8])
+    arg_parser.add_argument('--batch_size', type=int, default=3, help='patches of each rank')
+    arg_parser.add_argument('--epochs', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    sampler = ForegroundGridSampler(args.patch_shape, background_ratio=0.1, margin=8)
+    patches = [sampler.round_size(make_label_subject(tuple(args.shape), f'P{n}', rng)) for n in range(args.subjects)]
+    print(f"patches of the subjects: min {min(patches)}, max {max(patches)}, total {sum(patches)}")
+
+    for world_size in args.world_size:
+        old = old_split(patches, world_size)
+        # DDP needs the same steps on all the ranks: the ranks with more patches wait or drop them
+        old_dropped = 1 - old.min() // args.batch_size * args.batch_size * world_size / sum(patches)
+        loads, batches = check(patches, world_size, args.batch_size, args.epochs)
+        dropped = 1 - min(batches) * args.batch_size * world_size / sum(patches)
+        print(
+            f"{world_size} ranks | subjects[rank::{world_size}]: {old.max() / old.mean():.3f} max/mean, "
+            f"{old_dropped:.1%} patches dropped | balanced: {(loads.max(1) / loads.mean(1)).max():.3f} max/mean "
+            f"(worst of {args.epochs} epochs), {dropped:.1%} patches dropped (worst)"
+        )
+
+    print(f"2 ranks iterated, subjects of each rank: {iterate(2, 4)}")
+
+    results = mp.Manager().dict()
+    mp.spawn(skip_together, args=(2, results), nprocs=2)
+    assert all(results[rank] == [False, True] for rank in range(2)), f"ranks skipped different steps: {dict(results)}"
+    print("2 ranks: a batch without gt on one rank is skipped by both")
@@ -0,0 +1,58 @@
+"""
+parity and speed of the single channel input path against the RGB replicated volumes.
+run it from the project root with: python -m benchmarks.single_channel
+"""
+import time
+import argparse
+import torch
+from models.PadUNet3D import padUNet3D, PositionalpadUNet3D
+from models.transUnet import TransUNet3D
+from utils import fold_input_channels
+
+
+def build(name, in_ch, patch_shape):
+    emb_shape = [dim // 8 for dim in patch_shape]
+    if name == 'PadUNet3D':
+        return padUNet3D(n_classes=2, in_ch=in_ch)
+    if name == 'PosPadUNet3D':
+        return PositionalpadUNet3D(n_classes=2, emb_shape=emb_shape, in_ch=in_ch)
+    return TransUNet3D(n_classes=2, emb_shape=emb_shape, in_ch=in_ch)
+
+
+def timeit(model, images, emb_codes, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        model(images, emb_codes)
+    if images.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[32, 32, 32], help='Z H W of the patches')
+    arg_parser.add_argument('--batch_size', type=int, default=2)
+    arg_parser.add_argument('--repeat', type=int, default=3, help='forward passes for the timing')
+    args = arg_parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(47)
+    images = torch.rand(args.batch_size, 1, *args.patch_shape, device=device)
+    emb_codes = torch.rand(args.batch_size, 6, device=device)
+
+    for name in ['PadUNet3D', 'PosPadUNet3D', 'transUNet3D']:
+        rgb = build(name, 3, args.patch_shape).to(device).eval()
+        single = build(name, 1, args.patch_shape).to(device).eval()
+        state_dict, folded = fold_input_channels(rgb.state_dict(), single)
+        single.load_state_dict(state_dict)
+
+        with torch.no_grad():
+            ref = rgb(images.repeat(1, 3, 1, 1, 1), emb_codes)  # old pipeline, replicated input
+            res = single(images, emb_codes)
+            assert torch.allclose(ref, res, atol=1e-4), f"{name}: single channel output is not matching the RGB one"
+            rgb_time = timeit(rgb, images, emb_codes, args.repeat)
+            single_time = timeit(single, images, emb_codes, args.repeat)
+
+        print(f"{name:<14} folded: {folded} max abs diff: {(ref - res).abs().max():.2e} "
+              f"rgb: {rgb_time:.3f}s single: {single_time:.3f}s input bytes: {images.numel() * 4} vs {images.numel() * 12}")
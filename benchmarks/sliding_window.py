@@ -0,0 +1,57 @@
+"""
+sliding window inference: parity with the torchio grid sampler and throughput for several overlaps.
+run it from the project root with: python -m benchmarks.sliding_window
+"""
+import argparse
+import torch
+import torchio as tio
+from models.PadUNet3D import padUNet3D
+from inference import SlidingWindow
+
+
+def torchio_grid(model, volume, patch_shape, batch_size):
+    """
+    reference implementation: tio.GridSampler without overlap + GridAggregator('average')
+    """
+    subject = tio.Subject(data=tio.ScalarImage(tensor=volume))
+    sampler = tio.GridSampler(subject, patch_size=patch_shape, patch_overlap=0)
+    aggr = tio.inference.GridAggregator(sampler, overlap_mode='average')
+    device = next(model.parameters()).device
+    with torch.no_grad():
+        for subvolume in torch.utils.data.DataLoader(sampler, batch_size):
+            images = subvolume['data'][tio.DATA].float().to(device)
+            output = model(images, subvolume[tio.LOCATION].float().to(device))
+            aggr.add_batch(output, subvolume[tio.LOCATION])
+    return aggr.get_output_tensor()
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[40, 72, 72], help='Z H W of the synthetic volume')
+    arg_parser.add_argument('--patch_shape', type=int, nargs=3, default=[32, 32, 32])
+    arg_parser.add_argument('--overlaps', type=int, nargs='+', default=[0, 8, 16])
+    arg_parser.add_argument('--batch_size', type=int, default=4)
+    arg_parser.add_argument('--amp', action='store_true', help='autocast the forward passes')
+    args = arg_parser.parse_args()
+
+    torch.manual_seed(47)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = padUNet3D(n_classes=2, in_ch=1).to(device).eval()
+    volume = torch.rand(1, *args.shape)
+
+    ref = torchio_grid(model, volume, args.patch_shape, args.batch_size)
+    res = SlidingWindow(args.patch_shape, overlap=0, batch_size=args.batch_size, device=device)(model, volume)
+    assert torch.allclose(ref, res, atol=1e-5), "sliding window is not matching the torchio grid aggregator"
+    print(f"overlap 0 constant blending matches torchio, max abs diff: {(ref - res).abs().max():.2e}")
+
+    for overlap in args.overlaps:
+        for blending in ['constant', 'gaussian']:
+            for buffer_dtype in ['float32', 'float16']:
+                engine = SlidingWindow(
+                    args.patch_shape, overlap=overlap, batch_size=args.batch_size, blending=blending,
+                    buffer_dtype=buffer_dtype, amp=args.amp, device=device
+                )
+                engine(model, volume)
+                print(f"overlap {overlap:>3} {blending:<8} {buffer_dtype}: {engine.patches / engine.seconds:7.1f} patches/s, "
+                      f"{engine.seconds:.2f}s per volume ({engine.patches} patches)")
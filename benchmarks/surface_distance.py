@@ -0,0 +1,84 @@
+"""
+hausdorff distances of Eval.hausdorf (distance transforms, volumes cut to each region) against
+skimage.metrics.hausdorff_distance on every region: they must be the same, inf included.
+hd95 and assd of the surfaces are printed, they have no skimage reference.
+run it from the project root with: python -m benchmarks.surface_distance
+"""
+import time
+import argparse
+import numpy as np
+from scipy.ndimage import binary_dilation
+from skimage import metrics
+from surface_distance import SurfaceDistances
+
+
+def synthetic_canal(shape, radius, shift, seed=47):
+    """
+    tube along the H axis following a smooth random curve, a rough model of the alveolar canal
+    """
+    rng = np.random.default_rng(seed)
+    Z, H, W = shape
+    zz, xx = np.mgrid[:Z, :W]
+    volume = np.zeros(shape, bool)
+    centers_z = Z / 2 + np.cumsum(rng.normal(0, .3, H)) + shift
+    centers_x = W / 4 + np.cumsum(rng.normal(0, .3, H)) + shift
+    for y in range(H):
+        volume[:, y] = (zz - centers_z[y]) ** 2 + (xx - centers_x[y]) ** 2 < radius ** 2
+    return volume
+
+
+def skimage_regions(pred, gt, splits, half, spacing):
+    """
+    reference implementation: the old Eval.hausdorf in the Final phase
+    """
+    res = []
+    for i in range(len(splits) - 1):
+        res.append(metrics.hausdorff_distance(gt[:, splits[i]:splits[i + 1], :half], pred[:, splits[i]:splits[i + 1], :half]) * spacing)
+        res.append(metrics.hausdorff_distance(gt[:, splits[i]:splits[i + 1], half:], pred[:, splits[i]:splits[i + 1], half:]) * spacing)
+    res.append(metrics.hausdorff_distance(gt[..., half:], pred[..., half:]) * spacing)
+    res.append(metrics.hausdorff_distance(gt[..., :half], pred[..., :half]) * spacing)
+    return res, metrics.hausdorff_distance(gt, pred) * spacing
+
+
+def surface_regions(pred, gt, splits, half, spacing):
+    """
+    the new Eval.hausdorf in the Final phase
+    """
+    def haus(region=np.s_[...]):
+        return SurfaceDistances(pred[region], gt[region], spacing=spacing, surfaces=False).hausdorff()
+
+    res = []
+    for i in range(len(splits) - 1):
+        res.append(haus(np.s_[:, splits[i]:splits[i + 1], :half]))
+        res.append(haus(np.s_[:, splits[i]:splits[i + 1], half:]))
+    res.append(haus(np.s_[..., half:]))
+    res.append(haus(np.s_[..., :half]))
+    dist = SurfaceDistances(pred, gt, spacing=spacing)
+    return res, haus(), dist.hd95(), dist.assd()
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[152, 224, 256], help='Z H W of the synthetic volumes')
+    arg_parser.add_argument('--spacing', type=float, default=0.3)
+    args = arg_parser.parse_args()
+
+    gt = synthetic_canal(args.shape, radius=6, shift=0)
+    pred = binary_dilation(synthetic_canal(args.shape, radius=5, shift=2), iterations=1)
+    splits = np.linspace(0, args.shape[1], 6).astype(int)
+    half = args.shape[2] // 2
+
+    start = time.perf_counter()
+    ref_regions, ref = skimage_regions(pred, gt, splits, half, args.spacing)
+    skimage_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    regions, hd, hd95, assd = surface_regions(pred, gt, splits, half, args.spacing)
+    surface_time = time.perf_counter() - start
+
+    assert np.allclose(ref_regions, regions) and np.isclose(ref, hd), "hausdorff differs from skimage"
+    print(f"hausdorff skimage {ref:.3f} surface {hd:.3f}, hd95 {hd95:.3f}, assd {assd:.3f}")
+    print(f"regions skimage {np.round(ref_regions, 2)}")
+    print(f"regions surface {np.round(regions, 2)}")
+    print(f"skimage {skimage_time:.2f}s, surface distances {surface_time:.2f}s, speedup {skimage_time / surface_time:.1f}x")
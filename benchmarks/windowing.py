@@ -0,0 +1,59 @@
+"""
+peak memory and time of the HU rescale + windowing of Jaw, old full-volume pipeline against processing.hu_windowing.
+run it from the project root with: python -m benchmarks.windowing [--shape Z H W]
+"""
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import processing
+
+
+def legacy_windowing(raw_volume, slope, intercept, c, w):
+    """
+    reference implementation: the pipeline Jaw.__init__ used before hu_windowing
+    """
+    ymax = c + (w / 2)
+    ymin = c - (w / 2)
+    tmp = raw_volume * slope + intercept
+    volume = tmp.copy()
+    volume = ((volume - (c - .5)) / (w - 1) + .5) * (ymax - ymin) + ymin
+    volume[tmp < (c - .5 - (w - 1) / 2)] = ymin
+    volume[tmp > (c - .5 + (w - 1) / 2)] = ymax
+    return volume
+
+
+def profile(fn, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    res = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, elapsed, peak
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--shape', type=int, nargs=3, default=[576, 512, 512], help='Z H W of the synthetic volume')
+    args = arg_parser.parse_args()
+
+    raw = np.random.default_rng(47).integers(0, 4096, size=args.shape, dtype=np.int16)
+    slope, intercept, c, w = 1, -1000, 1000, 4000
+    raw_mb = raw.nbytes / 2 ** 20
+    print(f"raw volume {args.shape}, {raw.dtype}, {raw_mb:.0f} MB")
+
+    new, new_time, new_peak = profile(processing.hu_windowing, raw, slope, intercept, c, w)
+    print(f"hu_windowing float32: {new_time:6.2f}s, peak {new_peak / 2 ** 20:7.0f} MB ({new_peak / 2 ** 20 / raw_mb:.1f}x raw)")
+    _, int_time, int_peak = profile(processing.hu_windowing, raw, slope, intercept, c, w, dtype=np.int16)
+    print(f"hu_windowing int16:   {int_time:6.2f}s, peak {int_peak / 2 ** 20:7.0f} MB ({int_peak / 2 ** 20 / raw_mb:.1f}x raw)")
+    old, old_time, old_peak = profile(legacy_windowing, raw, slope, intercept, c, w)
+    print(f"legacy float64:       {old_time:6.2f}s, peak {old_peak / 2 ** 20:7.0f} MB ({old_peak / 2 ** 20 / raw_mb:.1f}x raw)")
+
+    assert np.allclose(old, new, atol=1e-2), "windowed volumes are not matching"
+    print(f"max abs difference float32: {np.max(np.abs(old - new)):.2e}")
+    # float64 is what utils.data_from_dicom saves, data.npy has to stay as before
+    wide = processing.hu_windowing(raw, slope, intercept, c, w, dtype=np.float64)
+    assert wide.dtype == old.dtype and np.allclose(old, wide, rtol=0, atol=1e-9), "float64 volume is not matching"
+    print(f"max abs difference float64: {np.max(np.abs(old - wide)):.2e}")
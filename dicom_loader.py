@@ -1,12 +1,25 @@
 import pydicom
 from pydicom.filereader import read_dicomdir
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
 import re
 import os
 import numpy as np
 
+DICOM_WORKERS = 8  # default number of threads decoding the slices in parallel
 
-def dicom_from_dicomdir(dicom_dir):
 
+def series_from_dicomdir(dicom_dir):
+    """
+    look for the series with the CBCT volume inside the dicomdir
+    Args:
+        dicom_dir (pydicom.dicomdir.DicomDir): dicomdir object
+
+    Returns:
+        (str) abs path of the dicomdir folder
+        (list of str) filenames of the slices, relative to the dicomdir folder
+    """
     dataset_path = os.path.dirname(os.path.abspath(dicom_dir.filename))  # abs path without the final dicomdir
     for patient_record in dicom_dir.patient_records:
         studies = patient_record.children
@@ -19,9 +32,65 @@ def dicom_from_dicomdir(dicom_dir):
                     image_filenames = [
                         image_rec.ReferencedFileID for image_rec in image_records
                     ]
-                    datasets = [pydicom.dcmread(os.path.join(dataset_path, basename)) for basename in image_filenames]
-                    # raw data stacked together
-                    volume = np.stack([images.pixel_array for images in datasets])
-                    return image_filenames, datasets, volume
+                    return dataset_path, image_filenames
             raise Exception('No valid series found, abort!')
-    raise Exception('no valid patient or study found in the path, abort!')
\ No newline at end of file
+    raise Exception('no valid patient or study found in the path, abort!')
+
+
+def dicom_from_dicomdir(dicom_dir):
+
+    dataset_path, image_filenames = series_from_dicomdir(dicom_dir)
+    datasets = [pydicom.dcmread(os.path.join(dataset_path, basename)) for basename in image_filenames]
+    # raw data stacked together
+    volume = np.stack([images.pixel_array for images in datasets])
+    return image_filenames, datasets, volume
+
+
+def parallel_dicom_from_dicomdir(dicom_dir, num_workers=DICOM_WORKERS, release_pixel_data=False):
+    """
+    load the CBCT series of a dicomdir with a pool of threads.
+    headers are read first (without pixel data) to sort the slices along the z axis and to preallocate the volume,
+    then each thread decodes its slices straight into the volume.
+
+    Args:
+        dicom_dir (pydicom.dicomdir.DicomDir): dicomdir object
+        num_workers (int): number of decoding threads
+        release_pixel_data (bool): if true the returned datasets are just the headers of the slices (overlays included)
+            and the raw pixel data is dropped after decoding. datasets can not be saved back to disk in this case.
+
+    Returns:
+        (list of str) filenames of the slices, sorted as the volume
+        (list of pydicom.dataset.FileDataset) datasets of the slices, sorted as the volume
+        (numpy array) raw volume with shape Z, H, W
+    """
+    start_time = time.time()
+    dataset_path, image_filenames = series_from_dicomdir(dicom_dir)
+    paths = [os.path.join(dataset_path, basename) for basename in image_filenames]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        headers = list(pool.map(lambda p: pydicom.dcmread(p, stop_before_pixels=True), paths))
+
+        order = np.argsort([float(h.ImagePositionPatient[-1]) for h in headers], kind='stable')
+        image_filenames = [image_filenames[i] for i in order]
+        paths = [paths[i] for i in order]
+        datasets = [headers[i] for i in order]
+
+        first = datasets[0]
+        dtype = f"{'int' if first.PixelRepresentation == 1 else 'uint'}{first.BitsAllocated}"  # same dtype of pixel_array
+        volume = np.empty((len(paths), first.Rows, first.Columns), dtype=dtype)
+
+        def decode(slice_num):
+            ds = pydicom.dcmread(paths[slice_num])
+            volume[slice_num] = ds.pixel_array
+            if not release_pixel_data:
+                # drop the decoded copy cached by pydicom, the volume keeps the data. the cache id is reset as well,
+                # so pixel_array decodes the slice again instead of returning the empty cache
+                del ds._pixel_array
+                ds._pixel_id = {}
+                datasets[slice_num] = ds
+
+        list(pool.map(decode, range(len(paths))))
+
+    elapsed = time.time() - start_time
+    logging.info(f"loaded {len(paths)} slices in {elapsed:.2f}s ({len(paths) / elapsed:.1f} slices/s) from {dataset_path}")
+    return image_filenames, datasets, volume
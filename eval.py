@@ -2,28 +2,165 @@ from statistics import mean
 import torch
 import pathlib
 import numpy as np
-from skimage import metrics
+import io
+import time
+import queue
+import logging
+import threading
+from surface_distance import SurfaceDistances
 import os
 import pandas as pd
 import zipfile
+import torch.distributed as dist
+
+METRICS = ['iou', 'dice', 'precision', 'recall', 'volume_similarity']
+
+
+def confusion_matrix(pred, gt, num_classes):
+    """
+    confusion matrix of a prediction in a single pass (one bincount over gt * C + pred).
+    numpy arrays and torch tensors (on any device) are supported.
+    Args:
+        pred (numpy array or torch.Tensor): predicted labels
+        gt (numpy array or torch.Tensor): ground truth labels, same shape of pred
+        num_classes (int): number of classes C, labels must be in [0, C)
+
+    Returns:
+        (numpy array) int64 matrix with shape C, C: rows are gt labels, columns predicted labels
+    """
+    if torch.is_tensor(pred):
+        gt = torch.as_tensor(gt, device=pred.device)
+        flat = gt.reshape(-1).long() * num_classes + pred.reshape(-1).long()
+        return torch.bincount(flat, minlength=num_classes ** 2).reshape(num_classes, num_classes).cpu().numpy()
+    flat = gt.reshape(-1).astype(np.int64) * num_classes + pred.reshape(-1).astype(np.int64)
+    return np.bincount(flat, minlength=num_classes ** 2).reshape(num_classes, num_classes)
+
+
+def class_scores(cm, labels, eps=1e-06):
+    """
+    overlap metrics for each class from a confusion matrix
+    Args:
+        cm (numpy array): confusion matrix with shape C, C, see confusion_matrix
+        labels (list of int): classes to be scored
+        eps (float): smoothing term, empty classes in both pred and gt score 1
+
+    Returns:
+        (dict) metric name -> numpy array with a score for each label, see METRICS
+    """
+    labels = np.asarray(labels)
+    tp = np.diag(cm)[labels].astype(np.float64)
+    fp = cm[:, labels].sum(axis=0) - tp
+    fn = cm[labels, :].sum(axis=1) - tp
+    return {
+        'iou': (tp + eps) / (tp + fp + fn + eps),
+        'dice': (2 * tp + eps) / (2 * tp + fp + fn + eps),
+        'precision': (tp + eps) / (tp + fp + eps),
+        'recall': (tp + eps) / (tp + fn + eps),
+        'volume_similarity': 1 - np.abs(fn - fp) / (2 * tp + fp + fn + eps),
+    }
+
+
+class ArchiveWriter:
+    """
+    writes arrays as npy entries of a zip archive from a background thread.
+    compression and disk writes overlap with the caller, which is blocked only when max_pending volumes are waiting.
+    the archive unzips to <name>/<key>.npy, as the old numpy folder of the experiments.
+    """
+
+    def __init__(self, path, max_pending=2, compresslevel=6):
+        """
+        Args:
+            path (str): path of the zip archive, overwritten if it exists
+            max_pending (int): max number of entries waiting to be written
+            compresslevel (int): deflate level, from 0 (fast) to 9 (small)
+        """
+        self.path = path
+        self.zipf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.raw_bytes = 0
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def write(self, name, **arrays):
+        """
+        Args:
+            name (str): folder of the arrays inside the archive
+            **arrays (numpy arrays): arrays to be saved, the name of the argument is the name of the file
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((name, arrays))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.zipf.close()
+        if self.error is not None:
+            raise self.error
+        logging.info(
+            f"archive {self.path}: {self.raw_bytes / 2 ** 20:.1f}MB of arrays stored in "
+            f"{os.path.getsize(self.path) / 2 ** 20:.1f}MB, {time.time() - self.start_time:.1f}s"
+        )
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # draining the queue, the error is raised by the caller
+            name, arrays = item
+            try:
+                for key, array in arrays.items():
+                    buffer = io.BytesIO()
+                    np.save(buffer, array)
+                    self.raw_bytes += buffer.tell()
+                    self.zipf.writestr(f'{name}/{key}.npy', buffer.getbuffer())
+            except Exception as e:
+                self.error = e
+
 
 class Eval:
-    def __init__(self, loader_config, project_dir, skip_dump=False):
+    def __init__(self, loader_config, project_dir, skip_dump=False, rank=0, world_size=1):
+        """
+        Args:
+            loader_config (dict): data-loader section of the config
+            project_dir (str): folder of results.xlsx and numpy.zip
+            skip_dump (bool): do not store the volumes of the final test
+            rank (int): rank of this process, the results of the final test are written by rank 0
+            world_size (int): ranks sharing the test subjects, see gather
+        """
         self.iou_list = []
         self.dice_list = []
+        self.precision_list = []
+        self.recall_list = []
+        self.vs_list = []
+        self.hd95_list = []
+        self.assd_list = []
         self.config = loader_config
         self.project_dir = project_dir
         self.eps = 1e-06
         self.classes = loader_config['labels']
+        self.num_classes = max(self.classes.values()) + 1
         self.hausdord_splits = 6
         self.hausdord_verbose = []
         self.hausdorf_list = []
         self.test_ids = []
         self.skip_dump = skip_dump
+        self.rank = rank
+        self.world_size = world_size
+        self.writer = None
 
     def reset_eval(self):
         self.iou_list.clear()
         self.dice_list.clear()
+        self.precision_list.clear()
+        self.recall_list.clear()
+        self.vs_list.clear()
+        self.hd95_list.clear()
+        self.assd_list.clear()
         self.hausdord_verbose = []
         self.hausdorf_list.clear()
         self.test_ids.clear()
@@ -35,8 +172,12 @@ class Eval:
         iou = 0 if len(self.iou_list) == 0 else mean(self.iou_list)
         dice = 0 if len(self.dice_list) == 0 else mean(self.dice_list)
         haus = 0 if len(self.hausdorf_list) == 0 else max(self.hausdorf_list)
+        inf_count = int(np.isinf(self.hausdorf_list).sum()) if len(self.hausdorf_list) > 0 else 0
+        if inf_count > 0:
+            logging.info(f"{phase}: hausdorff is inf for {inf_count}/{len(self.hausdorf_list)} subjects "
+                         f"(empty prediction or ground truth)")
 
-        if phase == "Final":
+        if phase == "Final" and self.rank == 0:
             excl_dest = os.path.join(self.project_dir, 'logs', 'results.xlsx')
             cols = [f"s{n}" for n in range(self.hausdord_splits - 1)] + ["L entire"] + [f"s{n}" for n in range(self.hausdord_splits - 1)] + ["R entire"]
             df = pd.DataFrame(np.stack(self.hausdord_verbose), columns=cols)
@@ -48,12 +189,35 @@ class Eval:
             df['haus tot'] = np.round(self.hausdorf_list, 2)
             df['IoU'] = np.round(self.iou_list, 2)
             df['dice'] = np.round(self.dice_list, 2)
+            df['precision'] = np.round(self.precision_list, 2)
+            df['recall'] = np.round(self.recall_list, 2)
+            df['volume similarity'] = np.round(self.vs_list, 2)
+            df['hd95'] = np.round(self.hd95_list, 2)
+            df['assd'] = np.round(self.assd_list, 2)
             df.to_excel(excl_dest, index=False)
+        if phase == "Final":
             self.save_zip()  # zip volumes with predictions
 
         self.reset_eval()
         return iou, dice, haus
 
+    def gather(self):
+        """
+        collect the metrics of the subjects evaluated by all the ranks, every rank has to call it.
+        rank r evaluates subjects[r::world_size], so the lists are interleaved back in the order of the subjects,
+        mean_metric gives then the same results on all the ranks and of a single process.
+        """
+        if self.world_size == 1:
+            return
+        lists = ['iou_list', 'dice_list', 'precision_list', 'recall_list', 'vs_list', 'hd95_list', 'assd_list',
+                 'hausdorf_list', 'hausdord_verbose', 'test_ids']
+        gathered = [None] * self.world_size
+        dist.all_gather_object(gathered, {name: list(getattr(self, name)) for name in lists})
+        for name in lists:
+            shards = [metrics[name] for metrics in gathered]
+            merged = [shard[i] for i in range(max(len(s) for s in shards)) for shard in shards if i < len(shard)]
+            setattr(self, name, merged)
+
     def compute_metrics(self, pred, gt, images, names, phase):
         if phase not in ["Train", "Validation", "Test", "Final"]:
             raise Exception(f"this phase is not valid {phase}")
@@ -69,13 +233,28 @@ class Eval:
         self.test_ids += names
 
         for batch_id in range(pred.shape[0]):
-            self.iou_list.append(self.iou(pred[batch_id], gt[batch_id], labels))
-            self.dice_list.append(self.dice_coefficient(pred[batch_id], gt[batch_id], labels))
-            self.hausdorf_list.append(self.hausdorf(pred[batch_id], gt[batch_id], phase))
+            # tensors are scored on their device, hausdorf and dumps need numpy arrays
+            scores = class_scores(confusion_matrix(pred[batch_id], gt[batch_id], self.num_classes), labels, self.eps)
+            self.iou_list.append(scores['iou'].mean())
+            self.dice_list.append(scores['dice'].mean())
+            self.precision_list.append(scores['precision'].mean())
+            self.recall_list.append(scores['recall'].mean())
+            self.vs_list.append(scores['volume_similarity'].mean())
+            pred_np, gt_np = [v[batch_id].cpu().numpy() if torch.is_tensor(v) else v[batch_id] for v in (pred, gt)]
+            self.hausdorf_list.append(self.hausdorf(pred_np, gt_np, phase, name=names[batch_id]))
             if phase == 'Final' and not self.skip_dump:
-                self.dump(gt[batch_id], pred[batch_id], images[batch_id], names[batch_id])
+                self.dump(gt_np, pred_np, images[batch_id], names[batch_id])
 
-    def hausdorf(self, pred, gt, phase, pixel_spacing=0.3):
+    def hausdorf(self, pred, gt, phase, pixel_spacing=0.3, name=''):
+        """
+        hausdorff distance between the foreground voxels of prediction and ground truth (as
+        skimage.metrics.hausdorff_distance), in the Final phase also of each block, with the volumes cut to the block.
+        distances come from distance transforms (see SurfaceDistances), hd95 and assd are measured between the
+        surfaces and stored in their lists. a distance is inf if just one of the volumes is empty (in its block).
+        pixel_spacing can be a tuple for anisotropic volumes.
+        """
+        def haus(region=np.s_[...]):
+            return SurfaceDistances(pred[region], gt[region], spacing=pixel_spacing, surfaces=False).hausdorff()
 
         if phase == "Final":
             left = []
@@ -86,21 +265,24 @@ class Eval:
             half = gt.shape[2] // 2
 
             for i in range(len(splits) - 1):
-                left.append(metrics.hausdorff_distance(
-                    gt[:, splits[i]:splits[i + 1], :half],
-                    pred[:, splits[i]:splits[i + 1], :half]
-                ) * pixel_spacing)
-
-                right.append(metrics.hausdorff_distance(
-                    gt[:, splits[i]:splits[i + 1], half:],
-                    pred[:, splits[i]:splits[i + 1], half:]
-                ) * pixel_spacing)
+                left.append(haus(np.s_[:, splits[i]:splits[i + 1], :half]))
+                right.append(haus(np.s_[:, splits[i]:splits[i + 1], half:]))
 
-            right.append(metrics.hausdorff_distance(gt[..., half:], pred[..., half:]) * pixel_spacing)
-            left.append(metrics.hausdorff_distance(gt[..., :half], pred[..., :half]) * pixel_spacing)
-            self.hausdord_verbose.append(np.round(np.concatenate((left, right)).astype(float), 2))
+            right.append(haus(np.s_[..., half:]))
+            left.append(haus(np.s_[..., :half]))
+            regions = np.concatenate((left, right)).astype(float)
+            if np.isinf(regions).any():
+                logging.info(f"hausdorff of {name}: {np.isinf(regions).sum()}/{len(regions)} regions are inf "
+                             f"(empty prediction or ground truth), written as -1 in results.xlsx")
+            self.hausdord_verbose.append(np.round(regions, 2))
 
-        return metrics.hausdorff_distance(gt, pred) * pixel_spacing
+        dist = SurfaceDistances(pred, gt, spacing=pixel_spacing)
+        self.hd95_list.append(dist.hd95())
+        self.assd_list.append(dist.assd())
+        hausdorff = haus()
+        if np.isinf(hausdorff):
+            logging.info(f"hausdorff of {name} is inf: empty prediction or ground truth")
+        return hausdorff
 
     def iou(self, pred, gt, labels):
         """
@@ -108,35 +290,32 @@ class Eval:
         :param gt: SHAPE MUST BE (Z, H W) or (BS, Z, H, W)
         :return:
         """
-        c_score = []
-        for c in labels:
-            gt_class_idx = np.argwhere(gt.flatten() == c)
-            intersection = np.sum(pred.flatten()[gt_class_idx] == c)
-            union = np.argwhere(gt.flatten() == c).size + np.argwhere(pred.flatten() == c).size - intersection
-            c_score.append((intersection + self.eps) / (union + self.eps))
-        return sum(c_score) / len(labels)
+        return class_scores(confusion_matrix(pred, gt, self.num_classes), labels, self.eps)['iou'].mean()
 
     def dice_coefficient(self, pred, gt, labels):
-        c_score = []
-        for c in labels:
-            gt_class_idx = np.argwhere(gt.flatten() == c)
-            intersection = np.sum(pred.flatten()[gt_class_idx] == c)
-            dice_union = np.argwhere(gt.flatten() == c).size + np.argwhere(pred.flatten() == c).size
-            c_score.append((2 * intersection + self.eps) / (dice_union + self.eps))
-        return sum(c_score) / len(labels)
+        return class_scores(confusion_matrix(pred, gt, self.num_classes), labels, self.eps)['dice'].mean()
 
     def dump(self, gt_volume, prediction, images, patient_name):
-        save_dir = os.path.join(self.project_dir, 'numpy', f'{patient_name}')
-        pathlib.Path(save_dir).mkdir(parents=True, exist_ok=True)
-        np.save(os.path.join(save_dir, 'gt.npy'), gt_volume)
-        np.save(os.path.join(save_dir, 'pred.npy'), prediction)
-        np.save(os.path.join(save_dir, 'input.npy'), images)
+        """
+        queue the volumes of a patient for numpy.zip, labels are stored as uint8 and the input as float32.
+        the other ranks write their patients in numpy_rank<rank>.zip
+        """
+        if self.writer is None:
+            pathlib.Path(self.project_dir).mkdir(parents=True, exist_ok=True)
+            name = 'numpy.zip' if self.rank == 0 else f'numpy_rank{self.rank}.zip'
+            self.writer = ArchiveWriter(os.path.join(self.project_dir, name))
+        self.writer.write(
+            f'numpy/{patient_name}',
+            gt=gt_volume.astype(np.uint8),
+            pred=prediction.astype(np.uint8),
+            input=images.astype(np.float32, copy=False),
+        )
 
     def save_zip(self):
-        zipf = zipfile.ZipFile(os.path.join(self.project_dir, 'numpy.zip'), 'w', zipfile.ZIP_DEFLATED)
-        for root, dirs, files in os.walk(os.path.join(self.project_dir, 'numpy')):
-            for file in files:
-                zipf.write(os.path.join(root, file),
-                           os.path.relpath(os.path.join(root, file),
-                                           os.path.join(os.path.join(self.project_dir))))
-        zipf.close()
\ No newline at end of file
+        """
+        wait for the pending dumps and close numpy.zip
+        """
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
\ No newline at end of file
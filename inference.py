@@ -0,0 +1,157 @@
+import time
+import logging
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+BUFFER_DTYPES = {'float16': torch.float16, 'float32': torch.float32}
+
+
+def patch_locations(shape, patch_shape, overlap):
+    """
+    start and end of the patches covering a volume, same grid of tio.GridSampler.
+    the last patch of each axis is shifted back to end with the volume.
+    Args:
+        shape (tuple): Z, H, W of the volume, each dim must be >= than the patch dim
+        patch_shape (tuple): Z, H, W of the patches
+        overlap (tuple): overlap between neighbour patches for each axis
+
+    Returns:
+        (numpy array) locations with shape N, 6: z_ini, y_ini, x_ini, z_fin, y_fin, x_fin
+    """
+    indices = []
+    for dim, patch_dim, overlap_dim in zip(shape, patch_shape, overlap):
+        indices_dim = list(range(0, dim + 1 - patch_dim, patch_dim - overlap_dim))
+        if indices_dim[-1] != dim - patch_dim:
+            indices_dim.append(dim - patch_dim)
+        indices.append(indices_dim)
+    indices_ini = np.array(np.meshgrid(*indices, indexing='ij')).reshape(3, -1).T
+    return np.hstack((indices_ini, indices_ini + np.array(patch_shape)))
+
+
+def gaussian_importance(patch_shape, sigma_scale=1. / 8, min_weight=1e-3):
+    """
+    importance map of the patches: voxels close to the center of a patch have more context and weight more
+    when overlapping predictions are blended.
+    Args:
+        patch_shape (tuple): Z, H, W of the patches
+        sigma_scale (float): sigma of the gaussian for each axis as fraction of the patch dim
+        min_weight (float): lower bound of the map (as fraction of the peak), borders never weight zero
+
+    Returns:
+        (torch.Tensor) map with shape Z, H, W and max value 1
+    """
+    axes = []
+    for dim in patch_shape:
+        coords = torch.arange(dim, dtype=torch.float64) - (dim - 1) / 2
+        axes.append(torch.exp(-.5 * (coords / (dim * sigma_scale)) ** 2))
+    importance = axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]
+    importance /= importance.max()
+    return importance.clamp_(min=min_weight).float()
+
+
+class SlidingWindow:
+    """
+    sliding window inference over whole volumes.
+    patches are cut from the volume on the device, forwarded in large batches (optionally in mixed precision)
+    and blended into a preallocated output buffer with constant or gaussian weights.
+    with overlap 0 and constant blending the output is the same of tio.GridSampler + GridAggregator('average').
+
+    usage:
+        engine = SlidingWindow((120, 120, 120), overlap=20, blending='gaussian')
+        output = engine(model, volume)  # C, Z, H, W
+        engine.log()
+    """
+
+    def __init__(self, patch_shape, overlap=0, batch_size=8, blending='constant', sigma_scale=1. / 8,
+                 buffer_dtype='float32', amp=False, device=None):
+        """
+        Args:
+            patch_shape (tuple): Z, H, W of the patches
+            overlap (int or tuple): overlap between neighbour patches, for each axis if tuple
+            batch_size (int): patches for each forward pass
+            blending (str): 'constant' (average of the overlapping predictions) or 'gaussian'
+            sigma_scale (float): sigma of the gaussian blending as fraction of the patch shape
+            buffer_dtype (str): 'float32' or 'float16', dtype of the accumulation buffer
+            amp (bool): forward passes with autocast
+            device (str): device for the forward passes, default is cuda if available
+        """
+        self.patch_shape = tuple(patch_shape)
+        self.overlap = tuple(overlap) if isinstance(overlap, (list, tuple)) else (overlap,) * 3
+        if any(o >= p for o, p in zip(self.overlap, self.patch_shape)):
+            raise Exception(f"overlap {self.overlap} must be smaller than the patch shape {self.patch_shape}")
+        if blending not in ['constant', 'gaussian']:
+            raise Exception(f"blending {blending} not supported, use constant or gaussian")
+        if buffer_dtype not in BUFFER_DTYPES:
+            raise Exception(f"buffer dtype {buffer_dtype} not supported, use one of {list(BUFFER_DTYPES)}")
+        self.batch_size = batch_size
+        self.blending = blending
+        self.buffer_dtype = BUFFER_DTYPES[buffer_dtype]
+        self.amp = amp
+        self.device = torch.device(device if device is not None else 'cuda' if torch.cuda.is_available() else 'cpu')
+
+        if blending == 'gaussian':
+            self.importance = gaussian_importance(self.patch_shape, sigma_scale).to(self.device)
+        else:
+            self.importance = torch.ones(self.patch_shape, device=self.device)
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.volumes = 0
+        self.patches = 0
+        self.seconds = 0
+
+    def __call__(self, model, volume):
+        """
+        Args:
+            model (torch.nn.Module): network called as model(patches, locations), in eval mode
+            volume (torch.Tensor or numpy array): volume with shape C, Z, H, W
+
+        Returns:
+            (torch.Tensor) float32 prediction on cpu with shape classes, Z, H, W
+        """
+        start_time = time.perf_counter()
+        volume = torch.as_tensor(volume).to(self.device, torch.float32, non_blocking=True)
+
+        # volumes smaller than a patch are padded and cropped back at the end
+        shape = volume.shape[-3:]
+        padded_shape = [max(dim, patch_dim) for dim, patch_dim in zip(shape, self.patch_shape)]
+        if list(shape) != padded_shape:
+            pad = [(p - d) for d, p in zip(shape, padded_shape)]
+            volume = F.pad(volume, [0, pad[2], 0, pad[1], 0, pad[0]])
+
+        locations = patch_locations(padded_shape, self.patch_shape, self.overlap)
+        output, weights = None, torch.zeros(padded_shape, device=self.device)
+
+        with torch.no_grad():
+            for batch_start in range(0, len(locations), self.batch_size):
+                batch_locations = locations[batch_start:batch_start + self.batch_size]
+                patches = torch.stack([volume[:, z0:z1, y0:y1, x0:x1] for z0, y0, x0, z1, y1, x1 in batch_locations])
+                emb_codes = torch.as_tensor(batch_locations, dtype=torch.float32, device=self.device)
+
+                with torch.autocast(device_type=self.device.type, enabled=self.amp):
+                    predictions = model(patches, emb_codes)  # B, classes, Z, H, W
+
+                if output is None:
+                    output = torch.zeros((predictions.shape[1], *padded_shape), dtype=self.buffer_dtype, device=self.device)
+                predictions = predictions.float() * self.importance
+                for prediction, (z0, y0, x0, z1, y1, x1) in zip(predictions, batch_locations):
+                    output[:, z0:z1, y0:y1, x0:x1] += prediction.to(self.buffer_dtype)
+                    weights[z0:z1, y0:y1, x0:x1] += self.importance
+
+        output = (output.float() / weights)[:, :shape[0], :shape[1], :shape[2]].cpu()
+
+        elapsed = time.perf_counter() - start_time
+        self.volumes += 1
+        self.patches += len(locations)
+        self.seconds += elapsed
+        return output
+
+    def log(self):
+        if self.volumes == 0:
+            return
+        logging.info(
+            f"sliding window (overlap {self.overlap}, {self.blending} blending): "
+            f"{self.patches / self.seconds:.1f} patches/s, {self.seconds / self.volumes:.2f}s per volume"
+        )
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import numpy as np
+
+# bump this when the preprocessing changes, all the old entries are going to be ignored.
+# 2: blockwise normalize_volume, background suppression of degenerate slices, Geometry padding with the cropped minimum
+CACHE_VERSION = 2
+HASH_CHUNK = 2 ** 24  # bytes read at once when hashing a file
+
+
+class VolumeCache:
+    """
+    persistent store of preprocessed volumes, shared across experiments.
+    each entry is addressed by the hash of the content of the source files and of the preprocessing parameters,
+    so entries are invalidated as soon as an input file or the config changes.
+    content hashes are memoized in an index by (path, size, mtime) to avoid reading the sources on each run.
+
+    layout of the cache directory:
+        hashes.json  -> {abs path: {size, mtime, sha1}}
+        <key>/data.npy, <key>/gt.npy  -> preprocessed arrays
+    """
+
+    def __init__(self, cache_dir, params):
+        """
+        Args:
+            cache_dir (str): root folder of the cache
+            params (dict): preprocessing parameters, they must be json serializable
+        """
+        self.cache_dir = cache_dir
+        pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        self.params = json.dumps({'version': CACHE_VERSION, **params}, sort_keys=True)
+        self.index_path = os.path.join(cache_dir, 'hashes.json')
+        self.index = self.__read_index()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *paths):
+        """
+        compute the key of an entry
+        Args:
+            *paths (str): source files of the entry
+
+        Returns:
+            (str) hex digest identifying the entry
+        """
+        h = hashlib.sha1(self.params.encode())
+        for path in paths:
+            h.update(self.file_hash(path).encode())
+        return h.hexdigest()
+
+    def file_hash(self, path):
+        """
+        sha1 of the content of a file, memoized in the index until the file is modified
+        Args:
+            path (str): path to the file
+
+        Returns:
+            (str) hex digest of the file
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.index.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['sha1']
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+                h.update(chunk)
+        self.index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': h.hexdigest()}
+        self.__write_index()
+        return self.index[path]['sha1']
+
+    def contains(self, key):
+        return os.path.isdir(os.path.join(self.cache_dir, key))
+
+    def path(self, key, name):
+        """
+        Args:
+            key (str): key of the entry
+            name (str): name of the array inside the entry
+
+        Returns:
+            (str) path to the npy file of the array
+        """
+        return os.path.join(self.cache_dir, key, f'{name}.npy')
+
+    def load(self, key):
+        """
+        Args:
+            key (str): key of the entry
+
+        Returns:
+            (dict of numpy arrays) content of the entry, None if the entry is not in the cache
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {
+            os.path.splitext(filename)[0]: np.load(os.path.join(entry_dir, filename))
+            for filename in os.listdir(entry_dir)
+        }
+
+    def save(self, key, **arrays):
+        """
+        store a new entry. arrays are written in a temporary folder which is then renamed,
+        concurrent writers (e.g. multiple ranks) never leave a partial entry.
+        Args:
+            key (str): key of the entry
+            **arrays (numpy arrays): arrays to be saved, the name of the argument is the name of the file
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp_')
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), array)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:  # someone else stored the same entry in the meantime
+            for filename in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, filename))
+            os.rmdir(tmp_dir)
+
+    def log(self):
+        logging.info(f"preprocessing cache {self.cache_dir}: {self.hits} hits, {self.misses} misses")
+
+    def __read_index(self):
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except ValueError:
+            logging.info(f"corrupted cache index {self.index_path}, all the files are going to be hashed again")
+            return {}
+
+    def __write_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp_', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
@@ -3,9 +3,11 @@ import numpy as np
 from torchvision import transforms
 import os
 from matplotlib import pyplot as plt
-from augmentations import RandomRotate, RandomContrast, ElasticDeformation, Normalize, ToTensor, CenterPad, RandomHorizontalFlip, Resize, Rescale
+from augmentations import RandomRotate, RandomContrast, ElasticDeformation, Normalize, ToTensor, CenterPad, RandomHorizontalFlip, Resize, Rescale, Geometry
 import torch
 import json
+import pathlib
+import tempfile
 from tqdm import tqdm
 from Jaw import Jaw
 import logging
@@ -56,6 +58,15 @@ class AlveolarDataloader(Dataset):
         reshape_size = self.config.get('resize_shape', (152, 224, 256))
         self.reshape_size = tuple(reshape_size) if type(reshape_size) == list else reshape_size
 
+        # lazy sub-volumes are views of memory mapped files, they are read from disk when requested
+        self.lazy = config.get('lazy', False)
+        self.lazy_dir = None
+        if self.lazy:
+            cache_dir = config.get('cache_dir', None)
+            if cache_dir is not None:
+                pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            self.lazy_dir = tempfile.TemporaryDirectory(prefix='.lazy2D_', dir=cache_dir)  # removed with the dataset
+
         self.mean = self.config.get('mean', None)
         self.std = self.config.get('std', None)
         self.means = []
@@ -141,28 +152,24 @@ class AlveolarDataloader(Dataset):
 
         # rescale
         data = np.clip(data, self.dicom_min, self.dicom_max)
-        data = (data.astype(np.float) + self.dicom_min) / (self.dicom_max + self.dicom_min)   # [0-1] with shifting
+        data = (data.astype(np.float32) + self.dicom_min) / (self.dicom_max + self.dicom_min)   # [0-1] with shifting
 
         if self.mean is None or self.std is None:
             self.means.append(np.mean(data))
             self.stds.append(np.std(data))
 
-        D, H, W = data.shape[-3:]
-        rD, rH, rW = self.reshape_size
-        tmp_ratio = np.array((D/W, H/W, 1))
-        pad_factor = tmp_ratio / np.array((rD/rW, rH/rW, 1))
-        pad_factor /= np.max(pad_factor)
-        new_shape = np.array((D, H, W)) / pad_factor
-        new_shape = np.round(new_shape).astype(np.int)
-
-        data = CenterPad(new_shape)(data)
-        data = Rescale(size=self.reshape_size)(data)
+        # resample keeping the aspect ratio and pad, test2D maps the predictions back with the inverse
+        geometry = Geometry.keep_aspect(data.shape[-3:], self.reshape_size)
+        data = geometry(data)
 
         if partition == 'train':
-            gt = CenterPad(new_shape)(gt, pad_val=self.config['labels']['BACKGROUND'])
-            gt = Rescale(size=self.reshape_size, interp_fn='nearest')(gt)
+            gt = geometry(gt, pad_val=self.config['labels']['BACKGROUND'], mode='nearest')
         else:
-            gt = np.zeros_like(data)  # this is because in test and train we load gt at runtime
+            gt = np.zeros_like(data, dtype=np.uint8)  # this is because in test and train we load gt at runtime
+
+        if self.lazy:
+            data = self.to_memmap(data, f'{partition}_{folder}_data')
+            gt = self.to_memmap(gt, f'{partition}_{folder}_gt')
 
         data = [np.squeeze(d) for d in self.splitter.split(data)]
         gt = [np.squeeze(g) for g in self.splitter.split(gt)]
@@ -181,9 +188,26 @@ class AlveolarDataloader(Dataset):
         vol = transforms.Normalize(self.mean, self.std)(ToTensor()(vol.copy()))
         gt = ToTensor()(gt.copy())
         ToTensor()(np.asarray(self.patients['weights'][index]).astype(np.float32))
-        vol = vol.repeat(3, 1, 1)  # creating the channel axis and making it RGB
+        # one channel, models broadcast it to their input channels
         return vol, gt, folders, weights, gt_paths
 
+    def to_memmap(self, volume, name):
+        """
+        move a preprocessed volume to a read-only memory mapped file in the lazy folder
+        Args:
+            volume (numpy array): preprocessed volume
+            name (str): unique name of the file
+
+        Returns:
+            (numpy memmap) volume mapped from disk, pages are shared by all the loader workers
+        """
+        path = os.path.join(self.lazy_dir.name, f'{name}.npy')
+        mmap = np.lib.format.open_memmap(path, mode='w+', dtype=volume.dtype, shape=volume.shape)
+        mmap[:] = volume
+        mmap.flush()
+        del mmap
+        return np.load(path, mmap_mode='r')
+
     def get_splitter(self):
         return self.splitter
 
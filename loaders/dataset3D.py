@@ -3,14 +3,76 @@ import numpy as np
 from torchvision import transforms
 import os
 from matplotlib import pyplot as plt
-from augmentations import RandomRotate, RandomContrast, ElasticDeformation, Normalize, ToTensor, CenterPad, RandomVerticalFlip, Resize, Rescale, CropAndPad
+from augmentations import RandomRotate, RandomContrast, ElasticDeformation, Normalize, ToTensor, CenterPad, RandomVerticalFlip, Resize, Rescale, CropAndPad, CenterCrop, Geometry
 import torch
 import json
+import copy
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
 from Jaw import Jaw
 import logging
 import torchio as tio
 import utils
+import processing
+import batch_augmentations
+from loaders.cache import VolumeCache
+from loaders.samplers import LabelIndexSampler, ForegroundGridSampler
+from inference import patch_locations
+
+
+def mmap_reader(path, target_shape=None, clip=None, pad_val=None, dtype=np.float32, mask=None):
+    """
+    torchio reader for the lazy subjects of Loader3D.
+    the npy volume is memory mapped and just the voxels inside target_shape are read from disk,
+    clip and rescale of Loader3D.preprocessing are then applied to the cropped volume before padding it.
+    Args:
+        path (str): path to the npy volume
+        target_shape (tuple): final shape of the volume, if None the volume is read as it is
+        clip (tuple): volumes_min and volumes_max for clip and rescale, if None values are not rescaled
+        pad_val (float): value for the padding, if None the min of the volume is used
+        dtype (numpy dtype): dtype of the result
+        mask (numpy array): bool mask with shape H, W of the volume, voxels outside are set to 0 after the rescale
+
+    Returns:
+        tensor (torch.Tensor): volume with shape 1, Z, H, W
+        affine (numpy array): identity matrix, as for the subjects created from tensors
+    """
+    volume = np.load(path, mmap_mode='r')
+    if volume.ndim == 4:
+        volume = volume[0]
+    if target_shape is not None:
+        crop_shape = np.minimum(volume.shape, target_shape)
+        volume = CenterCrop(crop_shape)(volume)
+        mask = CenterCrop((1, *crop_shape[1:]))(mask[None])[0] if mask is not None else None
+    if clip is not None:  # reading the cropped voxels from disk, with the rescale of Loader3D.preprocessing
+        volume = processing.normalize_volume(volume, *clip, mask=mask).astype(dtype, copy=False)
+    else:
+        volume = np.array(volume, dtype=dtype)  # reading the cropped voxels from disk
+        if mask is not None:
+            volume[:, ~mask] = 0
+
+    if target_shape is not None:
+        volume = CropAndPad(target_shape, pad_val=pad_val)(volume)  # nothing left to crop, just padding
+    return torch.from_numpy(volume[None]), np.eye(4)
+
+
+class SubjectLoader:
+    """
+    iterable over the subjects of the test or validation set, volumes are predicted by inference.SlidingWindow.
+    lazy subjects are loaded one at a time and released once the iteration moves on.
+    """
+
+    def __init__(self, subjects, lazy=False):
+        self.subjects = subjects
+        self.lazy = lazy
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __iter__(self):
+        for subject in self.subjects:
+            yield copy.deepcopy(subject) if self.lazy else subject  # cheap, images are not loaded yet
 
 
 class Loader3D():
@@ -40,10 +102,33 @@ class Loader3D():
         augment = AugFactory(auglist)
         augment.log()  # write what we are using to logfile
         self.transforms = augment.get_transform()
+        # with backend: torch the augmentations are applied by train3D on the collated batches, see batch_augmentations.py
+        self.batch_transforms = augment.get_batch_transform()
 
         reshape_size = self.config.get('resize_shape', (152, 224, 256))
         self.reshape_size = tuple(reshape_size) if type(reshape_size) == list else reshape_size
 
+        # lazy subjects are memory mapped and preprocessed when they are loaded by the queue workers
+        self.lazy = config.get('lazy', False)
+
+        # data outside the dental arch is set to 0, see utils.suppression_mask
+        self.background_suppression = config.get('background_suppression', False)
+        self.suppression = None
+
+        # preprocessed volumes can be shared across experiments, see loaders/cache.py
+        cache_dir = config.get('cache_dir', None)
+        self.cache = None
+        if cache_dir is not None:
+            params = {
+                'volumes_min': self.dicom_min,
+                'volumes_max': self.dicom_max,
+                'resize_shape': list(self.reshape_size),
+                'labels': self.config['labels'],
+            }
+            if self.background_suppression:  # old entries stay valid when the suppression is off
+                params['background_suppression'] = True
+            self.cache = VolumeCache(cache_dir, params=params)
+
         split_filepath = config.get('split_filepath')
         logging.info(f"split filepath is {split_filepath}")
         with open(split_filepath) as f:
@@ -59,6 +144,10 @@ class Loader3D():
             else:
                 folder_splits['syntetic'] = []
 
+        if self.background_suppression:
+            data_paths = [os.path.join(config['sparse_path'], folder, 'data.npy') for folders in folder_splits.values() for folder in folders]
+            self.suppression = self.suppression_masks(data_paths)
+
         for partition, folders in folder_splits.items():
             logging.info(f"loading data for {partition} - tot: {len(folders)}.")
             for patient_num, folder in tqdm(enumerate(folders), total=len(folders)):
@@ -75,15 +164,16 @@ class Loader3D():
                     gt_filename = 'gt_alpha_multi.npy' if 'CONTOUR' in self.config['labels'] else 'gt_alpha.npy'
                     gt_path = os.path.join(config['file_path'], folder, gt_filename)
 
-                data = np.load(data_path)
-                gt = np.load(gt_path)
+                infos = (data_path, gt_path, folder, partition)
+                if self.lazy:
+                    data, gt = self.lazy_images(infos)
+                else:
+                    data, gt = self.load_patient(infos)
+                    data, gt = tio.ScalarImage(tensor=data), tio.LabelMap(tensor=gt)
+                self.subjects[partition].append(self.make_subject(data, gt, infos))
 
-                assert np.max(data) > 1  # data should NOT be normalized by default
-                assert np.unique(gt).size <= len(self.config['labels'])
-
-                self.subjects[partition].append(
-                    self.preprocessing(data, gt, infos=(data_path, gt_path, folder, partition))
-                )
+        if self.cache is not None:
+            self.cache.log()
 
         self.weights = self.config.get('weights', None)
         if self.weights is None:
@@ -99,30 +189,137 @@ class Loader3D():
     def get_weights(self):
         return self.weights
 
+    def suppression_masks(self, data_paths):
+        """
+        background suppression masks of the patients (see utils.suppression_mask_file), as a preprocessing stage.
+        missing masks are computed by a pool of preprocessing_workers processes and stored in the cache, if enabled.
+        Args:
+            data_paths (list of str): raw volumes of the patients
+
+        Returns:
+            (dict) data path -> bool mask with shape H, W
+        """
+        masks = {}
+        missing = []
+        for data_path in dict.fromkeys(data_paths):
+            cached = self.cache.load(self.cache.key(data_path)) if self.cache is not None else None
+            if cached is not None:
+                masks[data_path] = cached['mask']
+            else:
+                missing.append(data_path)
+
+        compute = partial(utils.suppression_mask_file, dicom_min=self.dicom_min, dicom_max=self.dicom_max)
+        workers = min(self.config.get('preprocessing_workers', os.cpu_count()), len(missing))
+        pool = Pool(workers) if workers > 1 else None
+        try:
+            results = pool.imap(compute, missing) if pool is not None else map(compute, missing)
+            for data_path, mask in tqdm(zip(missing, results), total=len(missing), desc='background suppression'):
+                masks[data_path] = mask
+                if self.cache is not None:
+                    self.cache.save(self.cache.key(data_path), mask=mask)
+        finally:
+            if pool is not None:
+                pool.terminate()  # all the results are in, or something failed
+        logging.info(f"background suppression: {len(missing)} masks computed with {max(workers, 1)} workers, "
+                     f"{len(masks) - len(missing)} from the cache")
+        return masks
+
+    def load_patient(self, infos):
+        """
+        load the preprocessed volumes of a patient, from the cache if available
+        Args:
+            infos (tuple): data_path, gt_path, folder, partition
+
+        Returns:
+            data (numpy array): float32 volume, shape 1, Z, H, W
+            gt (numpy array): uint8 labels, shape 1, Z, H, W
+        """
+        data_path, gt_path, folder, partition = infos
+
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(data_path, gt_path)
+            cached = self.cache.load(key)
+            if cached is not None:
+                return cached['data'], cached['gt']
+
+        data = np.load(data_path)
+        gt = np.load(gt_path)
+
+        assert np.max(data) > 1  # data should NOT be normalized by default
+        assert np.unique(gt).size <= len(self.config['labels'])
+
+        data, gt = self.preprocessing(data, gt, infos)
+        if self.cache is not None:
+            self.cache.save(key, data=data, gt=gt)
+        return data, gt
+
     def preprocessing(self, data, gt, infos):
 
         data_path, gt_path, folder, partition = infos
 
-        # rescale
-        data = np.clip(data, self.dicom_min, self.dicom_max)
-        data = (data.astype(np.float) + self.dicom_min) / (self.dicom_max + self.dicom_min)   # [0-1] with shifting
+        # rescale and background suppression, the same of predict.py
+        mask = self.suppression[data_path] if self.suppression is not None else None
+        data = processing.normalize_volume(data, self.dicom_min, self.dicom_max, mask=mask)
 
         safe_gt_check = np.sum(gt)
-        data = CropAndPad(self.reshape_size)(data)
-        gt = CropAndPad(self.reshape_size, pad_val=self.config['labels']['BACKGROUND'])(gt)
+        geometry = Geometry(data.shape[-3:], self.reshape_size)  # test3D maps the predictions back with its inverse
+        data = geometry(data)
+        gt = geometry(gt, pad_val=self.config['labels']['BACKGROUND'])
         if safe_gt_check != np.sum(gt):
             logging.info(f"BIG WARNING: we are missing some GT voxel with this crop! {folder}, {partition}")
 
         gt = gt.astype(np.uint8)
 
-        # adding the 4th dim and making it RGB
+        # adding the channel axis
         if gt.ndim == 3: gt = gt.reshape(1, *gt.shape)
-        if data.ndim == 3: data = np.tile(data.reshape(1, *data.shape), (3, 1, 1, 1))
+        if data.ndim == 3: data = data.reshape(1, *data.shape)
+        return data, gt
+
+    def lazy_images(self, infos):
+        """
+        create the images of a patient without loading them, see mmap_reader.
+        if the cache is enabled the images point to the cached volumes, which are created here if missing.
+        Args:
+            infos (tuple): data_path, gt_path, folder, partition
+
+        Returns:
+            data (tio.ScalarImage): lazy volume
+            gt (tio.LabelMap): lazy labels
+        """
+        data_path, gt_path, folder, partition = infos
+
+        if self.cache is not None:
+            key = self.cache.key(data_path, gt_path)
+            if not self.cache.contains(key):
+                self.load_patient(infos)  # preprocessed volumes are stored and released right away
+            return (
+                tio.ScalarImage(path=self.cache.path(key, 'data'), reader=mmap_reader),
+                tio.LabelMap(path=self.cache.path(key, 'gt'), reader=partial(mmap_reader, dtype=np.uint8)),
+            )
+
+        mask = self.suppression[data_path] if self.suppression is not None else None
+        data_reader = partial(mmap_reader, target_shape=self.reshape_size, clip=(self.dicom_min, self.dicom_max), mask=mask)
+        label_reader = partial(mmap_reader, target_shape=self.reshape_size, pad_val=self.config['labels']['BACKGROUND'], dtype=np.uint8)
+        return tio.ScalarImage(path=data_path, reader=data_reader), tio.LabelMap(path=gt_path, reader=label_reader)
+
+    def make_subject(self, data, gt, infos):
+        """
+        volumes are stored with one channel, models broadcast it to their input channels (see in_channels in the model config).
+        Args:
+            data (tio.ScalarImage): volume
+            gt (tio.LabelMap): labels
+            infos (tuple): data_path, gt_path, folder, partition
+
+        Returns:
+            (tio.Subject) subject of the patient, labels are included only for the training partitions
+        """
+        data_path, gt_path, folder, partition = infos
 
         if partition in ['train', 'syntetic']:
             return tio.Subject(
-                data=tio.ScalarImage(tensor=data),
-                label=tio.LabelMap(tensor=gt),
+                data=data,
+                label=gt,
                 gt_path=gt_path,
                 data_path=data_path,
                 folder=folder,
@@ -131,7 +328,7 @@ class Loader3D():
             )
 
         return tio.Subject(
-            data=tio.ScalarImage(tensor=data),
+            data=data,
             gt_path=gt_path,
             data_path=data_path,
             folder=folder,
@@ -145,27 +342,65 @@ class Loader3D():
     def get_sampler(self, type, overlap=0):
         patch_shape = self.config['patch_shape']
         if type == 'grid':
+            background_ratio = self.config.get('background_ratio', None)
+            if background_ratio is not None:  # grid without most of the empty patches
+                return ForegroundGridSampler(
+                    patch_size=patch_shape,
+                    patch_overlap=overlap,
+                    background_ratio=background_ratio,
+                    margin=self.config.get('roi_margin', 0),
+                    background=self.config['labels']['BACKGROUND'],
+                )
             return tio.GridSampler(patch_size=patch_shape, patch_overlap=overlap)
         elif type == 'by_label':
-            return tio.LabelSampler(
+            labels = self.config['labels']
+            probabilities = self.config.get('label_probabilities', {'BACKGROUND': 0.1, 'INSIDE': 0.9})
+            return LabelIndexSampler(
                 patch_size=patch_shape,
-                label_name='label',
-                label_probabilities={self.config['labels']['BACKGROUND']: 0.1, self.config['labels']['INSIDE']: 0.9}
+                label_probabilities={labels[name]: p for name, p in probabilities.items()},
+                background=labels['BACKGROUND'],
             )
         else:
             raise Exception('no valid sampling type provided')
 
+    def patches_per_subject(self, sampler, samples_per_volume):
+        """
+        patches drawn from each training subject in an epoch, the work used by PatchPipeline to balance the ranks.
+        with the foreground grid sampler a subject gives one round (all its foreground patches and their share of
+        background ones), the locations are computed here once and kept by the sampler for the workers.
+        the plain grid sampler is finite, subjects give samples_per_volume patches at most its grid locations.
+        the index of the labels of the by_label sampler is also built here, once, and the workers get it with the
+        sampler instead of indexing each subject on their own.
+        Args:
+            sampler (tio.data.PatchSampler): training sampler, see get_sampler
+            samples_per_volume (int): patches of each subject for the other samplers
+
+        Returns:
+            (list of int) patches of each subject of the training set, in the order of split_dataset
+        """
+        training_set = self.subjects['train'] + self.subjects['syntetic']
+        if isinstance(sampler, tio.GridSampler):
+            grid = patch_locations(self.reshape_size, sampler.patch_size.astype(int), sampler.patch_overlap)
+            return [min(samples_per_volume, len(grid))] * len(training_set)
+        if isinstance(sampler, LabelIndexSampler):
+            for subject in training_set:
+                sampler.index(copy.deepcopy(subject) if self.lazy else subject)
+        if not isinstance(sampler, ForegroundGridSampler):
+            return [samples_per_volume] * len(training_set)
+        # lazy subjects are copied, so the labels loaded here are released
+        return [sampler.round_size(copy.deepcopy(s) if self.lazy else s) for s in training_set]
+
     def split_dataset(self, rank=0, world_size=1):
+        """
+        the training set is not split among the ranks, PatchPipeline shards it on each epoch.
+        test and validation subjects are split as subjects[rank::world_size], see Eval.gather
+        """
         training_set = self.subjects['train'] + self.subjects['syntetic']
-        train = tio.SubjectsDataset(training_set[rank::world_size], transform=self.transforms) if self.do_train else None
+        train = tio.SubjectsDataset(training_set, transform=self.transforms) if self.do_train else None
         # logging.info("using the following augmentations: ", train[0].history)
 
-        if rank == 0:
-            patch_shape = self.config['patch_shape']
-            test = [tio.GridSampler(subject, patch_size=patch_shape, patch_overlap=0) for subject in self.subjects['test']]
-            val = [tio.GridSampler(subject, patch_size=patch_shape, patch_overlap=0) for subject in self.subjects['val']]
-        else:
-            test = val = None
+        test = self.subjects['test'][rank::world_size]
+        val = self.subjects['val'][rank::world_size]
         # TODO: grid sampling: might be interesting to make some test with overlapping!
         # TODO: check if grid or weight sampling is selected for the training data. assuming grid right now.
 
@@ -201,7 +436,8 @@ class Loader3D():
         class_pixel_count = num_labels * [0]
 
         for p in self.subjects['train']:
-            gt = p['label'][tio.DATA].cpu().numpy()
+            label = copy.deepcopy(p['label']) if self.lazy else p['label']  # do not keep lazy labels in memory
+            gt = label[tio.DATA].cpu().numpy()
             for l in valid_labels:
                 class_pixel_count[l] += np.sum(gt == l) / np.sum(np.in1d(gt, valid_labels))
 
@@ -240,8 +476,19 @@ class Loader3D():
 
 
 class AugFactory:
+    """
+    augmentations listed in a yaml file. transforms are torchio ones applied to each subject when it is loaded,
+    or, if the file has the key backend: torch, the batched transforms of batch_augmentations.py applied to the
+    patches of each batch on the device of the model.
+    """
+
+    BACKENDS = {'torchio': tio, 'torch': batch_augmentations}
+
     def __init__(self, aug_list):
-        self.aug_list = aug_list
+        self.aug_list = dict(aug_list)
+        self.backend = self.aug_list.pop('backend', 'torchio')
+        if self.backend not in self.BACKENDS:
+            raise Exception(f"augmentation backend {self.backend} not recognized, use one of {list(self.BACKENDS)}")
         self.transforms = self.factory(self.aug_list, [])
 
     def log(self):
@@ -250,18 +497,19 @@ class AugFactory:
         :param path:
         :return:
         """
-        logging.info('going to use the following augmentations:: %s', self.aug_list)
+        logging.info('going to use the following augmentations (%s):: %s', self.backend, self.aug_list)
 
     def factory(self, auglist, transforms):
+        module = self.BACKENDS[self.backend]
         for aug in auglist:
             if aug == 'OneOf':
-                transforms.append(tio.OneOf(self.factory(auglist[aug], [])))
+                transforms.append(module.OneOf(self.factory(auglist[aug], [])))
             else:
                 try:
                     kwargs = {}
                     for param, value in auglist[aug].items():
                         kwargs[param] = value
-                    transforms.append(getattr(tio, aug)(**kwargs))
+                    transforms.append(getattr(module, aug)(**kwargs))
                 except:
                     raise Exception(f"this transform is not valid: {aug}")
         return transforms
@@ -271,4 +519,10 @@ class AugFactory:
         return the transform object
         :return:
         """
-        return tio.Compose(self.transforms)
\ No newline at end of file
+        return tio.Compose(self.transforms if self.backend == 'torchio' else [])
+
+    def get_batch_transform(self):
+        """
+        return the batched transform object, None if the augmentations are torchio ones
+        """
+        return batch_augmentations.Compose(self.transforms) if self.backend == 'torch' and self.transforms else None
@@ -0,0 +1,316 @@
+import time
+import random
+import logging
+import traceback
+from itertools import islice
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torchio as tio
+
+
+def produce(dataset, tasks, sampler, batch_size, worker_subjects):
+    """
+    batches of patches from a list of subjects, patches of worker_subjects subjects are shuffled together
+    Args:
+        dataset (tio.SubjectsDataset): training subjects, augmentations are applied when a subject is loaded
+        tasks (list of tuple): (subject index, patches) of the subjects to be sampled
+        sampler (tio.data.PatchSampler): patch sampler
+        batch_size (int): patches for each batch, the last batch can be smaller
+        worker_subjects (int): subjects loaded at once
+
+    Yields:
+        (list of tio.Subject) patches of a batch
+    """
+    pool = []
+    position = 0
+    while True:
+        if len(pool) < batch_size and position < len(tasks):
+            for index, num_patches in tasks[position:position + worker_subjects]:
+                pool.extend(islice(sampler(dataset[index]), num_patches))
+            position += worker_subjects
+            random.shuffle(pool)
+            continue
+        if not pool:
+            return
+        batch, pool = pool[:batch_size], pool[batch_size:]
+        yield batch
+
+
+def write(buffers, slot, patches):
+    """
+    copy the patches of a batch in a slot of the buffers
+
+    Returns:
+        (list of str) folders of the patches
+    """
+    for i, patch in enumerate(patches):
+        buffers['data'][slot, i].copy_(patch['data'][tio.DATA])
+        buffers['label'][slot, i].copy_(patch['label'][tio.DATA])
+        buffers['location'][slot, i].copy_(torch.as_tensor(patch[tio.LOCATION]))
+        buffers['weight'][slot, i] = float(patch.get('weight', 1))
+    return [patch.get('folder') for patch in patches]
+
+
+def worker_loop(worker_id, dataset, sampler, batch_size, worker_subjects, buffers, tasks, free, ready, seed):
+    """
+    body of the workers of PatchPipeline: for each epoch (a task with the subjects of the worker) batches are written
+    in the free slots and announced on the ready queue, a 'done' message closes the epoch
+    """
+    torch.set_num_threads(1)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        epoch, subjects = task
+        worker_seed = seed + epoch * 1000 + worker_id
+        random.seed(worker_seed)
+        np.random.seed(worker_seed)
+        torch.manual_seed(worker_seed)
+        try:
+            for patches in produce(dataset, subjects, sampler, batch_size, worker_subjects):
+                slot = free.get()
+                names = write(buffers, slot, patches)
+                ready.put(('batch', slot, len(patches), names))
+        except Exception:
+            ready.put(('error', worker_id, traceback.format_exc()))
+        ready.put(('done', worker_id, None))
+
+
+class PatchPipeline:
+    """
+    training batches of patches produced by persistent worker processes.
+    each worker loads and augments its share of the subjects, extracts the patches and writes whole batches
+    in a ring of shared memory slots (page-locked when cuda is available); the trainer gets views of the slots,
+    batches are never pickled, collated or copied on the main process.
+    a batch is valid until the next one is requested, then its slot goes back to the workers.
+    with num_workers 0 batches are produced by the main process, in a single slot.
+    with more ranks the subjects are split among them on each epoch, balancing the patches (see assignment):
+    every rank gets the whole dataset and the same seed, and all the ranks run the same number of steps.
+
+    usage:
+        pipeline = PatchPipeline(dataset, sampler, 32, batch_size=6, patch_shape=(80, 80, 80), num_workers=8)
+        for epoch in range(epochs):
+            for batch in pipeline:  # subjects are shuffled again on each epoch
+                batch['data'][tio.DATA], batch['label'][tio.DATA], batch[tio.LOCATION], batch['weight'], batch['folder']
+        pipeline.close()
+    """
+
+    def __init__(self, dataset, sampler, samples_per_volume, batch_size, patch_shape, num_workers=0, slots=None,
+                 worker_subjects=2, channels=1, shuffle_subjects=True, pin_memory=True, seed=0, rank=0, world_size=1,
+                 augment=None):
+        """
+        Args:
+            dataset (tio.SubjectsDataset): training subjects with their augmentations
+            sampler (tio.data.PatchSampler): patch sampler
+            samples_per_volume (int or list of int): patches for each subject, or the patches of each subject
+            batch_size (int): patches for each batch of this rank
+            patch_shape (tuple): Z, H, W of the patches
+            num_workers (int): worker processes
+            slots (int): batches in the ring buffer, default is two for each worker
+            worker_subjects (int): subjects whose patches are shuffled together by each worker
+            channels (int): channels of the volumes
+            shuffle_subjects (bool): new order of the subjects on each epoch
+            pin_memory (bool): page-lock the slots for faster (and asynchronous) copies to the gpu
+            seed (int): seed of the order of the subjects and of the workers, the same on all the ranks
+            rank (int): rank of this process
+            world_size (int): number of ranks sharing the subjects
+            augment (batch_augmentations.BatchTransform): batched augmentations applied by the trainer to the
+                batches of this pipeline once they are on its device, None if the subjects are augmented by dataset
+        """
+        self.dataset = dataset
+        self.sampler = sampler
+        if isinstance(samples_per_volume, int):
+            samples_per_volume = [samples_per_volume] * len(dataset)
+        if len(samples_per_volume) != len(dataset):
+            raise Exception(f"patches for {len(samples_per_volume)} subjects, the dataset has {len(dataset)} subjects")
+        self.samples_per_volume = list(samples_per_volume)
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.num_slots = 1 if num_workers == 0 else slots if slots is not None else 2 * num_workers
+        self.worker_subjects = worker_subjects
+        self.shuffle_subjects = shuffle_subjects
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.augment = augment
+        self.epoch = 0
+        self.loads = np.zeros(world_size, np.int64)
+
+        self.buffers = {
+            'data': torch.zeros((self.num_slots, batch_size, channels, *patch_shape), dtype=torch.float32),
+            'label': torch.zeros((self.num_slots, batch_size, 1, *patch_shape), dtype=torch.uint8),
+            'location': torch.zeros((self.num_slots, batch_size, 6), dtype=torch.int64),
+            'weight': torch.zeros((self.num_slots, batch_size), dtype=torch.float32),
+        }
+        if num_workers > 0:
+            for buffer in self.buffers.values():
+                buffer.share_memory_()
+        self.pinned = pin_memory and torch.cuda.is_available() and self.__pin()
+
+        self.workers = []
+        self.reset_stats()
+
+    def __pin(self):
+        """
+        page-lock the shared slots in place, pin_memory() would copy them out of the shared memory
+        """
+        cudart = torch.cuda.cudart()
+        for buffer in self.buffers.values():
+            if int(cudart.cudaHostRegister(buffer.data_ptr(), buffer.numel() * buffer.element_size(), 0)) != 0:
+                logging.info("patch pipeline: slots can not be pinned, copies to the gpu are going to be synchronous")
+                return False
+        return True
+
+    def assignment(self, epoch):
+        """
+        subjects of the workers of this rank for an epoch.
+        subjects are split among the ranks by their patches: largest first, each one to the rank with fewer patches.
+        subjects with the same patches are taken in a new random order on each epoch, so they move among the ranks.
+        every rank computes the same split from the seed, no communication is needed.
+        ranks run the steps of the rank with fewer patches, the patches left on the others are dropped.
+
+        Returns:
+            (list of list of tuple) (subject index, patches) for each worker
+            (int) batches of this rank in the epoch
+            (numpy array) patches of each rank
+        """
+        rng = np.random.RandomState(self.seed + epoch)
+        order = rng.permutation(len(self.dataset)) if self.shuffle_subjects else np.arange(len(self.dataset))
+        loads = np.zeros(self.world_size, np.int64)
+        shards = [[] for _ in range(self.world_size)]
+        for index in sorted(order.tolist(), key=lambda i: -self.samples_per_volume[i]):  # stable, ties keep the order
+            rank = int(np.argmin(loads))
+            shards[rank].append(index)
+            loads[rank] += self.samples_per_volume[index]
+
+        subjects = shards[self.rank]
+        if self.shuffle_subjects:
+            subjects = [subjects[i] for i in rng.permutation(len(subjects))]
+        num_workers = max(self.num_workers, 1)
+        workers = [[(i, self.samples_per_volume[i]) for i in subjects[w::num_workers]] for w in range(num_workers)]
+        if self.world_size == 1:
+            batches = sum(-(-sum(n for _, n in tasks) // self.batch_size) for tasks in workers)
+        else:
+            batches = int(loads.min()) // self.batch_size
+        return workers, batches, loads
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.assignment(self.epoch)[1]
+
+    def batch(self, slot, size, names):
+        return {
+            'data': {tio.DATA: self.buffers['data'][slot, :size]},
+            'label': {tio.DATA: self.buffers['label'][slot, :size]},
+            tio.LOCATION: self.buffers['location'][slot, :size],
+            'weight': self.buffers['weight'][slot, :size],
+            'folder': names,
+        }
+
+    def __start(self):
+        self.tasks = [mp.Queue() for _ in range(self.num_workers)]
+        self.free = mp.Queue()
+        self.ready = mp.Queue()
+        for slot in range(self.num_slots):
+            self.free.put(slot)
+        for worker_id in range(self.num_workers):
+            worker = mp.Process(
+                target=worker_loop,
+                args=(worker_id, self.dataset, self.sampler, self.batch_size, self.worker_subjects, self.buffers, self.tasks[worker_id], self.free, self.ready, self.seed),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def __iter__(self):
+        assignment, num_batches, self.loads = self.assignment(self.epoch)
+        epoch = self.epoch
+        self.epoch += 1
+
+        if self.num_workers == 0:
+            worker_seed = self.seed + epoch * 1000
+            random.seed(worker_seed)
+            np.random.seed(worker_seed)
+            batches = produce(self.dataset, assignment[0], self.sampler, self.batch_size, self.worker_subjects)
+            for patches in islice(batches, num_batches):
+                yield self.batch(0, len(patches), write(self.buffers, 0, patches))
+            return
+
+        if not self.workers:
+            self.__start()
+        for worker_id, subjects in enumerate(assignment):
+            self.tasks[worker_id].put((epoch, subjects))
+
+        running = self.num_workers
+        previous = None
+        yielded = 0
+        try:
+            while running and yielded < num_batches:
+                if previous is not None:
+                    self.free.put(previous)  # the trainer is done with the previous batch
+                    previous = None
+                depth = self.ready.qsize()
+                start = time.perf_counter()
+                kind, value, *content = self.ready.get()
+                if kind == 'done':
+                    running -= 1
+                    continue
+                if kind == 'error':
+                    raise Exception(f"patch worker {value} failed:\n{content[0]}")
+                self.batches += 1
+                self.wait += time.perf_counter() - start
+                self.starved += depth == 0
+                self.depth += depth
+                previous = value
+                yielded += 1
+                yield self.batch(value, *content)
+        finally:
+            if previous is not None:
+                self.free.put(previous)
+            # iteration stopped early (or the other ranks are done): the rest of the epoch is discarded,
+            # slots go back to the workers
+            while running:
+                kind, value, *_ = self.ready.get()
+                if kind == 'batch':
+                    self.free.put(value)
+                elif kind == 'done':
+                    running -= 1
+        self.log()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.batches = 0
+        self.wait = 0
+        self.starved = 0
+        self.depth = 0
+
+    def log(self):
+        if self.batches == 0:
+            return
+        logging.info(
+            f"patch pipeline ({self.num_workers} workers, {self.num_slots} slots): {self.batches} batches, "
+            f"{self.wait / self.batches * 1000:.1f}ms mean wait, {self.starved / self.batches:.0%} starved batches, "
+            f"{self.depth / self.batches:.1f} ready batches on average"
+        )
+        if self.world_size > 1:
+            logging.info(
+                f"patch pipeline rank {self.rank}/{self.world_size}: patches of the ranks {self.loads.tolist()}, "
+                f"{self.loads.max() / self.loads.mean():.3f} max/mean"
+            )
+
+    def close(self):
+        for tasks in getattr(self, 'tasks', []):
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        if self.pinned:
+            cudart = torch.cuda.cudart()
+            for buffer in self.buffers.values():
+                cudart.cudaHostUnregister(buffer.data_ptr())
+            self.pinned = False
@@ -0,0 +1,238 @@
+import numpy as np
+import torchio as tio
+from inference import patch_locations
+
+
+def spatial_history(subject):
+    """
+    spatial augmentations applied to a subject
+    Args:
+        subject (tio.Subject): loaded subject
+
+    Returns:
+        (list of int) spatial axes flipped with respect to the original subject
+        (bool) true if flips are the only spatial augmentations, positions computed on the original subject can be
+        moved on this one by flipping them
+    """
+    flipped = np.zeros(3, bool)
+    reusable = True
+    for transform in subject.get_applied_transforms():
+        if isinstance(transform, tio.Flip) and all(isinstance(axis, int) for axis in transform.axes):
+            flipped[list(transform.axes)] ^= True
+        elif isinstance(transform, tio.SpatialTransform):
+            reusable = False
+    return np.flatnonzero(flipped).tolist(), reusable
+
+
+def label_index(label, labels):
+    """
+    coordinates of the voxels of each label, the compact index used by LabelIndexSampler
+    Args:
+        label (numpy array): labels with shape Z, H, W
+        labels (list of int): labels to be indexed
+
+    Returns:
+        (dict) label -> uint16 numpy array with shape N, 3
+    """
+    return {l: np.argwhere(label == l).astype(np.uint16) for l in labels}
+
+
+class LabelIndexSampler(tio.data.PatchSampler):
+    """
+    random patches centered on the voxels of the labels, drawn with given probabilities.
+    the voxels of each label are indexed once per subject and kept by the sampler, so each patch costs O(1) instead of
+    the probability map and the CDF of tio.LabelSampler. the index is built in the main process before the workers of
+    the patch pipeline start (see Loader3D.patches_per_subject), the workers get it with the sampler.
+    flipped subjects reuse the index of their subject, other spatial augmentations change the position of the
+    labels and their subjects are indexed again on each load.
+    the background label is not indexed (it would store most of the volume): background patches are drawn uniformly.
+    centers close to the borders are moved inside the volume, so each voxel of the labels can be sampled.
+
+    usage:
+        sampler = LabelIndexSampler((80, 80, 80), {0: 0.1, 1: 0.9}, background=0)
+        pipeline = PatchPipeline(subjects, sampler, samples_per_volume, batch_size, patch_shape)
+    """
+
+    def __init__(self, patch_size, label_probabilities, background=0, label_name='label', key='folder'):
+        """
+        Args:
+            patch_size (tuple): Z, H, W of the patches
+            label_probabilities (dict): label -> probability of a patch centered on it, normalized here
+            background (int): background label, sampled uniformly
+            label_name (str): name of the label map in the subjects
+            key (str): name of the attribute identifying the subjects
+        """
+        super().__init__(patch_size)
+        total = sum(label_probabilities.values())
+        if total <= 0:
+            raise Exception(f"label probabilities must have a positive sum, got {label_probabilities}")
+        self.label_probabilities = {label: p / total for label, p in label_probabilities.items() if p > 0}
+        self.background = background
+        self.label_name = label_name
+        self.key = key
+        self.indices = {}
+
+    def index(self, subject):
+        """
+        index of the labels of a subject and the axes flipped with respect to it
+        Args:
+            subject (tio.Subject): subject to be sampled
+
+        Returns:
+            (dict) label -> voxel coordinates, see label_index
+            (list of int) spatial axes to be flipped to move the coordinates on the subject
+        """
+        flipped, reusable = spatial_history(subject)
+        key = subject.get(self.key)
+        if reusable and key in self.indices:
+            return self.indices[key], flipped
+
+        labels = [l for l in self.label_probabilities if l != self.background]
+        index = label_index(subject[self.label_name][tio.DATA][0].numpy(), labels)
+        if not reusable or key is None:
+            return index, []
+        shape = np.array(subject.spatial_shape)
+        for axis in flipped:  # the index is stored for the original subject, flips are involutions
+            for coords in index.values():
+                coords[:, axis] = shape[axis] - 1 - coords[:, axis]
+        self.indices[key] = index
+        return index, flipped
+
+    def _generate_patches(self, subject, num_patches=None):
+        index, flipped = self.index(subject)
+        shape = np.array(subject.spatial_shape)
+        half_patch = self.patch_size.astype(int) // 2
+        max_ini = shape - self.patch_size
+
+        # labels missing in this subject are not drawn
+        labels = [l for l in self.label_probabilities if l == self.background or len(index.get(l, ())) > 0]
+        if not labels:
+            raise Exception(f"subject {subject.get(self.key)} has none of the labels {list(self.label_probabilities)}")
+        probabilities = np.array([self.label_probabilities[l] for l in labels])
+        probabilities /= probabilities.sum()
+
+        patches_left = num_patches if num_patches is not None else True
+        while patches_left:
+            label = labels[np.random.choice(len(labels), p=probabilities)]
+            if label == self.background:
+                index_ini = (np.random.random(3) * (max_ini + 1)).astype(int)
+            else:
+                coords = index[label]
+                center = coords[np.random.randint(len(coords))].astype(int)
+                center[flipped] = shape[flipped] - 1 - center[flipped]
+                index_ini = np.clip(center - half_patch, 0, max_ini)
+            yield self.crop(subject, index_ini, self.patch_size)
+            if num_patches is not None:
+                patches_left -= 1
+
+
+class ForegroundGridSampler(tio.data.PatchSampler):
+    """
+    grid patches without most of the empty ones.
+    grid locations (the same of tio.GridSampler) are split once per subject in foreground and background locations,
+    a location is foreground if the labels are inside the patch grown by margin voxels (a dilated ROI of the canal).
+    each round yields all the foreground patches and a random share of background ones, in random order;
+    rounds are repeated until the pipeline has the patches of the subject (round_size patches are one round).
+    flipped subjects reuse the locations of their subject (flipped), other spatial augmentations are split again.
+
+    usage:
+        sampler = ForegroundGridSampler((80, 80, 80), background_ratio=0.1, margin=8)
+        pipeline = PatchPipeline(subjects, sampler, samples_per_volume, batch_size, patch_shape)
+    """
+
+    def __init__(self, patch_size, patch_overlap=0, background_ratio=0.1, margin=0, background=0, label_name='label',
+                 key='folder'):
+        """
+        Args:
+            patch_size (tuple): Z, H, W of the patches
+            patch_overlap (int or tuple): overlap between neighbour patches, for each axis if tuple
+            background_ratio (float): share of background patches in each round, in [0, 1)
+            margin (int): voxels added around each patch when looking for labels
+            background (int): background label
+            label_name (str): name of the label map in the subjects
+            key (str): name of the attribute identifying the subjects
+        """
+        super().__init__(patch_size)
+        if not 0 <= background_ratio < 1:
+            raise Exception(f"background ratio must be in [0, 1), got {background_ratio}")
+        self.patch_overlap = tuple(patch_overlap) if isinstance(patch_overlap, (list, tuple)) else (patch_overlap,) * 3
+        self.background_ratio = background_ratio
+        self.margin = margin
+        self.background = background
+        self.label_name = label_name
+        self.key = key
+        self.locations = {}
+
+    def split(self, subject):
+        """
+        foreground and background grid locations of a subject
+        Args:
+            subject (tio.Subject): subject to be sampled
+
+        Returns:
+            (numpy array) foreground locations with shape N, 6 (z_ini, y_ini, x_ini, z_fin, y_fin, x_fin)
+            (numpy array) background locations with shape M, 6
+        """
+        flipped, reusable = spatial_history(subject)
+        key = subject.get(self.key)
+        shape = np.array(subject.spatial_shape)
+        if reusable and key in self.locations:
+            foreground, background = self.locations[key]
+        else:
+            label = subject[self.label_name][tio.DATA][0].numpy()
+            locations = patch_locations(shape, self.patch_size.astype(int), self.patch_overlap)
+            grown = np.hstack((np.maximum(locations[:, :3] - self.margin, 0), locations[:, 3:] + self.margin))
+            has_labels = np.array([
+                (label[z0:z1, y0:y1, x0:x1] != self.background).any() for z0, y0, x0, z1, y1, x1 in grown
+            ], bool)
+            foreground, background = locations[has_labels], locations[~has_labels]
+            if not reusable or key is None:
+                return foreground, background
+            # locations are stored for the original subject, flips are involutions
+            foreground, background = self.__flip(foreground, flipped, shape), self.__flip(background, flipped, shape)
+            self.locations[key] = foreground, background
+        return self.__flip(foreground, flipped, shape), self.__flip(background, flipped, shape)
+
+    @staticmethod
+    def __flip(locations, axes, shape):
+        if not axes:
+            return locations
+        locations = locations.copy()
+        for axis in axes:
+            locations[:, [axis, axis + 3]] = shape[axis] - locations[:, [axis + 3, axis]]
+        return locations
+
+    def round_locations(self, subject):
+        """
+        locations of a round of a subject
+        Returns:
+            (numpy array) foreground locations, all of them are in each round
+            (numpy array) background locations to be drawn from
+            (int) background locations drawn in each round
+        """
+        foreground, background = self.split(subject)
+        if len(foreground) == 0:
+            foreground, background = background, background[:0]  # nothing to filter, plain grid
+        num_background = int(round(len(foreground) * self.background_ratio / (1 - self.background_ratio)))
+        return foreground, background, min(num_background, len(background))
+
+    def round_size(self, subject):
+        """
+        patches in a round of a subject, its share of the work in an epoch
+        """
+        foreground, _, num_background = self.round_locations(subject)
+        return len(foreground) + num_background
+
+    def _generate_patches(self, subject, num_patches=None):
+        foreground, background, num_background = self.round_locations(subject)
+
+        patches_left = num_patches if num_patches is not None else True
+        while patches_left:
+            chosen = background[np.random.choice(len(background), num_background, replace=False)]
+            locations = np.concatenate((foreground, chosen))
+            for location in locations[np.random.permutation(len(locations))]:
+                yield self.crop(subject, location[:3], self.patch_size)
+                if num_patches is not None:
+                    patches_left -= 1
+                    if not patches_left:
+                        return
@@ -4,6 +4,124 @@ from torch import nn
 import torch.nn.functional as F
 
 
+class Logits:
+    """
+    logits and labels of a batch as flat views, shared by all the losses of LossFn (the sigmoid is computed once).
+    labels are never one-hot encoded and are kept in their dtype (uint8 from the patch pipeline): the losses gather
+    the values of the true class and reduce each class with scatter_add, indexing with the labels.
+    """
+
+    def __init__(self, pred, gt):
+        """
+        Args:
+            pred (torch.Tensor): logits with shape B, C, Z, H, W
+            gt (torch.Tensor): labels with shape B, 1, Z, H, W (or B, Z, H, W)
+        """
+        self.pred = pred
+        self.gt = gt
+        self.cache = {}
+
+    @property
+    def classes(self):
+        return self.pred.shape[1]
+
+    @property
+    def flat(self):
+        """
+        (torch.Tensor) logits with shape B, C, N
+        """
+        return self.pred.reshape(*self.pred.shape[:2], -1)
+
+    @property
+    def labels(self):
+        """
+        (torch.Tensor) labels with shape B, 1, N
+        """
+        return self.gt.reshape(self.pred.shape[0], 1, -1)
+
+    @property
+    def sigmoid(self):
+        if 'sigmoid' not in self.cache:
+            self.cache['sigmoid'] = torch.sigmoid(self.flat)
+        return self.cache['sigmoid']
+
+
+def class_sum(values, index, classes):
+    """
+    Args:
+        values (torch.Tensor): a value for each voxel, shape B, N
+        index (torch.Tensor): int64 labels, shape B, N
+        classes (int): number of classes
+
+    Returns:
+        (torch.Tensor) sum of the values of the voxels of each class, shape B, C
+    """
+    sums = torch.zeros((values.shape[0], classes), dtype=values.dtype, device=values.device)
+    return sums.scatter_add_(1, index, values)
+
+
+class LabelBCEWithLogits(torch.autograd.Function):
+    """
+    mean binary cross entropy of logits B, C, N against the one-hot encoding of labels B, 1, N, without the one-hot:
+    an element with y = 0 costs softplus(x), with y = 1 pos_weight * softplus(-x). only logits and labels are saved,
+    the gradient sigmoid(x) - y is computed in the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, x, labels, pos_weight=None):
+        index = labels.long()
+        true = x.gather(1, index)
+        positive = F.softplus(-true)
+        if pos_weight is not None:
+            positive = positive * pos_weight[index]
+        ctx.save_for_backward(x, labels)
+        ctx.pos_weight = pos_weight
+        return (F.softplus(x).sum() + (positive - F.softplus(true)).sum()) / x.numel()
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, labels = ctx.saved_tensors
+        index = labels.long()
+        grad_x = torch.sigmoid(x)
+        true = grad_x.gather(1, index) - 1
+        if ctx.pos_weight is not None:
+            true = true * ctx.pos_weight[index]
+        grad_x.scatter_(1, index, true)
+        return grad_x.mul_(grad / x.numel()), None, None
+
+
+class SoftDice(torch.autograd.Function):
+    """
+    1 - soft dice of each class of each volume from logits B, C, N and labels B, 1, N, without the one-hot:
+    the intersection sums the probabilities of the true class over the voxels of each class, the cardinality
+    is the sum of the probabilities plus the voxels of each class. only logits and labels are saved, the softmax
+    is computed again in the backward pass.
+    """
+
+    @staticmethod
+    def forward(ctx, x, labels, eps=1e-06):
+        index = labels.long()[:, 0]
+        probs = F.softmax(x, dim=1)
+        intersection = class_sum(probs.gather(1, index[:, None])[:, 0], index, x.shape[1])
+        cardinality = probs.sum(dim=2) + class_sum(torch.ones_like(probs[:, 0]), index, x.shape[1]) + eps
+        ctx.save_for_backward(x, labels, intersection, cardinality)
+        return 1. - 2. * intersection / cardinality
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, labels, intersection, cardinality = ctx.saved_tensors
+        index = labels.long()[:, 0]
+        # d loss / d probs: every voxel through the cardinality, plus the voxels of each class through the intersection
+        every = grad * 2. * intersection / cardinality ** 2
+        own = -grad * 2. / cardinality
+        probs = F.softmax(x, dim=1)
+        grad_probs = every[:, :, None].expand_as(probs).clone()
+        grad_probs.scatter_add_(1, index[:, None], own.gather(1, index)[:, None])
+        # softmax backward
+        grad_probs -= (probs * grad_probs).sum(dim=1, keepdim=True)
+        return grad_probs.mul_(probs), None, None
+
+
 class JaccardLoss(torch.nn.Module):
     def __init__(self, weight=None, size_average=True, per_volume=False, apply_sigmoid=False,
                  min_pixels=5):
@@ -19,6 +137,14 @@ class JaccardLoss(torch.nn.Module):
             pred = torch.sigmoid(pred)
         return self.jaccard(pred, target)
 
+    def reduce(self, logits):
+        """
+        loss of the binary prediction of a batch, see Logits
+        """
+        assert logits.classes == 1, 'this loss works with a binary prediction'
+        outputs = logits.sigmoid if self.apply_sigmoid else logits.flat
+        return self.jaccard(outputs, logits.labels)
+
     def jaccard(self, outputs, targets):
         batch_size = outputs.size()[0]
         eps = 1e-3
@@ -32,30 +158,49 @@ class JaccardLoss(torch.nn.Module):
 
 
 class DiceLoss(nn.Module):
-    def __init__(self, classes, device, partition_weights):
+    """
+    soft dice of each class of each volume from the logits, see SoftDice
+    """
+
+    def __init__(self, classes):
+        """
+        Args:
+            classes (dict): labels of the config, the UNLABELED class is not part of the loss
+        """
         super().__init__()
         self.eps = 1e-06
-        self.classes = classes
-        self.device = device
-        self.weights = partition_weights
-        self.weights = self.weights.to(self.device)
+        self.included = [v for k, v in classes.items() if k not in ['UNLABELED']]
 
     def forward(self, pred, gt):
-        included = [v for k, v in self.classes.items() if k not in ['UNLABELED']]
-        gt_onehot = torch.nn.functional.one_hot(gt.squeeze().long(), num_classes=len(self.classes))
-        if gt.shape[0] == 1:  # we need to add a further axis after the previous squeeze()
-            gt_onehot = gt_onehot.unsqueeze(0)
+        return self.reduce(Logits(pred, gt))
 
-        gt_onehot = torch.movedim(gt_onehot, -1, 1)
-        input_soft = F.softmax(pred, dim=1)
-        dims = (2, 3, 4)
+    def reduce(self, logits):
+        """
+        Returns:
+            (torch.Tensor) loss with shape B, included classes
+        """
+        return SoftDice.apply(logits.flat, logits.labels, self.eps)[:, self.included]
 
-        intersection = torch.sum(input_soft * gt_onehot, dims)
-        cardinality = torch.sum(input_soft + gt_onehot, dims)
-        dice_score = 2. * intersection / (cardinality + self.eps)
-        assert self.weights.shape[0] == dice_score.shape[0], "weights should have size of batch size"
-        dice_score = self.weights * dice_score
-        return 1. - dice_score[:, included]
+
+class LabelBCEWithLogitsLoss(nn.Module):
+    """
+    nn.BCEWithLogitsLoss of the logits against the one-hot encoding of integer labels, see LabelBCEWithLogits
+    """
+
+    def __init__(self, pos_weight=None):
+        """
+        Args:
+            pos_weight (torch.Tensor): weight of the positive examples of each class, as for nn.BCEWithLogitsLoss
+        """
+        super().__init__()
+        self.register_buffer('pos_weight', pos_weight)
+
+    def forward(self, pred, gt):
+        return self.reduce(Logits(pred, gt))
+
+    def reduce(self, logits):
+        pos_weight = self.pos_weight.to(logits.pred.device) if self.pos_weight is not None else None
+        return LabelBCEWithLogits.apply(logits.flat, logits.labels, pos_weight)
 
 
 def one_hot_encode(volume, shape, device):
@@ -67,6 +212,12 @@ def one_hot_encode(volume, shape, device):
 
 
 class LossFn:
+    """
+    sum of the losses listed in the config. loss modules are built once, the losses of a step share the views and
+    the sigmoid of their batch (see Logits); labels are not one-hot encoded.
+    each loss is weighted by partition_weights (one weight for each volume) and averaged.
+    """
+
     def __init__(self, loss_config, loader_config, weights):
 
         if not isinstance(loss_config['name'], list):
@@ -76,41 +227,33 @@ class LossFn:
         self.loader_config = loader_config
         self.classes = loader_config['labels']
         self.weights = weights
+        self.losses = {name: self.factory_loss(name) for name in self.name}
 
-    def factory_loss(self, pred, gt, name, partition_weights):
+    def factory_loss(self, name):
 
         if name == 'CrossEntropyLoss':
-            pred = torch.nn.Sigmoid()(pred)  # sigmoid here which is already built-in in other losses
-            loss_fn = nn.CrossEntropyLoss(weight=self.weights).to(self.device)
+            return nn.CrossEntropyLoss(weight=self.weights)
         elif name == 'BCEWithLogitsLoss':
-            if pred.shape[1] == 1:
-                pred = pred.squeeze()
-                gt = gt.float()
-                loss_fn = nn.BCEWithLogitsLoss(pos_weight=1/self.weights[0]).to(self.device)
-            else:
-                # one hot encoding for cross entropy with digits. Bx1xHxW -> BxCxHxW
-                B, C, Z, H, W = pred.shape
-                gt_flat = gt.reshape(-1).unsqueeze(dim=1)  # 1xB*Z*H*W
-
-                gt_onehot = torch.zeros(size=(B * Z * H * W, C), dtype=torch.float).to(self.device)  # 1xB*Z*H*W destination tensor
-                gt_onehot.scatter_(1, gt_flat, 1)  # writing the conversion in the destination tensor
-
-                gt = torch.squeeze(gt_onehot).reshape(B, Z, H, W, C)  # reshaping to the original shape
-                pred = pred.permute(0, 2, 3, 4, 1)  # for BCE we want classes in the last axis
-                loss_fn = nn.BCEWithLogitsLoss(pos_weight=self.weights).to(self.device)
+            return LabelBCEWithLogitsLoss(pos_weight=self.weights)
         elif name == 'Jaccard':
-            assert pred.shape[1] == 1, 'this loss works with a binary prediction'
-            loss_fn = JaccardLoss(weight=self.weights, apply_sigmoid=True, per_volume=True)
+            return JaccardLoss(weight=self.weights, apply_sigmoid=True, per_volume=True)
         elif name == 'DiceLoss':
-            # pred = torch.argmax(torch.nn.Softmax(dim=1)(pred), dim=1)
-            # pred = pred.data.cpu().numpy()
-            # gt = gt.cpu().numpy()
-            loss_fn = DiceLoss(self.classes, self.device, partition_weights)
+            return DiceLoss(self.classes)
         else:
             raise Exception("specified loss function cant be found.")
 
-        loss = loss_fn(pred, gt)
-        loss = loss * partition_weights
+    def compute(self, logits, name, partition_weights):
+        loss_fn = self.losses[name]
+        if name == 'CrossEntropyLoss':
+            loss_fn.to(logits.pred.device)
+            # sigmoid here which is already built-in in other losses
+            loss = loss_fn(torch.sigmoid(logits.flat), logits.labels[:, 0].long())
+        elif name == 'BCEWithLogitsLoss' and logits.classes == 1:
+            pos_weight = None if self.weights is None else 1 / self.weights[0]
+            loss = F.binary_cross_entropy_with_logits(logits.flat, logits.labels.to(logits.flat.dtype), pos_weight=pos_weight)
+        else:
+            loss = loss_fn.reduce(logits)
+        loss = loss * partition_weights.reshape(-1, *[1] * (loss.ndim - 1)) if loss.ndim else loss * partition_weights
         return loss.mean()
 
     def __call__(self, pred, gt, partition_weights):
@@ -123,9 +266,10 @@ class LossFn:
         assert pred.device == gt.device
         assert gt.device != 'cpu'
 
+        logits = Logits(pred.float(), gt)  # losses are computed in fp32, also when the forward pass is autocast
         cur_loss = []
         for name in self.name:
-            loss = self.factory_loss(pred, gt, name, partition_weights)
+            loss = self.compute(logits, name, partition_weights)
             if torch.isnan(loss):
                 raise ValueError('Loss is nan during training...')
             cur_loss.append(loss)
@@ -7,6 +7,7 @@ from torch.utils.tensorboard import SummaryWriter
 import utils
 from loaders.dataset3D import Loader3D
 from eval import Eval as Evaluator
+from inference import SlidingWindow
 from losses import LossFn
 from test import test3D, test2D
 import sys
@@ -18,7 +19,8 @@ from torch.backends import cudnn
 from torch.utils.data import DistributedSampler
 import torch
 import logging
-from train import train3D, train2D
+from train import train3D, train2D, MixedPrecision
+from profiler import StepProfiler
 from torch import nn
 import torchio as tio
 import torch.distributed as dist
@@ -52,6 +54,16 @@ def main(experiment_name, args):
     train_config = config.get('trainer', None)
 
     model, dataset_type = utils.load_model(config)
+
+    # autocast and memory format of the 3D training step, see train.MixedPrecision
+    precision = MixedPrecision(
+        amp=train_config.get('amp', False),
+        dtype=train_config.get('amp_dtype', None),
+        channels_last=train_config.get('channels_last', False) and dataset_type == '3D',
+    )
+    model = precision.prepare(model)
+    logging.info(f"training precision: {precision}")
+
     # DDP setting
     world_size = 1
     rank = 0
@@ -103,7 +115,11 @@ def main(experiment_name, args):
     else:
         scheduler = None
 
-    evaluator = Evaluator(loader_config, project_dir, skip_dump=args.skip_dump)
+    evaluator = Evaluator(loader_config, project_dir, skip_dump=args.skip_dump, rank=rank, world_size=world_size)
+
+    # sliding window settings for validation and test, see inference.py
+    inference_config = {'batch_size': loader_config['batch_size'], **config.get('inference', {})}
+    engine = SlidingWindow(loader_config['patch_shape'], **inference_config) if dataset_type == '3D' else None
 
     loss = LossFn(config.get('loss'), loader_config, weights=None)  # TODO: fix this, weights are disabled now
 
@@ -111,9 +127,14 @@ def main(experiment_name, args):
     if train_config['checkpoint_path'] is not None:
         try:
             checkpoint = torch.load(train_config['checkpoint_path'])
-            model.load_state_dict(checkpoint['state_dict'])
+            state_dict, folded = utils.fold_input_channels(checkpoint['state_dict'], model)
+            model.load_state_dict(state_dict)
             start_epoch = checkpoint['epoch'] + 1
-            optimizer.load_state_dict(checkpoint['optimizer'])
+            if folded:
+                # moments of the optimizer do not match the folded weights, the optimizer starts from scratch
+                logging.info(f"RGB weights folded to a single input channel: {folded}")
+            else:
+                optimizer.load_state_dict(checkpoint['optimizer'])
             logging.info(f"Checkpoint loaded successfully at epoch {start_epoch}, score:{checkpoint.get('metric', 'unavailable')})")
         except OSError as e:
             logging.info("No checkpoint exists from '{}'. Skipping...".format(train_config['checkpoint_path']))
@@ -128,6 +149,15 @@ def main(experiment_name, args):
         else:
             writer = None
 
+        # stage timings of the 3D training steps, torch.profiler traces are saved next to the tensorboard logs
+        profiler = StepProfiler(
+            enabled=train_config.get('profile', False),
+            device=next(model.parameters()).device,
+            sync=train_config.get('profile_sync', True),
+            trace_dir=os.path.join(config['tb_dir'], experiment_name, 'trace') if rank == 0 else None,
+            trace_steps=train_config.get('profile_trace', 0),
+        )
+
         # warm_up = np.ones(shape=train_config['epochs'])
         # warm_up[0:int(train_config['epochs'] * train_config.get('warm_up_length', 0.35))] = np.linspace(
         #     0, 1, num=int(train_config['epochs'] * train_config.get('warm_up_length', 0.35))
@@ -138,23 +168,26 @@ def main(experiment_name, args):
 
         for epoch in range(start_epoch, train_config['epochs']):
 
+            if dataset_type == '3D':
+                train_loader.set_epoch(epoch)  # order and ranks of the subjects, the same on each run and after a reload
             if is_distributed:
-                train_loader.sampler.set_epoch(np.random.seed(np.random.randint(0, 10000)))
                 dist.barrier()
 
             if dataset_type == '2D':
                 train2D(model, train_loader, loss, optimizer, epoch, writer, evaluator, phase="Train")
             else:
-                train3D(model, train_loader, loss, optimizer, epoch, writer, evaluator, phase="Train")
+                train3D(model, train_loader, loss, optimizer, epoch, writer, evaluator, phase="Train", precision=precision,
+                        augment=train_loader.augment, profiler=profiler)
 
-            if rank == 0:
+            # 3D subjects are split among the ranks and their metrics gathered, every rank gets the same scores
+            if dataset_type == '3D' or rank == 0:
                 val_model = model.module
                 if dataset_type == '2D':
                     val_iou, val_dice, val_haus = test2D(val_model, val_loader, epoch, writer, evaluator, "Validation", splitter)
                 else:
-                    val_iou, val_dice, val_haus = test3D(val_model, val_loader, epoch, writer, evaluator, phase="Validation")
+                    val_iou, val_dice, val_haus = test3D(val_model, val_loader, epoch, writer, evaluator, phase="Validation", engine=engine)
 
-                if val_iou < 1e-05 and epoch > 15:
+                if val_iou < 1e-05 and epoch > 15 and rank == 0:
                     logging.info('WARNING: drop in performances detected.')
 
                 if scheduler is not None:
@@ -163,27 +196,31 @@ def main(experiment_name, args):
                     else:
                         scheduler.step(epoch)
 
-                save_weights(epoch, model, optimizer, val_iou, os.path.join(project_dir, 'checkpoints', 'last.pth'))
+                if rank == 0:
+                    save_weights(epoch, model, optimizer, val_iou, os.path.join(project_dir, 'checkpoints', 'last.pth'))
 
                 if val_iou > best_val:
                     best_val = val_iou
-                    save_weights(epoch, model, optimizer, best_val, os.path.join(project_dir, 'best.pth'))
+                    if rank == 0:
+                        save_weights(epoch, model, optimizer, best_val, os.path.join(project_dir, 'best.pth'))
 
                 if epoch % 5 == 0 and epoch != 0:
                     if dataset_type == '2D':
                         test_iou, _, _ = test2D(model, test_loader, epoch, writer, evaluator, "Test", splitter)
                     else:
-                        test_iou, _, _ = test3D(val_model, test_loader, epoch, writer, evaluator, phase="Test")
+                        test_iou, _, _ = test3D(val_model, test_loader, epoch, writer, evaluator, phase="Test", engine=engine)
                     best_test = best_test if best_test > test_iou else test_iou
 
         logging.info('BEST TEST METRIC IS {}'.format(best_test))
+        if dataset_type == '3D':
+            train_loader.close()
 
-    if rank == 0:
+    if dataset_type == '3D' or rank == 0:
         val_model = model.module
         if dataset_type == '2D':
             test2D(val_model, test_loader, epoch="Final", writer=None, evaluator=evaluator, phase="Final", splitter=splitter)
         else:
-            test3D(val_model, test_loader, epoch="Final", writer=None, evaluator=evaluator, phase="Final")
+            test3D(val_model, test_loader, epoch="Final", writer=None, evaluator=evaluator, phase="Final", engine=engine)
 
 
 if __name__ == '__main__':
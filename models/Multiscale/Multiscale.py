@@ -72,6 +72,7 @@ class Multiscale3D(nn.Module):
         )
 
     def forward(self, x):
+        x = x.expand(-1, 3, -1, -1, -1)  # single channel volumes are broadcast to the RGB stem of the video resnets
         out, low_level = self.resnet(x)
         out = self.mslayer(out)
 
@@ -92,6 +93,7 @@ class MultiscaleM3D(Multiscale3D):
         super().__init__(backbone='ResNetM3D', num_classes=num_classes)
 
     def forward(self, x):
+        x = x.expand(-1, 3, -1, -1, -1)  # single channel volumes are broadcast to the RGB stem of the video resnets
         out, low_level = self.resnet(x)
         out = self.mslayer(out)
 
@@ -77,6 +77,7 @@ class UNet(nn.Module):
 
     def forward(self, x):
 
+        x = x.expand(-1, self.in_ch, -1, -1)  # single channel slices are broadcast to the input channels
         enc1 = self.enc1(x)
         enc2 = self.enc2(enc1)
         enc3 = self.enc3(enc2)
@@ -1,5 +1,6 @@
 import torch 
 import torch.nn as nn
+from models.checkpointing import enable_checkpointing
 
 
 def initialize_weights(*models):
@@ -15,11 +16,12 @@ def initialize_weights(*models):
 
 
 class padUNet3D(nn.Module):
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, in_ch=3, checkpointing=None):
         self.n_classes = n_classes
+        self.in_ch = in_ch
 
         super(padUNet3D, self).__init__()
-        self.ec0 = self.conv3Dblock(3, 32)
+        self.ec0 = self.conv3Dblock(in_ch, 32)
         self.ec1 = self.conv3Dblock(32, 64, kernel_size=3, padding=1)  # third dimension to even val
         self.ec2 = self.conv3Dblock(64, 64)
         self.ec3 = self.conv3Dblock(64, 128)
@@ -43,6 +45,7 @@ class padUNet3D(nn.Module):
         self.dc1 = self.conv3Dblock(64, 64, kernel_size=3, stride=1, padding=1)
         self.final = nn.ConvTranspose3d(64, n_classes, kernel_size=3, padding=1, stride=1)
         initialize_weights(self)
+        self.checkpointed = enable_checkpointing(self, checkpointing)
 
     def conv3Dblock(self, in_channels, out_channels, kernel_size=(3, 3, 3), stride=1, padding=(1, 1, 1)):
         return nn.Sequential(
@@ -52,6 +55,7 @@ class padUNet3D(nn.Module):
         )
 
     def forward(self, x, _):
+        x = x.expand(-1, self.in_ch, -1, -1, -1)  # single channel volumes are broadcast to the input channels
         h = self.ec0(x)
         feat_0 = self.ec1(h)
         h = self.pool0(feat_0)
@@ -78,18 +82,19 @@ class padUNet3D(nn.Module):
         h = torch.cat((self.dc3(h), feat_0), dim=1)
         h = self.dc2(h)
         h = self.dc1(h)
-        return self.final(h.float())
+        return self.final(h)
 
 
 class PositionalpadUNet3D(nn.Module):
 
-    def __init__(self, n_classes, emb_shape):
+    def __init__(self, n_classes, emb_shape, in_ch=3, checkpointing=None):
         self.n_classes = n_classes
+        self.in_ch = in_ch
         super(PositionalpadUNet3D, self).__init__()
 
         self.emb_shape = torch.as_tensor(emb_shape)
         self.pos_emb_layer = nn.Linear(6, torch.prod(self.emb_shape).item())
-        self.ec0 = self.conv3Dblock(3, 32)
+        self.ec0 = self.conv3Dblock(in_ch, 32)
         self.ec1 = self.conv3Dblock(32, 64, kernel_size=3, padding=1)  # third dimension to even val
         self.ec2 = self.conv3Dblock(64, 64)
         self.ec3 = self.conv3Dblock(64, 128)
@@ -113,6 +118,7 @@ class PositionalpadUNet3D(nn.Module):
         self.dc1 = self.conv3Dblock(64, 64, kernel_size=3, stride=1, padding=1)
         self.final = nn.ConvTranspose3d(64, n_classes, kernel_size=3, padding=1, stride=1)
         initialize_weights(self)
+        self.checkpointed = enable_checkpointing(self, checkpointing)
 
     def conv3Dblock(self, in_channels, out_channels, kernel_size=(3, 3, 3), stride=1, padding=(1, 1, 1)):
         return nn.Sequential(
@@ -122,6 +128,7 @@ class PositionalpadUNet3D(nn.Module):
         )
 
     def forward(self, x, emb_codes):
+        x = x.expand(-1, self.in_ch, -1, -1, -1)  # single channel volumes are broadcast to the input channels
         h = self.ec0(x)
         feat_0 = self.ec1(h)
         h = self.pool0(feat_0)
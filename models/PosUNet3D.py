@@ -1,11 +1,13 @@
 import torch
 import torch.nn as nn
+from models.checkpointing import enable_checkpointing
 
 class PosUNet3D(nn.Module):
 
-    def __init__(self, n_classes, emb_shape):
+    def __init__(self, n_classes, emb_shape, in_ch=3, checkpointing=None):
         self.n_classes = n_classes
         super(PosUNet3D, self).__init__()
+        self.in_ch = in_ch
         Z, H, W = emb_shape
         feature_emb = Z * H * W
 
@@ -14,7 +16,7 @@ class PosUNet3D(nn.Module):
         # replace 1 with emb_voxel and emb_channels with 1 to have a weight for each emb_voxel instead of channels
         self.pos_emb_layer = nn.Linear(6, emb_channels)  # (pos_size, emb_channels, 1)
 
-        self.ec0 = self.conv3Dblock(3, 32)
+        self.ec0 = self.conv3Dblock(in_ch, 32)
         self.ec1 = self.conv3Dblock(32, 64, kernel_size=3, padding=1)  # third dimension to even val
         self.ec2 = self.conv3Dblock(64, 64)
         self.ec3 = self.conv3Dblock(64, 128)
@@ -37,6 +39,7 @@ class PosUNet3D(nn.Module):
         self.dc2 = self.conv3Dblock(64 + 128, 64, kernel_size=3, stride=1, padding=1)
         self.dc1 = self.conv3Dblock(64, 64, kernel_size=3, stride=1, padding=1)
         self.final = nn.ConvTranspose3d(64, n_classes, kernel_size=3, padding=1, stride=1)
+        self.checkpointed = enable_checkpointing(self, checkpointing)
 
     def conv3Dblock(self, in_channels, out_channels, kernel_size=(3, 3, 3), stride=1, padding=(1, 1, 1)):
         return nn.Sequential(
@@ -46,6 +49,7 @@ class PosUNet3D(nn.Module):
         )
 
     def forward(self, x, position):
+        x = x.expand(-1, self.in_ch, -1, -1, -1)  # single channel volumes are broadcast to the input channels
         h = self.ec0(x)
         feat_0 = self.ec1(h)
         h = self.pool0(feat_0)
@@ -115,6 +115,7 @@ class TransformerBTS(nn.Module):
 
     def forward(self, x, pos, auxillary_output_layers=[1, 2, 3, 4]):
 
+        x = x.expand(-1, self.num_channels, -1, -1, -1)  # single channel volumes are broadcast to the input channels
         x1_1, x2_1, x3_1, encoder_output, intmd_encoder_outputs = self.encode(x)
 
         decoder_output = self.decode(
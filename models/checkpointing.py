@@ -0,0 +1,67 @@
+import re
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+GRANULARITY = {
+    'all': r'(ec|dc)\d+',
+    'encoder': r'ec\d+',
+    'decoder': r'dc\d+',
+}
+
+
+class CheckpointedBlock(nn.Sequential):
+    """
+    conv3Dblock whose activations are dropped after the forward pass and recomputed in the backward pass.
+    the children are the same of the original block, so the names of the weights do not change.
+    batch norm running stats are restored after the recomputation, so they are updated once per step as without checkpoints.
+    """
+
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()):
+            return super().forward(x)
+
+        calls = []
+
+        def run(x):
+            if not calls:
+                calls.append(True)
+                return nn.Sequential.forward(self, x)
+            # recomputation during the backward pass, it can be stopped early by torch as soon as the needed
+            # activations are available, buffers are restored in any case
+            buffers = [buffer.clone() for buffer in self.buffers()]
+            try:
+                return nn.Sequential.forward(self, x)
+            finally:
+                with torch.no_grad():
+                    for buffer, saved in zip(self.buffers(), buffers):
+                        buffer.copy_(saved)
+
+        return checkpoint(run, x, use_reentrant=False)
+
+
+def enable_checkpointing(model, blocks):
+    """
+    activation checkpointing for the conv3Dblocks (ec* and dc* layers) of the 3D UNets.
+    memory of the activations goes down to the inputs of the checkpointed blocks, at the cost of a second forward pass
+    of those blocks during the backward. high resolution blocks (ec0, ec1, dc2, dc1) hold most of the memory.
+    Args:
+        model (torch.nn.Module): model with conv3Dblocks as children
+        blocks (str or list of str): 'all', 'encoder', 'decoder' or the names of the blocks, None disables checkpointing
+
+    Returns:
+        (list of str) names of the checkpointed blocks
+    """
+    if not blocks:
+        return []
+    candidates = [name for name, module in model.named_children() if isinstance(module, nn.Sequential)]
+    if isinstance(blocks, str):
+        if blocks not in GRANULARITY:
+            raise Exception(f"checkpointing {blocks} not supported, use one of {list(GRANULARITY)} or a list of blocks")
+        blocks = [name for name in candidates if re.fullmatch(GRANULARITY[blocks], name)]
+    unknown = [name for name in blocks if name not in candidates]
+    if unknown:
+        raise Exception(f"blocks {unknown} can not be checkpointed, available blocks are {candidates}")
+    for name in blocks:
+        setattr(model, name, CheckpointedBlock(*getattr(model, name)))
+    return list(blocks)
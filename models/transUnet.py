@@ -1,12 +1,14 @@
 import torch
 import torch.nn as nn
 from models.Multiscale.transformer import ViT_positional
+from models.checkpointing import enable_checkpointing
 
 
 class TransUNet3D(nn.Module):
 
-    def __init__(self, n_classes, emb_shape):
+    def __init__(self, n_classes, emb_shape, in_ch=3, checkpointing=None):
         self.n_classes = n_classes
+        self.in_ch = in_ch
         super(TransUNet3D, self).__init__()
         Z, H, W = emb_shape
 
@@ -23,7 +25,7 @@ class TransUNet3D(nn.Module):
             emb_dropout=0.1
         )
 
-        self.ec0 = self.conv3Dblock(3, 32)
+        self.ec0 = self.conv3Dblock(in_ch, 32)
         self.ec1 = self.conv3Dblock(32, 64, kernel_size=3, padding=1)  # third dimension to even val
         self.ec2 = self.conv3Dblock(64, 64)
         self.ec3 = self.conv3Dblock(64, 128)
@@ -46,6 +48,7 @@ class TransUNet3D(nn.Module):
         self.dc2 = self.conv3Dblock(64 + 128, 64, kernel_size=3, stride=1, padding=1)
         self.dc1 = self.conv3Dblock(64, 64, kernel_size=3, stride=1, padding=1)
         self.final = nn.ConvTranspose3d(64, n_classes, kernel_size=3, padding=1, stride=1)
+        self.checkpointed = enable_checkpointing(self, checkpointing)
 
     def conv3Dblock(self, in_channels, out_channels, kernel_size=(3, 3, 3), stride=1, padding=(1, 1, 1)):
         return nn.Sequential(
@@ -55,6 +58,7 @@ class TransUNet3D(nn.Module):
         )
 
     def forward(self, x, position):
+        x = x.expand(-1, self.in_ch, -1, -1, -1)  # single channel volumes are broadcast to the input channels
         h = self.ec0(x)
         feat_0 = self.ec1(h)
         h = self.pool0(feat_0)
@@ -0,0 +1,207 @@
+"""
+batch inference over a folder of DICOMDIRs, no split file, ground truth or evaluation needed.
+for each patient the predicted labels are saved as npy and the canal is written back as DICOM overlay.
+decoding of the next patient and the export of the previous one overlap with the inference of the current one.
+a patient which fails is logged and skipped, the exit code is 1 if any patient failed.
+
+usage:
+    python predict.py --config config.yaml --checkpoint best.pth --input /path/to/patients --output /path/to/results
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from torch import nn
+from Jaw import Jaw
+from augmentations import Geometry
+from dicom_loader import DICOM_WORKERS
+from inference import SlidingWindow
+import processing
+import utils
+
+
+def find_dicomdirs(root):
+    """
+    Args:
+        root (str): folder to scan recursively, or a DICOMDIR file
+
+    Returns:
+        (list of str) sorted paths to the DICOMDIR files
+    """
+    if os.path.basename(root).lower() == 'dicomdir':
+        return [root]
+    return sorted(
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(root)
+        for filename in filenames if filename.lower() == 'dicomdir'
+    )
+
+
+def load_patient(dicomdir_path, loader_config, num_workers):
+    """
+    decode a patient and apply the preprocessing of Loader3D (clip + rescale to [0-1], background suppression if
+    enabled in the config, crop/pad to resize_shape)
+    Args:
+        dicomdir_path (str): path to the DICOMDIR file
+        loader_config (dict): data-loader section of the config
+        num_workers (int): decoding threads
+
+    Returns:
+        (Jaw) jaw object, dicom files are kept to write the overlays
+        (numpy array) preprocessed volume with shape 1, Z, H, W
+    """
+    jaw = Jaw(dicomdir_path, parallel=True, num_workers=num_workers)
+    dicom_max = loader_config.get('volumes_max', 2100)
+    dicom_min = loader_config.get('volumes_min', 0)
+    reshape_size = tuple(loader_config.get('resize_shape', (152, 224, 256)))
+
+    data = jaw.get_volume()
+    mask = None
+    if loader_config.get('background_suppression', False):
+        mask = utils.volume_suppression_mask(data, dicom_min, dicom_max, name=dicomdir_path)
+    data = processing.normalize_volume(data, dicom_min, dicom_max, mask=mask)
+    data = Geometry(data.shape, reshape_size)(data)
+    return jaw, data[None]
+
+
+def predict(model, engine, jaw, data):
+    """
+    Args:
+        model (torch.nn.Module): network in eval mode
+        engine (SlidingWindow): inference engine
+        jaw (Jaw): jaw of the patient
+        data (numpy array): preprocessed volume with shape 1, Z, H, W
+
+    Returns:
+        (numpy array) uint8 predicted labels with the shape of the jaw volume
+    """
+    output = engine(model, data)  # C, Z, H, W
+    # inverse of the crop/pad of load_patient, pad_val = min(output) since we are dealing with probabilities
+    output = Geometry((jaw.Z, jaw.H, jaw.W), output.shape[-3:]).inverse()(output).squeeze()
+    if output.ndim > 3:
+        return torch.argmax(output, dim=0).numpy().astype(np.uint8)
+    return (nn.Sigmoid()(output) > .5).numpy().astype(np.uint8)
+
+
+def output_folder(dicomdir_path, input_root, output_root):
+    """
+    folder of the results of a patient, the layout of the input folder is replicated in the output one
+    """
+    patient_dir = os.path.dirname(os.path.abspath(dicomdir_path))
+    if os.path.isdir(input_root):
+        return os.path.join(output_root, os.path.relpath(patient_dir, start=os.path.abspath(input_root)))
+    return os.path.join(output_root, os.path.basename(patient_dir))
+
+
+def export(jaw, prediction, patient_dir, background, skip_dicom):
+    """
+    save the predicted labels as npy and the canal (all the labels but background) as overlay of the dicom files
+    Args:
+        jaw (Jaw): jaw of the patient
+        prediction (numpy array): predicted labels with the shape of the jaw volume
+        patient_dir (str): destination folder
+        background (int): background label
+        skip_dicom (bool): if true the dicom files are not exported
+
+    Returns:
+        (str) destination folder
+    """
+    os.makedirs(patient_dir, exist_ok=True)
+    np.save(os.path.join(patient_dir, 'prediction.npy'), prediction)
+    if not skip_dicom:
+        jaw.set_overlay((prediction != background).astype(np.uint8), overlay_desc="Prediction")
+        jaw.save_dicom(os.path.join(patient_dir, 'DICOM'))
+    return patient_dir
+
+
+def wait_export(pending_export):
+    """
+    wait for the export of a patient, failures are logged
+    Args:
+        pending_export (tuple): dicomdir path of the patient and future of export
+
+    Returns:
+        (bool) true if the results were saved
+    """
+    dicomdir_path, future = pending_export
+    try:
+        logging.info(f"results saved in {future.result()}")
+        return True
+    except Exception as e:
+        logging.info(f"export of {dicomdir_path} failed: {e}")
+        return False
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--config', required=True, help='yaml config of the experiment')
+    arg_parser.add_argument('--checkpoint', required=True, help='path to the weights, e.g. best.pth')
+    arg_parser.add_argument('--input', required=True, help='folder with the DICOMDIRs of the patients (searched recursively)')
+    arg_parser.add_argument('--output', required=True, help='results folder, the layout of the input folder is kept')
+    arg_parser.add_argument('--workers', type=int, default=DICOM_WORKERS, help='threads decoding each DICOM series')
+    arg_parser.add_argument('--skip_dicom', action='store_true', help='save just the npy predictions, default: false')
+    args = arg_parser.parse_args()
+
+    utils.set_logger()
+    config = utils.load_config_yaml(args.config)
+    loader_config = config['data-loader']
+
+    model, dataset_type = utils.load_model(config)
+    if dataset_type != '3D':
+        raise Exception("batch inference is available for the 3D models only")
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    checkpoint = torch.load(args.checkpoint, map_location=device)
+    state_dict = {k[len('module.'):] if k.startswith('module.') else k: v for k, v in checkpoint['state_dict'].items()}
+    state_dict, _ = utils.fold_input_channels(state_dict, model)
+    model.load_state_dict(state_dict)
+    model = model.to(device).eval()
+
+    inference_config = {'batch_size': loader_config['batch_size'], **config.get('inference', {})}
+    engine = SlidingWindow(loader_config['patch_shape'], device=device, **inference_config)
+
+    dicomdirs = find_dicomdirs(args.input)
+    logging.info(f"found {len(dicomdirs)} DICOMDIR in {args.input}")
+    background = loader_config['labels']['BACKGROUND']
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=1) as decoder, ThreadPoolExecutor(max_workers=1) as writer:
+        pending_load = decoder.submit(load_patient, dicomdirs[0], loader_config, args.workers) if dicomdirs else None
+        pending_export = None
+        failed = []
+        for num, dicomdir_path in enumerate(dicomdirs):
+            try:
+                jaw, data = pending_load.result()
+            except Exception as e:
+                logging.info(f"skipping {dicomdir_path}: {e}")
+                jaw = None
+            # decoding the next patient while the current one is on the model
+            if num + 1 < len(dicomdirs):
+                pending_load = decoder.submit(load_patient, dicomdirs[num + 1], loader_config, args.workers)
+            if jaw is None:
+                failed.append(dicomdir_path)
+                continue
+
+            try:
+                prediction = predict(model, engine, jaw, data)
+            except Exception as e:
+                logging.info(f"skipping {dicomdir_path}: prediction failed: {e}")
+                failed.append(dicomdir_path)
+                continue
+            if pending_export is not None and not wait_export(pending_export):
+                failed.append(pending_export[0])
+            patient_dir = output_folder(dicomdir_path, args.input, args.output)
+            pending_export = dicomdir_path, writer.submit(export, jaw, prediction, patient_dir, background, args.skip_dicom)
+
+        if pending_export is not None and not wait_export(pending_export):
+            failed.append(pending_export[0])
+
+    engine.log()
+    logging.info(f"{len(dicomdirs) - len(failed)}/{len(dicomdirs)} patients processed in {time.time() - start_time:.1f}s")
+    if failed:
+        logging.info(f"{len(failed)} patients failed: {', '.join(failed)}")
+        sys.exit(1)
@@ -2,6 +2,8 @@ import numpy as np
 import cv2
 from matplotlib import pyplot as plt
 
+WINDOWING_BLOCK = 32  # number of slices rescaled together by hu_windowing
+
 def plot_2D(image, cmap="gray", title=""):
     plt.title(title)
     plt.imshow(np.squeeze(image), cmap=cmap)
@@ -174,9 +176,61 @@ def arch_detection(slice, debug=False):
     return p, min(x), max(x)
 
 
+ARC_DENSITY = 8  # samples of the x axis for each pixel when the arc length of a spline is integrated
+
+
+def arc_length_points(func, start, end, d=1, delta=0.3, density=ARC_DENSITY):
+    """
+    points of the curve y = func(x) from start to end, spaced by d along the curve (arc length parametrization).
+    the arc length is integrated on a dense grid of x values (trapezoids) and inverted with np.interp, so the whole
+    curve is tracked with a few vectorized calls instead of a step by step walk.
+    Args:
+        func (poly1d object): polynomial function approximation, evaluated on numpy arrays
+        start (float): starting value for the X axis
+        end (float): ending value for the X axis, excluded
+        d (float): distance between two points along the curve
+        delta (float): step of the central difference used as first order derivative
+        density (int): samples of the dense grid for each unit of the X axis
+
+    Returns:
+        (numpy array) x of the points
+        (numpy array) first order derivative of func for each point
+    """
+    def slope(x):
+        return (func(x + delta / 2) - func(x - delta / 2)) / delta
+
+    if end <= start:
+        return np.zeros(0), np.zeros(0)
+    dense = np.linspace(start, end, int(np.ceil((end - start) * density)) + 1)
+    speed = np.sqrt(slope(dense) ** 2 + 1)
+    length = np.concatenate(([0], np.cumsum((speed[1:] + speed[:-1]) / 2 * np.diff(dense))))
+    x = np.interp(np.arange(0, length[-1], d), length, dense)
+    return x, slope(x)
+
+
+def parallel_offsets(x, y, slope, offset):
+    """
+    points shifted by offset along the normal of the curve, on both sides
+    Args:
+        x (numpy array): x of the points of the curve
+        y (numpy array): y of the points of the curve
+        slope (numpy array): first order derivative of the curve for each point
+        offset (float): distance from the curve
+
+    Returns:
+        (numpy array) points with greater y (lower offset), shape N, 2
+        (numpy array) points with smaller y (higher offset), shape N, 2
+    """
+    norm = np.sqrt(slope ** 2 + 1)
+    shift = np.stack((-slope * offset / norm, offset / norm), axis=1)
+    curve = np.stack((x, y), axis=1)
+    return curve + shift, curve - shift
+
+
 def arch_lines(func, start, end, offset=50, d=1):
     """
     this functions uses the first order derivative of the function func to track the proper points (x,y) from start to end.
+    points are equally distant along the curve, see arc_length_points
     Args:
         func (poly1d object): polynomial function approximation
         end (float) starting value for the X axis
@@ -189,36 +243,75 @@ def arch_lines(func, start, end, offset=50, d=1):
         high_offset (numpy array): set of sets of xy coordinates (higer offset)
         derivative: set of derivates foreach point of coords
     """
-    delta = 0.3
-    coords = []
-    x = start + 1
-    # we start from the range of X values on the X axis,
-    # we create a new list X of x coords along the curve
-    # we exploit the first order derivative to place values in X
-    # so that f(X) is equally distant for each point in X
-    while x < end:
-        coords.append((x, func(x)))
-        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta
-        x = x + d * np.sqrt(1 / (alfa ** 2 + 1))
-
-    # creating lines parallel to the spline
-    high_offset = []
-    low_offset = []
-    derivative = []
-    for x, y in coords:
-        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta  # first derivative
-        alfa = -1 / alfa  # perpendicular coeff
-        cos = np.sqrt(1 / (alfa ** 2 + 1))
-        sin = np.sqrt(alfa ** 2 / (alfa ** 2 + 1))
-        if alfa > 0:
-            low_offset.append((x + offset * cos, y + offset * sin))
-            high_offset.append((x - offset * cos, y - offset * sin))
-        else:
-            low_offset.append((x - offset * cos, y + offset * sin))
-            high_offset.append((x + offset * cos, y - offset * sin))
-        derivative.append(alfa)
-
-    return low_offset, coords, high_offset, derivative
+    x, slope = arc_length_points(func, start + 1, end, d)
+    y = func(x)
+    low_offset, high_offset = parallel_offsets(x, y, slope, offset)
+    with np.errstate(divide='ignore'):
+        derivative = -1 / slope  # perpendicular coeff
+
+    return list(map(tuple, low_offset)), list(zip(x, y)), list(map(tuple, high_offset)), list(derivative)
+
+
+def hu_windowing(raw_volume, slope, intercept, center, width, dtype=np.float32, block_size=WINDOWING_BLOCK):
+    """
+    rescale the raw DICOM values to HU and apply the DICOM window, block of slices by block of slices.
+    the linear window of the standard (https://dicom.nema.org/medical/dicom/current/output/chtml/part03/sect_C.11.2.html)
+    is folded with the HU rescale into a single scale and offset, values out of the window are clipped to its bounds.
+    the only full size array allocated is the result.
+    Args:
+        raw_volume (numpy array): raw volume as stored in the DICOM files, shape Z, H, W
+        slope (float): RescaleSlope
+        intercept (float): RescaleIntercept
+        center (float): WindowCenter
+        width (float): WindowWidth
+        dtype (numpy dtype): dtype of the result, integer dtypes are rounded
+        block_size (int): number of slices processed together
+
+    Returns:
+        result (numpy array): windowed volume with values in [center - width / 2, center + width / 2]
+    """
+    ymin, ymax = center - width / 2, center + width / 2
+    scale = slope * width / (width - 1)
+    offset = (intercept - (center - .5)) * width / (width - 1) + center
+
+    is_float = np.issubdtype(dtype, np.floating)
+    result = np.empty(raw_volume.shape, dtype=dtype)
+    for start in range(0, raw_volume.shape[0], block_size):
+        block = result[start:start + block_size] if is_float else np.empty(result[start:start + block_size].shape, np.float32)
+        np.multiply(raw_volume[start:start + block_size], scale, out=block, casting='same_kind')
+        block += offset
+        np.clip(block, ymin, ymax, out=block)
+        if not is_float:
+            result[start:start + block_size] = np.rint(block, out=block)
+    return result
+
+
+def normalize_volume(volume, dicom_min, dicom_max, mask=None, block_size=WINDOWING_BLOCK):
+    """
+    input preprocessing of the 3D models, shared by the loaders and predict.py: values are clipped to
+    [volumes_min, volumes_max] and rescaled to [0-1] with shifting, voxels outside the background suppression mask
+    are set to 0. slices are read block by block (volume can be memory mapped), the only full size array is the result.
+    Args:
+        volume (numpy array): volume with shape Z, H, W (or 1, Z, H, W)
+        dicom_min (float): volumes_min of the config
+        dicom_max (float): volumes_max of the config
+        mask (numpy array): bool mask with shape H, W, see utils.suppression_mask. None to keep all the voxels
+        block_size (int): number of slices processed together
+
+    Returns:
+        result (numpy array): float32 volume with the shape of volume
+    """
+    result = np.empty(volume.shape, dtype=np.float32)
+    blocks = result.reshape(-1, *result.shape[-2:])
+    source = volume.reshape(-1, *volume.shape[-2:])
+    for start in range(0, len(blocks), block_size):
+        block = blocks[start:start + block_size]
+        np.clip(source[start:start + block_size], dicom_min, dicom_max, out=block, casting='unsafe')
+        block += dicom_min
+        block /= dicom_max + dicom_min  # [0-1] with shifting
+        if mask is not None:
+            block[:, ~mask] = 0  # outside the dental arch
+    return result
 
 
 def increase_contrast(image):
@@ -0,0 +1,157 @@
+import os
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+import torch
+
+STAGES = ['data', 'transfer', 'augment', 'forward', 'loss', 'backward', 'optimizer', 'metrics']
+
+
+class StepProfiler:
+    """
+    wall time of the stages of each training step (data wait, host to device copy, forward, backward, ...),
+    with a cuda synchronize around each stage when the device is a gpu so kernels are charged to the stage which
+    launched them (this also removes the overlap between stages, enable it just to look at the numbers).
+    per step timings and patches/s go to the SummaryWriter, a table of the epoch goes to the log.
+    optionally the first steps are traced by torch.profiler and saved for the tensorboard profiler plugin.
+    a disabled profiler has no cost: stages are null contexts.
+
+    usage:
+        profiler = StepProfiler(device='cuda', trace_dir=os.path.join(tb_dir, 'trace'), trace_steps=5)
+        for step, batch in enumerate(profiler.iterate(loader)):
+            with profiler.stage('forward'):
+                outputs = model(batch)
+            ...
+            profiler.step(len(batch), writer, global_step)
+        profiler.summary(epoch, writer)
+    """
+
+    def __init__(self, enabled=True, device='cuda', sync=True, trace_dir=None, trace_steps=0):
+        """
+        Args:
+            enabled (bool): if false stages are not timed
+            device (str or torch.device): device of the training, cuda stages are synchronized
+            sync (bool): synchronize cuda around each stage
+            trace_dir (str): folder of the torch.profiler traces
+            trace_steps (int): steps traced by torch.profiler (after one step of warm up), 0 to disable the traces
+        """
+        self.enabled = enabled
+        self.sync = enabled and sync and torch.device(device).type == 'cuda' and torch.cuda.is_available()
+        self.trace_dir = trace_dir
+        self.trace_steps = trace_steps if enabled and trace_dir is not None else 0
+        self.trace = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.current = dict.fromkeys(STAGES, 0.)
+        self.totals = dict.fromkeys(STAGES, 0.)
+        self.steps = 0
+        self.patches = 0
+        self.epoch_start = self.step_start = time.perf_counter()
+
+    def synchronize(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def stage(self, name):
+        """
+        context manager timing a stage of the current step
+        """
+        if not self.enabled:
+            return nullcontext()
+        return self.__timed(name)
+
+    @contextmanager
+    def __timed(self, name):
+        self.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.current[name] += time.perf_counter() - start
+
+    def iterate(self, loader):
+        """
+        items of loader, the time spent waiting for each of them is the data stage of its step
+        """
+        self.epoch_start = self.step_start = time.perf_counter()
+        iterator = iter(loader)
+        while True:
+            with self.stage('data'):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self, patches, writer=None, global_step=None):
+        """
+        end of a training step: timings of its stages are stored and written to the writer
+        Args:
+            patches (int): patches of the step
+            writer (SummaryWriter): tensorboard writer, None to skip the scalars
+            global_step (int): step of the scalars
+        """
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - self.step_start
+        self.steps += 1
+        self.patches += patches
+        for name, value in self.current.items():
+            self.totals[name] += value
+        if writer is not None:
+            for name, value in self.current.items():
+                writer.add_scalar(f'Profile/{name}_ms', value * 1000, global_step)
+            writer.add_scalar('Profile/patches_per_s', patches / max(elapsed, 1e-9), global_step)
+        self.current = dict.fromkeys(self.current, 0.)
+        self.step_start = time.perf_counter()
+        if self.trace is not None:
+            self.trace.step()
+
+    @contextmanager
+    def profile(self):
+        """
+        torch.profiler trace of the first trace_steps steps of the epoch inside this context, if enabled
+        """
+        if not self.trace_steps:
+            yield
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        self.trace = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=0, warmup=1, active=self.trace_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+            record_shapes=True,
+            profile_memory=True,
+        )
+        with self.trace:
+            yield
+        self.trace = None
+        self.trace_steps = 0  # just the first epoch is traced
+
+    def summary(self, epoch, writer=None):
+        """
+        log a table with the time of each stage in the epoch and write the throughput of the epoch
+        """
+        if not self.enabled or self.steps == 0:
+            self.reset_stats()
+            return
+        elapsed = time.perf_counter() - self.epoch_start
+        measured = sum(self.totals.values())
+        rows = [f"{'stage':10s} {'total s':>9s} {'ms/step':>9s} {'share':>7s}"]
+        for name, value in self.totals.items():
+            rows.append(f"{name:10s} {value:9.2f} {value / self.steps * 1000:9.1f} {value / elapsed:7.1%}")
+        rows.append(f"{'other':10s} {elapsed - measured:9.2f} {(elapsed - measured) / self.steps * 1000:9.1f} {(elapsed - measured) / elapsed:7.1%}")
+        logging.info(
+            f"training epoch {epoch}: {self.steps} steps, {self.patches} patches in {elapsed:.1f}s, "
+            f"{self.patches / elapsed:.1f} patches/s{' (cuda synchronized stages)' if self.sync else ''}\n" + "\n".join(rows)
+        )
+        if writer is not None:
+            writer.add_scalar('Profile/epoch_patches_per_s', self.patches / elapsed, epoch)
+            for name, value in self.totals.items():
+                writer.add_scalar(f'Profile/epoch_{name}_share', value / elapsed, epoch)
+        self.reset_stats()
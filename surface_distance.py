@@ -0,0 +1,160 @@
+import numpy as np
+from scipy.ndimage import binary_erosion, distance_transform_edt, generate_binary_structure
+
+
+def surface(mask):
+    """
+    boundary voxels of a binary volume: voxels removed by one erosion step (6-connectivity).
+    voxels on the border of the volume are part of the surface.
+    Args:
+        mask (numpy array): binary volume
+
+    Returns:
+        (numpy array) bool volume with the surface voxels
+    """
+    mask = mask.astype(bool)
+    return mask ^ binary_erosion(mask, structure=generate_binary_structure(mask.ndim, 1), border_value=0)
+
+
+class SurfaceDistances:
+    """
+    surface distances between two binary volumes.
+    one euclidean distance transform is computed for each surface and shared by all the metrics and the sub-regions,
+    so the cost does not depend on how many regions are evaluated (no KD-trees over the foreground voxels).
+    everything is limited to the bounding box of the two volumes, which is exact and keeps small structures cheap.
+    distances of a region are measured from the surface voxels inside the region to the whole surface of the other volume.
+    with surfaces=False all the foreground voxels are used instead of the surfaces: the point sets of
+    skimage.metrics.hausdorff_distance, which gives the same hausdorff distance.
+
+    usage:
+        dist = SurfaceDistances(pred, gt, spacing=(0.3, 0.3, 0.3))
+        dist.hausdorff(), dist.hd95(), dist.assd()
+        dist.hausdorff(np.s_[:, :, :half])  # left side only
+    """
+
+    def __init__(self, a, b, spacing=1., return_indices=False, surfaces=True):
+        """
+        Args:
+            a (numpy array): first binary volume (e.g. the prediction), non zero voxels are foreground
+            b (numpy array): second binary volume (e.g. the ground truth), same shape of a
+            spacing (float or tuple): voxel size, for each axis if tuple
+            return_indices (bool): keep the closest surface voxel of each distance, needed by hausdorff_pair
+            surfaces (bool): distances between the surfaces, if false between all the foreground voxels
+        """
+        assert a.shape == b.shape, f"volumes must have the same shape, {a.shape} vs {b.shape}"
+        self.shape = a.shape
+        self.a_points = self.b_points = np.zeros((0, a.ndim), int)
+        self.a_to_b = self.b_to_a = self.a_closest = self.b_closest = None
+
+        # everything happens inside the bounding box of the foreground (+1 voxel for the erosion)
+        foreground = (a != 0) | (b != 0)
+        if not foreground.any():
+            return
+        axes = range(a.ndim)
+        bounds = [np.flatnonzero(foreground.any(axis=tuple(ax for ax in axes if ax != axis))) for axis in axes]
+        offset = np.array([max(bound[0] - 1, 0) for bound in bounds])
+        crop = tuple(slice(lo, min(bound[-1] + 2, dim)) for lo, bound, dim in zip(offset, bounds, self.shape))
+
+        if surfaces:
+            a_surface, b_surface = surface(a[crop]), surface(b[crop])
+        else:
+            a_surface, b_surface = a[crop] != 0, b[crop] != 0
+        self.a_points = np.argwhere(a_surface) + offset
+        self.b_points = np.argwhere(b_surface) + offset
+        if self.a_points.size == 0 or self.b_points.size == 0:
+            return
+        self.a_to_b, self.a_closest = self.__distances(b_surface, self.a_points - offset, offset, spacing, return_indices)
+        self.b_to_a, self.b_closest = self.__distances(a_surface, self.b_points - offset, offset, spacing, return_indices)
+
+    @staticmethod
+    def __distances(target, points, offset, spacing, return_indices):
+        """
+        distance (and closest voxel) of each point from the surface voxels of target
+        """
+        res = distance_transform_edt(~target, sampling=spacing, return_indices=return_indices)
+        if not return_indices:
+            return res[tuple(points.T)], None
+        dt, indices = res
+        closest = indices[(slice(None), *points.T)].T + offset
+        return dt[tuple(points.T)], closest
+
+    def __in_region(self, points, region):
+        """
+        Returns:
+            (numpy array) bool mask of the points inside the region
+        """
+        region = region if isinstance(region, tuple) else (region,)
+        if Ellipsis in region:
+            idx = region.index(Ellipsis)
+            region = region[:idx] + (slice(None),) * (len(self.shape) - len(region) + 1) + region[idx + 1:]
+        keep = np.ones(len(points), bool)
+        for axis, axis_slice in enumerate(region):
+            axis_mask = np.zeros(self.shape[axis], bool)
+            axis_mask[axis_slice] = True
+            keep &= axis_mask[points[:, axis]]
+        return keep
+
+    def distances(self, region=np.s_[...]):
+        """
+        directed surface distances inside a region
+        Args:
+            region (tuple of slices): sub-region of the volume, default is the whole volume
+
+        Returns:
+            (numpy array) distances from the surface voxels of a to the surface of b, None if a surface is missing
+            (numpy array) distances from the surface voxels of b to the surface of a, None if a surface is missing
+        """
+        if self.a_to_b is None:
+            return None, None
+        if region is Ellipsis:
+            return self.a_to_b, self.b_to_a
+        a_to_b = self.a_to_b[self.__in_region(self.a_points, region)]
+        b_to_a = self.b_to_a[self.__in_region(self.b_points, region)]
+        if a_to_b.size == 0 or b_to_a.size == 0:
+            return None, None
+        return a_to_b, b_to_a
+
+    def __empty(self, region):
+        """
+        value of the metrics when a surface is missing: 0 if both are empty, inf otherwise (as skimage)
+        """
+        a_empty = not self.__in_region(self.a_points, region).any()
+        b_empty = not self.__in_region(self.b_points, region).any()
+        return 0. if a_empty and b_empty else np.inf
+
+    def hausdorff(self, region=np.s_[...]):
+        a_to_b, b_to_a = self.distances(region)
+        if a_to_b is None:
+            return self.__empty(region)
+        return max(a_to_b.max(), b_to_a.max())
+
+    def hd95(self, region=np.s_[...]):
+        a_to_b, b_to_a = self.distances(region)
+        if a_to_b is None:
+            return self.__empty(region)
+        return max(np.percentile(a_to_b, 95), np.percentile(b_to_a, 95))
+
+    def assd(self, region=np.s_[...]):
+        """
+        average symmetric surface distance
+        """
+        a_to_b, b_to_a = self.distances(region)
+        if a_to_b is None:
+            return self.__empty(region)
+        return (a_to_b.sum() + b_to_a.sum()) / (a_to_b.size + b_to_a.size)
+
+    def hausdorff_pair(self):
+        """
+        Returns:
+            (numpy array) coords of the surface voxel of a involved in the hausdorff distance, () if a surface is missing
+            (numpy array) coords of the surface voxel of b involved in the hausdorff distance, () if a surface is missing
+        """
+        if self.a_to_b is None:
+            return (), ()
+        if self.a_closest is None:
+            raise Exception("hausdorff_pair needs the closest voxels, create the object with return_indices=True")
+        if self.a_to_b.max() > self.b_to_a.max():
+            idx = self.a_to_b.argmax()
+            return self.a_points[idx], self.a_closest[idx]
+        idx = self.b_to_a.argmax()
+        return self.b_closest[idx], self.b_points[idx]
@@ -1,12 +1,10 @@
 import torch
 from torch import nn
 from tqdm import tqdm
-from torch.nn.functional import interpolate
-from augmentations import CenterCrop
 import numpy as np
 import torchio as tio
 import logging
-from augmentations import CropAndPad
+from augmentations import Geometry
 
 
 def test2D(model, test_loader, epoch, writer, evaluator, phase, splitter):
@@ -19,7 +17,7 @@ def test2D(model, test_loader, epoch, writer, evaluator, phase, splitter):
         evaluator.reset_eval()
         for i, (images, labels, names, partition_weights, gt_paths) in tqdm(enumerate(test_loader), total=len(test_loader), desc='val epoch {}'.format(str(epoch))):
 
-            images = images.cuda()  # BS, 3, H, W
+            images = images.cuda()  # BS, 1, H, W
 
             output = model(images)  # BS, Classes, H, W
 
@@ -44,19 +42,10 @@ def test2D(model, test_loader, epoch, writer, evaluator, phase, splitter):
                 assert len(gt_path) == 1, "mixed patients!"  # must be just one!
                 labels = np.load(gt_path.pop())
 
-                D, H, W = labels.shape[-3:]
-                rD, rH, rW = output.shape[-3:]
-                tmp_ratio = np.array((D / W, H / W, 1))
-                pad_factor = tmp_ratio / np.array((rD / rW, rH / rW, 1))
-                pad_factor /= np.max(pad_factor)
-                reshape_size = np.array((D, H, W)) / pad_factor
-                reshape_size = np.round(reshape_size).astype(np.int)
-
-                output = interpolate(output.unsqueeze(0), size=tuple(reshape_size), mode='trilinear', align_corners=False).squeeze()  # (classes, Z, H, W) or (Z, H, W) if classes = 1
-                output = CenterCrop((D, H, W))(output)
-
-                images = interpolate(images.view(1, *images.shape), size=tuple(reshape_size), mode='trilinear', align_corners=False).squeeze()
-                images = CenterCrop((D, H, W))(images)[0]  # Z, H W
+                # inverse of the preprocessing of the 2D dataset
+                geometry = Geometry.keep_aspect(labels.shape[-3:], output.shape[-3:]).inverse()
+                output = geometry(output).squeeze()  # (classes, Z, H, W) or (Z, H, W) if classes = 1
+                images = geometry(images)[0]  # Z, H W
 
                 # final predictions
                 if output.ndim > 3:
@@ -123,34 +112,22 @@ def test2D(model, test_loader, epoch, writer, evaluator, phase, splitter):
     return epoch_iou, epoch_dice, epoch_haus
 
 
-def test3D(model, test_loader, epoch, writer, evaluator, phase):
+def test3D(model, test_loader, epoch, writer, evaluator, phase, engine):
 
     model.eval()
+    engine.reset_stats()
 
     with torch.no_grad():
         evaluator.reset_eval()
-        for i, (subject, loader) in tqdm(enumerate(test_loader), total=len(test_loader), desc='val epoch {}'.format(str(epoch))):
-            aggr = tio.inference.GridAggregator(subject, overlap_mode='average')
-            import time
-            start_time = time.time()
-            for subvolume in loader:
-                # batchsize with torchio affects the number of grids we extract from a patient.
-                # when we aggragate the patient the volume is just one.
-
-                images = subvolume['data'][tio.DATA].float().cuda()  # BS, 3, Z, H, W
-                emb_codes = subvolume[tio.LOCATION].float().cuda()
-
-                output = model(images, emb_codes)  # BS, Classes, Z, H, W
+        for i, subject in tqdm(enumerate(test_loader), total=len(test_loader), desc='val epoch {}'.format(str(epoch))):
 
-                aggr.add_batch(output, subvolume[tio.LOCATION])
+            output = engine(model, subject['data'][tio.DATA])  # C, Z, H, W
 
-            output = aggr.get_output_tensor()  # C, Z, H, W
-            print("--- %s seconds ---" % (time.time() - start_time))
-            labels = np.load(subject[0]['gt_path'])  # original labels from storage
-            images = np.load(subject[0]['data_path'])  # high resolution image from storage
+            labels = np.load(subject['gt_path'])  # original labels from storage
+            images = np.load(subject['data_path'])  # high resolution image from storage
 
-            orig_shape = labels.shape[-3:]
-            output = CropAndPad(orig_shape)(output).squeeze()  # keep pad_val = min(output) since we are dealing with probabilities
+            # inverse of the crop/pad of Loader3D.preprocessing, pad_val = min(output) since we are dealing with probabilities
+            output = Geometry(labels.shape[-3:], output.shape[-3:]).inverse()(output).squeeze()
 
             # final predictions
             if output.ndim > 3:
@@ -160,7 +137,7 @@ def test3D(model, test_loader, epoch, writer, evaluator, phase):
                 output = torch.where(output > .5, 1, 0)
                 output = output.squeeze().cpu().detach().numpy()  # BS, Z, H, W
 
-            evaluator.compute_metrics(output, labels, images, subject[0]['folder'], phase)
+            evaluator.compute_metrics(output, labels, images, subject['folder'], phase)
 
             # TB DUMP FOR BINARY CASE!
             # images = np.clip(images, 0, None)
@@ -189,6 +166,8 @@ def test3D(model, test_loader, epoch, writer, evaluator, phase):
             #     )
             # END OF THE DUMP
 
+    engine.log()
+    evaluator.gather()  # metrics of the subjects of the other ranks
     epoch_iou, epoch_dice, epoch_haus = evaluator.mean_metric(phase=phase)
     if writer is not None and phase != "Final":
         writer.add_scalar(f'{phase}/IoU', epoch_iou, epoch)
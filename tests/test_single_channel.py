@@ -0,0 +1,56 @@
+"""
+single channel input path of the 3D models: a model with in_channels 1 loading a folded RGB checkpoint
+(utils.fold_input_channels) predicts the same as the RGB model on the replicated volume, and the RGB models
+broadcast a single channel batch to their input channels.
+run it from the project root with: python -m pytest tests/test_single_channel.py
+"""
+import pytest
+import torch
+from models.PadUNet3D import padUNet3D, PositionalpadUNet3D
+from models.transUnet import TransUNet3D
+from utils import fold_input_channels
+
+PATCH_SHAPE = (32, 32, 32)
+MODELS = ['PadUNet3D', 'PosPadUNet3D', 'transUNet3D']
+
+
+def build(name, in_ch):
+    emb_shape = [dim // 8 for dim in PATCH_SHAPE]
+    if name == 'PadUNet3D':
+        return padUNet3D(n_classes=2, in_ch=in_ch)
+    if name == 'PosPadUNet3D':
+        return PositionalpadUNet3D(n_classes=2, emb_shape=emb_shape, in_ch=in_ch)
+    return TransUNet3D(n_classes=2, emb_shape=emb_shape, in_ch=in_ch)
+
+
+@pytest.fixture
+def batch():
+    torch.manual_seed(47)
+    return torch.rand(2, 1, *PATCH_SHAPE), torch.rand(2, 6)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_folded_checkpoint(name, batch):
+    images, emb_codes = batch
+    rgb = build(name, 3).eval()
+    single = build(name, 1).eval()
+    state_dict, folded = fold_input_channels(rgb.state_dict(), single)
+    single.load_state_dict(state_dict)
+    assert len(folded) == 1, f"just the first convolution has to be folded, got {folded}"
+    with torch.no_grad():
+        reference = rgb(images.repeat(1, 3, 1, 1, 1), emb_codes)  # replicated volume of the old loaders
+        assert torch.allclose(reference, single(images, emb_codes), atol=1e-4)
+
+
+@pytest.mark.parametrize('name', MODELS)
+def test_expand(name, batch):
+    images, emb_codes = batch
+    rgb = build(name, 3).eval()
+    with torch.no_grad():
+        assert torch.equal(rgb(images, emb_codes), rgb(images.repeat(1, 3, 1, 1, 1), emb_codes))
+
+
+def test_same_checkpoint_is_not_folded():
+    model = build('PadUNet3D', 3)
+    state_dict, folded = fold_input_channels(model.state_dict(), model)
+    assert not folded
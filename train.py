@@ -4,6 +4,82 @@ from tqdm import tqdm
 from torch import nn
 import torchio as tio
 import torch.distributed as dist
+from profiler import StepProfiler
+
+AMP_DTYPES = {'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+class MixedPrecision:
+    """
+    precision settings of the training step: autocast of the forward pass, gradient scaling and memory format.
+    losses are computed in fp32 outside autocast. float16 needs a GradScaler (cuda only), bfloat16 has the
+    range of fp32 and is used without scaling, which is the mode available on CPU.
+    the default object keeps the plain fp32 training.
+
+    usage:
+        precision = MixedPrecision(amp=True, channels_last=True)
+        model = precision.prepare(model)
+        with precision.autocast():
+            outputs = model(precision.format(images), emb_codes)
+        precision.step(loss_fn(outputs.float(), labels, weights), optimizer)
+    """
+
+    def __init__(self, amp=False, dtype=None, channels_last=False, device='cuda'):
+        """
+        Args:
+            amp (bool): forward passes with autocast
+            dtype (str): 'float16' or 'bfloat16', default is float16 on cuda and bfloat16 on cpu
+            channels_last (bool): channels_last_3d memory format for the 3D convolutions
+            device (str): device type of the training, 'cuda' or 'cpu'
+        """
+        self.device_type = torch.device(device).type
+        dtype = dtype if dtype is not None else 'float16' if self.device_type == 'cuda' else 'bfloat16'
+        if dtype not in AMP_DTYPES:
+            raise Exception(f"amp dtype {dtype} not supported, use one of {list(AMP_DTYPES)}")
+        if amp and dtype == 'float16' and self.device_type != 'cuda':
+            raise Exception("float16 autocast is available on cuda only, use bfloat16 on cpu")
+        self.amp = amp
+        self.dtype = AMP_DTYPES[dtype]
+        self.channels_last = channels_last
+        self.scaler = torch.cuda.amp.GradScaler(enabled=amp and self.dtype == torch.float16)
+
+    def prepare(self, model):
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last_3d)
+        return model
+
+    def format(self, volumes):
+        """
+        Args:
+            volumes (torch.Tensor): batch with shape B, C, Z, H, W
+
+        Returns:
+            (torch.Tensor) the batch in the memory format of the model
+        """
+        if self.channels_last and volumes.ndim == 5:
+            return volumes.contiguous(memory_format=torch.channels_last_3d)
+        return volumes
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device_type, dtype=self.dtype, enabled=self.amp)
+
+    def step(self, loss, optimizer):
+        """
+        backward pass and optimizer step, gradients are unscaled before the step when float16 is used
+        """
+        self.backward(loss)
+        self.update(optimizer)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def update(self, optimizer):
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def __str__(self):
+        mode = f"{self.dtype} autocast" if self.amp else "fp32"
+        return f"{mode}{', channels_last_3d' if self.channels_last else ''}"
 
 
 def train2D(model, train_loader, loss_fn, optimizer, epoch, writer, evaluator, phase='Train'):
@@ -55,59 +131,99 @@ def train2D(model, train_loader, loss_fn, optimizer, epoch, writer, evaluator, p
     return epoch_train_loss, epoch_iou
 
 
-def train3D(model, train_loader, loss_fn, optimizer, epoch, writer, evaluator, phase='Train'):
+def empty_batch(gt_count):
+    """
+    true if the step has to be skipped because all the gt volumes of the batch are empty.
+    with DDP the backward pass is collective: a rank with an empty batch makes all the ranks skip the step together,
+    otherwise the other ranks would wait for it in the all-reduce of the gradients.
+    Args:
+        gt_count (torch.Tensor): gt voxels of each volume of the batch
+
+    Returns:
+        (bool) skip the step
+    """
+    empty = (torch.sum(gt_count) == 0).int()
+    if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+        dist.all_reduce(empty, op=dist.ReduceOp.MAX)
+    return bool(empty)
+
+
+def train3D(model, train_loader, loss_fn, optimizer, epoch, writer, evaluator, phase='Train', precision=None,
+            augment=None, profiler=None):
+    """
+    Args:
+        precision (MixedPrecision): autocast and memory format of the step, default is fp32
+        augment (batch_augmentations.BatchTransform): batched augmentations of images and labels, applied on the
+            device of the model, see the backend key of the augmentations file
+        profiler (StepProfiler): timings of the stages of each step, default is no profiling
+    """
+    precision = precision if precision is not None else MixedPrecision()
+    profiler = profiler if profiler is not None else StepProfiler(enabled=False)
+    device = next(model.parameters()).device
     model.train()
     evaluator.reset_eval()
     losses = []
-    for i, d in tqdm(enumerate(train_loader), total=len(train_loader), desc=f'{phase} epoch {str(epoch)}'):
-
-        images = d['data'][tio.DATA].float().cuda()
-        labels = d['label'][tio.DATA].cuda()
-
-        emb_codes = torch.cat((
-            d['index_ini'],
-            d['index_ini'] + torch.as_tensor(images.shape[-3:])
-        ), dim=1).float().cuda()
-
-        partition_weights = d['weight'].cuda()
-        gt_count = torch.sum(labels == 1, dim=list(range(1, labels.ndim)))
-        if torch.sum(gt_count) == 0:
-            logging.info(f"skipped iteration {i}/{len(train_loader)} at epoch {epoch} cos all gt volumes were empty\n")
-            continue
-        eps = 1e-10
-        partition_weights = (eps + gt_count) / torch.max(gt_count)  # TODO: set this only when it is not competitor and we are on grid
-        # partition_weights = (eps + gt_count) / torch.sum(gt_count)  # over max tecnique is better
-
-        optimizer.zero_grad()
-        outputs = model(images, emb_codes)  # output -> B, C, Z, H, W
-        assert outputs.ndim == labels.ndim, f"Gt and output dimensions are not the same before loss. {outputs.ndim} vs {labels.ndim}"
-
-        loss = loss_fn(outputs, labels, partition_weights)
-        losses.append(loss.item())
-        loss.backward()
-        optimizer.step()
-
-        # final predictions
-        # shape B, C, xyz -> softmax -> B, xyz
-        # shape 1, C, xyz -> softmax -> 1, xyz
-        # shape B, 1, xyz -> sigmoid + sqz -> B, xyz
-        # shape B, 1, xyz -> sigmoid + sqz -> xyz
-        if outputs.shape[1] > 1:
-            outputs = torch.argmax(torch.nn.Softmax(dim=1)(outputs), dim=1).cpu().numpy()
-        else:
-            outputs = nn.Sigmoid()(outputs)  # BS, 1, Z, H, W
-            outputs[outputs > .5] = 1
-            outputs[outputs != 1] = 0
-            outputs = outputs.squeeze().cpu().detach().numpy()  # BS, Z, H, W
-
-        labels = labels.squeeze().cpu().numpy()  # BS, Z, H, W
-        evaluator.compute_metrics(outputs, labels, images, d['folder'], phase)
+    with profiler.profile():
+        for i, d in tqdm(enumerate(profiler.iterate(train_loader)), total=len(train_loader), desc=f'{phase} epoch {str(epoch)}'):
+
+            with profiler.stage('transfer'):
+                images = d['data'][tio.DATA].float().to(device)
+                labels = d['label'][tio.DATA].to(device)
+
+                emb_codes = d[tio.LOCATION].float().to(device)  # z_ini, y_ini, x_ini, z_fin, y_fin, x_fin of each patch
+
+            if augment is not None:
+                with profiler.stage('augment'):
+                    images, labels = augment(images, labels)
+
+            partition_weights = d['weight'].to(device)
+            gt_count = torch.sum(labels == 1, dim=list(range(1, labels.ndim)))
+            if empty_batch(gt_count):
+                logging.info(f"skipped iteration {i}/{len(train_loader)} at epoch {epoch} cos all gt volumes were empty\n")
+                profiler.step(0)
+                continue
+            eps = 1e-10
+            partition_weights = (eps + gt_count) / torch.max(gt_count)  # TODO: set this only when it is not competitor and we are on grid
+            # partition_weights = (eps + gt_count) / torch.sum(gt_count)  # over max tecnique is better
+
+            optimizer.zero_grad()
+            with profiler.stage('forward'), precision.autocast():
+                outputs = model(precision.format(images), emb_codes)  # output -> B, C, Z, H, W
+            outputs = outputs.float()  # losses and predictions in fp32
+            assert outputs.ndim == labels.ndim, f"Gt and output dimensions are not the same before loss. {outputs.ndim} vs {labels.ndim}"
+
+            with profiler.stage('loss'):
+                loss = loss_fn(outputs, labels, partition_weights)
+                losses.append(loss.item())
+            with profiler.stage('backward'):
+                precision.backward(loss)
+            with profiler.stage('optimizer'):
+                precision.update(optimizer)
+
+            # final predictions
+            # shape B, C, xyz -> softmax -> B, xyz
+            # shape 1, C, xyz -> softmax -> 1, xyz
+            # shape B, 1, xyz -> sigmoid + sqz -> B, xyz
+            # shape B, 1, xyz -> sigmoid + sqz -> xyz
+            with profiler.stage('metrics'):
+                if outputs.shape[1] > 1:
+                    outputs = torch.argmax(torch.nn.Softmax(dim=1)(outputs), dim=1).cpu().numpy()
+                else:
+                    outputs = nn.Sigmoid()(outputs)  # BS, 1, Z, H, W
+                    outputs[outputs > .5] = 1
+                    outputs[outputs != 1] = 0
+                    outputs = outputs.squeeze().cpu().detach().numpy()  # BS, Z, H, W
+
+                labels = labels.squeeze().cpu().numpy()  # BS, Z, H, W
+                evaluator.compute_metrics(outputs, labels, images, d['folder'], phase)
+            profiler.step(len(images), writer, epoch * len(train_loader) + i)
 
     epoch_train_loss = sum(losses) / len(losses)
     epoch_iou, epoch_dice, epoch_haus = evaluator.mean_metric(phase=phase)
     if writer is not None:
         writer.add_scalar(f'Loss/{phase}', epoch_train_loss, epoch)
         writer.add_scalar(f'{phase}', epoch_iou, epoch)
+    profiler.summary(epoch, writer)
 
     # logging.info(
     #     f'{phase} Epoch [{epoch}], '
@@ -22,6 +22,7 @@ from models.Multiscale.Multiscale import Multiscale3D
 from models.Competitor import Competitor
 import sys
 from Jaw import Jaw
+import processing
 import torch
 from tqdm import tqdm
 import SimpleITK as sitk
@@ -56,7 +57,8 @@ def data_from_dicom(directory):
     for i, (folder) in tqdm(enumerate(folders), total=len(folders), desc='creating the gorgeous dataset'):
         TARGET_FOLDER = os.path.join(directory, folder, 'DICOM', 'DICOMDIR')
         if os.path.exists(TARGET_FOLDER):
-            j = Jaw(TARGET_FOLDER)
+            # float64 as the data.npy of the existing datasets
+            j = Jaw(TARGET_FOLDER, parallel=True, release_pixel_data=True, dtype=np.float64)
             np.save(os.path.join(directory, folder, 'data.npy'), j.get_volume())
 
 
@@ -70,7 +72,7 @@ def fix_dataset_folder(directory):
             continue
 
         # better file format (from DICOM LUT)
-        data = Jaw(os.path.join(directory, folder, 'DICOM', 'DICOMDIR')).get_volume()
+        data = Jaw(os.path.join(directory, folder, 'DICOM', 'DICOMDIR'), parallel=True, release_pixel_data=True, dtype=np.float64).get_volume()
         four_labels = np.load(os.path.join(directory, folder, 'gt_volume.npy'))
         two_labels = convert_to_two_labels(four_labels)
 
@@ -155,21 +157,25 @@ def load_model(config):
         num_classes = len(loader_config['labels'])
 
     name = model_config.get('name', 'UNet3D')
+    # loaders produce single channel volumes, 3 keeps the first convolution of the existing checkpoints
+    # (the volume is broadcast inside the model), 1 feeds the volume as it is, see fold_input_channels
+    in_ch = model_config.get('in_channels', 3)
+    checkpointing = model_config.get('checkpointing', None)  # conv3Dblocks recomputed in the backward pass
 
     if name == 'PadUNet2D':
-        return PadUNet2D(num_classes=num_classes, in_ch=3), "2D"
+        return PadUNet2D(num_classes=num_classes, in_ch=in_ch), "2D"
 
     emb_shape = [dim // 8 for dim in loader_config['patch_shape']]
 
     if name == 'PadUNet3D':
-        return padUNet3D(n_classes=num_classes), "3D"
+        return padUNet3D(n_classes=num_classes, in_ch=in_ch, checkpointing=checkpointing), "3D"
     elif name == 'PosPadUNet3D':
-        return PospadUNet3D(n_classes=num_classes, emb_shape=emb_shape), "3D"
+        return PospadUNet3D(n_classes=num_classes, emb_shape=emb_shape, in_ch=in_ch, checkpointing=checkpointing), "3D"
     elif name == 'transBTS':
         _, net = TransBTS(num_classes=num_classes, img_dim=loader_config['patch_shape'][0])
         return net,"3D"
     elif name == 'transUNet3D':
-        return TransUNet3D(n_classes=num_classes, emb_shape=emb_shape), "3D"
+        return TransUNet3D(n_classes=num_classes, emb_shape=emb_shape, in_ch=in_ch, checkpointing=checkpointing), "3D"
     elif name == 'Multiscale':
         return Multiscale3D(num_classes=num_classes), "3D"
     elif model_config['name'] == 'RESNET18':
@@ -182,281 +188,283 @@ def load_model(config):
         raise Exception("Model not found, check the config.yaml")
 
 
+def fold_input_channels(state_dict, model):
+    """
+    adapt the weights of a checkpoint trained on RGB replicated volumes to a model with a single input channel.
+    the first convolution sees the same volume on each channel, so summing its kernels over the input channels
+    gives exactly the same output on single channel volumes.
+    Args:
+        state_dict (dict): weights of the checkpoint
+        model (torch.nn.Module): model which is going to load the weights
+
+    Returns:
+        (dict) weights ready for model.load_state_dict
+        (list of str) names of the folded weights
+    """
+    model_state = model.state_dict()
+    folded = []
+    state_dict = dict(state_dict)
+    for name, weight in state_dict.items():
+        target = model_state.get(name)
+        if target is None or target.ndim < 3 or weight.shape == target.shape:
+            continue
+        if target.shape[1] == 1 and weight.shape[0] == target.shape[0] and weight.shape[2:] == target.shape[2:]:
+            state_dict[name] = weight.sum(dim=1, keepdim=True)
+            folded.append(name)
+    return state_dict, folded
+
+
 
 ##########################
 #   BACKGROUND SUPPRESSION
 
+def stack_channels(images):
+    """
+    view a stack of N images (N, H, W) as a single image with N channels for cv2, each channel is processed on its own
+    """
+    return np.ascontiguousarray(np.moveaxis(images, 0, -1))
+
+
 def compute_skeleton(img):
     """
-    create the skeleton using morphology
+    create the skeleton using morphology.
+    a stack of images is processed at once: the slices are the channels of a single cv2 image
     Args:
-        img (numpy array): source image
+        img (numpy array): source image, or a stack of images with shape N, H, W (at most 512)
 
     Returns:
-        (numpy array), b&w image: 0 background, 255 skeleton elements
+        (numpy array), b&w image: 0 background, 255 skeleton elements, with the shape of img
     """
-
-    img = img.astype(np.uint8)
-    size = img.size
+    stack = img.ndim == 3
+    img = stack_channels(img.astype(np.uint8)) if stack else img.astype(np.uint8)
     skel = np.zeros(img.shape, np.uint8)
     kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
-    while True:
+    while img.any():
         eroded = cv2.erode(img, kernel)
         temp = cv2.dilate(eroded, kernel)
         temp = cv2.subtract(img, temp)
         skel = np.bitwise_or(skel, temp)
-        img = eroded.copy()
-        zeros = size - cv2.countNonZero(img)
-        if zeros == size:
-            return skel
+        img = eroded
+    return np.moveaxis(skel, -1, 0) if stack else skel
 
 
 def fill_holes(img):
     assert np.array_equal(img, img.astype(bool)), "not binary image provided in hole filling"
     _, labels, stats, _ = cv2.connectedComponentsWithStats(img.astype(np.int8))
+    if len(stats) < 2:  # nothing but the background
+        return img.astype(np.int8)
     major_label = np.argsort(-stats[1:, -1])[0] + 1
     return (labels == major_label).astype(np.int8)
 
 
-def arch_detection(slice):
+def arch_detection_batch(slices):
     """
-    compute a polynomial spline of the dental arch from a DICOM file
+    compute a polynomial spline of the dental arch for each slice of a stack.
+    closing and skeleton run on the whole stack at once (the slices are the channels of a cv2 image) and the
+    thresholds of all the slices come from a single histogram pass, connected components are labelled slice by slice.
     Args:
-        slice (numpy array): source image. Must be float with values in range [0,1]
+        slices (numpy array): source images with shape N, H, W (at most 512). Must be float with values in range [0,1]
 
     Returns:
-        (poly1d object): polynomial function approximation
-        (float) starting value for the X axis
-        (float) ending value for the X axis
+        (list of tuple) poly1d object, starting and ending value for the X axis of each slice,
+            None for the slices whose skeleton has too few points for the spline
     """
-
     # initial closing
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    arch = cv2.morphologyEx(slice, cv2.MORPH_CLOSE, kernel)
-
-    # thresholding to find the dental arch
-    values, bins = np.histogram(arch, bins=40)
-    cumulative = np.cumsum(values) / arch.size  # normalized cumulative hist values
-    suitable_idx = np.abs(cumulative - 0.86).argmin()  # suitable th idx for this slice
-    arch = cv2.threshold(arch, bins[suitable_idx], 1, cv2.THRESH_BINARY)[1]
+    arch = np.moveaxis(cv2.morphologyEx(stack_channels(slices), cv2.MORPH_CLOSE, kernel), -1, 0)
+
+    # thresholding to find the dental arch: 40 bins histogram of each slice, th where 86% of the values are below
+    low, high = arch.min(axis=(1, 2)), arch.max(axis=(1, 2))
+    scale = (40 / np.where(high > low, high - low, 1))[:, None, None]
+    bins = np.minimum(((arch - low[:, None, None]) * scale).astype(np.int32), 39)
+    bins += 40 * np.arange(len(arch), dtype=np.int32)[:, None, None]  # a range of bins for each slice
+    values = np.bincount(bins.ravel(), minlength=40 * len(arch))
+    cumulative = np.cumsum(values.reshape(len(arch), 40), axis=1) / arch[0].size  # normalized cumulative hist values
+    suitable_idx = np.abs(cumulative - 0.86).argmin(axis=1)  # suitable th idx for each slice
+    arch = (arch > (low + (high - low) * suitable_idx / 40)[:, None, None]).astype(np.int8)
 
     # removing external noise and internal holes with labelling
-    arch = fill_holes(arch.astype(np.int8))
-    arch = 1 - fill_holes(1 - arch)
+    arch = np.stack([1 - fill_holes(1 - fill_holes(a)) for a in arch])
 
     # compute skeleton
     skel = compute_skeleton(arch)
 
     # regression polynomial function
-    coords = np.argwhere(skel > 0)
-    y, x = list(coords[:, 0]), list(coords[:, 1])
-    try:
-        pol = np.polyfit(x, y, 8)
-        p = np.poly1d(pol)
-    except np.RankWarning:
-        pass
-
-    # DEBUG PREDICTED SPLINE
-    # original_rgb = np.tile(slice, (3, 1, 1))  # overlay on the original image (colorful)
-    # original_rgb = np.moveaxis(original_rgb, 0, -1)
-    # for sample in np.linspace(min(x), max(x), 1000):  # range(min(x), max(x)):
-    #     y_sample = p(sample)
-    #     try:
-    #         original_rgb[int(y_sample), int(sample), :] = (1, 0, 0)
-    #     except IndexError as e:
-    #         pass
-    # plt.imshow(original_rgb, cmap='gray')
-    # plt.show()
-    # END DEBUG
-
-    return p, min(x), max(x)
+    splines = []
+    for s in skel:
+        y, x = np.nonzero(s)
+        if len(x) <= 8:  # a degree 8 spline needs at least 9 points
+            splines.append(None)
+            continue
+        splines.append((np.poly1d(np.polyfit(x, y, 8)), x.min(), x.max()))
+    return splines
+
+
+def arch_detection(slice):
+    """
+    compute a polynomial spline of the dental arch from a DICOM file
+    Args:
+        slice (numpy array): source image. Must be float with values in range [0,1]
+
+    Returns:
+        (poly1d object): polynomial function approximation
+        (float) starting value for the X axis
+        (float) ending value for the X axis
+        or None if the slice has no suitable skeleton
+    """
+    return arch_detection_batch(slice[None])[0]
 
 
 def arch_stats(func, start, end):
-    x = start
-    counter = 0
-    delta = 0.3
-    peak = 100
-    while x < end:
-        y = func(x)
-        peak = peak if y > peak else y  # this is not a bug, peak value is the lowest
-        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta
-        x = x + 1 * np.sqrt(1 / (alfa ** 2 + 1))
-        counter = counter + 1
-    return counter, peak
+    """
+    length of the curve y = func(x) from start to end (unit steps along the curve, see processing.arc_length_points)
+    and its lowest y value, 100 at most
+    """
+    x, _ = processing.arc_length_points(func, start, end)
+    peak = min(100, func(x).min()) if len(x) else 100  # this is not a bug, peak value is the lowest
+    return len(x), peak
 
 
 def paralines_mask(func, start, end, slice_dim, offset=50):
     """
-    this functions uses the first order derivative of the function func to track the proper points (x,y) from start to end.
+    mask of the region between the two curves parallel to func at distance offset.
+    points of the parallel curves are tracked along func (see processing.arch_lines) and fitted with polynomials,
+    the mask is filled between them with a broadcast comparison of the row indices.
     Args:
         func (poly1d object): polynomial function approximation
         end (float) starting value for the X axis
         start (float) ending value for the X axis
-        offset (Int): offset for generating two more curves
+        slice_dim (tuple): H, W of the mask
+        offset (Int): distance of the parallel curves from func
 
     Returns:
-        low_offset (numpy array): set of sets of xy coordinates (lower offset)
-        coords (numpy array): set of sets of xy coordinates
-        high_offset (numpy array): set of sets of xy coordinates (higer offset)
-        derivative: set of derivates foreach point of coords
-    """
-
-    d = 1
-    delta = 0.3
-    hx, hy = [], []
-    lx, ly = [], []
-    x = start + 1
-
-    while x < end:
-        y = func(x)
-        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta
-
-        # computing the shift trajectory
-        ort_alpha = -1 / alfa
-        cos = np.sqrt(1 / (ort_alpha ** 2 + 1))
-        sin = np.sqrt(ort_alpha ** 2 / (ort_alpha ** 2 + 1))
-        if ort_alpha > 0:
-            lx.append(x + offset * cos), ly.append(y + offset * sin)
-            hx.append(x - offset * cos), hy.append(y - offset * sin)
-        else:
-            lx.append(x - offset * cos), ly.append(y + offset * sin)
-            hx.append(x + offset * cos), hy.append(y - offset * sin)
-
-        x = x + d * np.sqrt(1 / (alfa ** 2 + 1))  # moving to the next x-axis val to check
+        (numpy array) bool mask with shape H, W
+    """
+    x, slope = processing.arc_length_points(func, start + 1, end)
+    low, high = processing.parallel_offsets(x, func(x), slope, offset)
 
     H, W = slice_dim
-    hp = np.poly1d(np.polyfit(hx, hy, 6))
-    lp = np.poly1d(np.polyfit(lx, ly, 6))
-
-    mask = np.zeros((H, W))
-    start = max(int(hx[0]), 0)
-    end = min(int(hx[-1]), W - 1)
-    hy2 = [hp(x) for x in range(start, end)]
-    ly2 = [lp(x) for x in range(start, end)]
-
-    hy2 = np.clip(hy2, a_min=0, a_max=H - 1)
-    ly2 = np.clip(ly2, a_min=0, a_max=H - 1)
-    for idx in range(start, end):
-        mask[int(hy2[idx - start]):int(ly2[idx - start]), int(idx)] = 1
-
-    # mask = np.zeros((H, W))
-    # hy = [hp(x) for x in range(start_x, end_x)]
-    # ly = [lp(x) for x in range(start_x, end_x)]
-    #
-    # hy = np.clip(hy, a_min=0, a_max=H - 1)
-    # ly = np.clip(ly, a_min=0, a_max=H - 1)
-    # for idx in range(start_x, end_x):
-    #     mask[int(hy[idx - start_x]):int(ly[idx - start_x]), int(idx)] = 1
+    hp = np.poly1d(np.polyfit(high[:, 0], high[:, 1], 6))
+    lp = np.poly1d(np.polyfit(low[:, 0], low[:, 1], 6))
 
-    return mask.astype(np.bool)
+    start = max(int(high[0, 0]), 0)
+    end = min(int(high[-1, 0]), W - 1)
+    columns = np.arange(start, end)
+    top = np.clip(hp(columns), a_min=0, a_max=H - 1).astype(int)
+    bottom = np.clip(lp(columns), a_min=0, a_max=H - 1).astype(int)
+
+    mask = np.zeros((H, W), bool)
+    rows = np.arange(H)[:, None]
+    mask[:, start:end] = (rows >= top) & (rows < bottom)
+    return mask
 
 
 def arch_lines(func, start, end, offset=50):
     """
     this functions uses the first order derivative of the function func to track the proper points (x,y) from start to end.
-    Args:
-        func (poly1d object): polynomial function approximation
-        end (float) starting value for the X axis
-        start (float) ending value for the X axis
-        offset (Int): offset for generating two more curves
+    see processing.arch_lines
+    """
+    return processing.arch_lines(func, start, end, offset=offset)
 
-    Returns:
-        low_offset (numpy array): set of sets of xy coordinates (lower offset)
-        coords (numpy array): set of sets of xy coordinates
-        high_offset (numpy array): set of sets of xy coordinates (higer offset)
-        derivative: set of derivates foreach point of coords
-    """
-
-    d = 1
-    delta = 0.3
-    coords = []
-    x = start + 1
-    # we start from the range of X values on the X axis,
-    # we create a new list X of x coords along the curve
-    # we exploit the first order derivative to place values in X
-    # so that f(X) is equally distant for each point in X
-    while x < end:
-        coords.append((x, func(x)))
-        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta
-        x = x + d * np.sqrt(1 / (alfa ** 2 + 1))
-
-    # creating lines parallel to the spline
-    high_offset = []
-    low_offset = []
-    derivative = []
-    for x, y in coords:
-        alfa = (func(x + delta / 2) - func(x - delta / 2)) / delta  # first derivative
-        alfa = -1 / alfa  # perpendicular coeff
-        cos = np.sqrt(1 / (alfa ** 2 + 1))
-        sin = np.sqrt(alfa ** 2 / (alfa ** 2 + 1))
-        if alfa > 0:
-            low_offset.append((x + offset * cos, y + offset * sin))
-            high_offset.append((x - offset * cos, y - offset * sin))
-        else:
-            low_offset.append((x - offset * cos, y + offset * sin))
-            high_offset.append((x + offset * cos, y - offset * sin))
-        derivative.append(alfa)
 
-    return low_offset, coords, high_offset, derivative
+def suppression_slices(depth, slice_range=40, step=4):
+    """
+    Returns:
+        (numpy array) indices of the central slices searched for the dental arch
+    """
+    center = depth // 2
+    return np.clip(np.arange(center - slice_range, center + slice_range, step), 0, depth - 1)
 
 
-def background_suppression(data, folder):
-    """
-    detect the best spline from a set of 40 central slices of the volume,
-    draw the parallel splines to select the most relevant zone of the volume
-    suppress all the data out of this zone
-    :param data:
-    :return:
+def suppression_mask(slices):
     """
+    detect the best spline among a set of slices (see suppression_slices),
+    the mask selects the zone between the parallel splines and above the lowest point of the spline
+    Args:
+        slices (numpy array): slices with shape N, H, W, values in range [0,1]
 
-    slice_range = 40
-    step = 4
-    Z_center = data.shape[0] // 2
+    Returns:
+        (numpy array) bool mask with shape H, W, None if no slice has a suitable spline
+    """
+    H, W = slices.shape[-2:]
     best = 100
-    slice_id = Z_center
-    setup = []
-    for i in range(Z_center - slice_range, Z_center + slice_range, step):
-        p, start, end = arch_detection(data[i])
+    setup = None
+    for spline in arch_detection_batch(slices):
+        if spline is None:
+            continue
+        p, start, end = spline
         mid = (start + end) // 2
-        new_start = start + np.argmax([p(i) for i in range(start, mid)])  # removing possible noise at the beginning of the spline
-        new_end = mid + np.argmax([p(i) for i in range(mid, end)])  # same as above for the end of the spline
+        if mid <= start or end <= mid:  # degenerate spline, no range to search
+            continue
+        new_start = start + np.argmax(p(np.arange(start, mid)))  # removing possible noise at the beginning of the spline
+        new_end = mid + np.argmax(p(np.arange(mid, end)))  # same as above for the end of the spline
         score = abs(p(new_start) - p(new_end))  # best spline starts and ends at the same level of depth
-        lenght, peak = arch_stats(p, new_start, new_end)
-        if new_start < 100 and new_end > data.shape[-1] - 100 and p(new_start) > data.shape[-2] - 200 and p(new_end) > data.shape[-2] - 200:
-            if score < best and lenght > 500 and peak < 80:
-                # print(f"this is a new best: {score}, {lenght}, {peak}")
+        if new_start < 100 and new_end > W - 100 and p(new_start) > H - 200 and p(new_end) > H - 200 and score < best:
+            lenght, peak = arch_stats(p, new_start, new_end)
+            if lenght > 500 and peak < 80:
                 best = score
-                slice_id = i
                 setup = [p, new_start, new_end]
 
-    if len(setup) == 0:
-        print(f"found patient {folder} where preprocessing was not feasible.")
-        return data
+    if setup is None:
+        return None
 
     f, start, end = setup
-    mask = paralines_mask(f, start, end, slice_dim=(data.shape[-2:]), offset=40)
+    mask = paralines_mask(f, start, end, slice_dim=(H, W), offset=40)
     # suppressing data below the lowest point in the spline
     minimum = f(start) if f(start) > f(end) else f(end)
     mask[int(minimum):, :] = False
+    return mask
 
-    data[:, np.bitwise_not(mask)] = 0  # using mask to suppress data
 
-    # # DEBUG: check the result
-    # save_dir = os.path.join(r'C:\Users\marco\Desktop\pre-processing-risultati\test_currently')
-    # original_rgb = np.tile(data[slice_id], (3, 1, 1))  # overlay on the original image (colorful)
-    # original_rgb = np.moveaxis(original_rgb, 0, -1)
-    # original_rgb *= 255
-    # for sample in np.linspace(start, end, 1000):  # range(min(x), max(x)):
-    #     y_sample = f(sample)
-    #     try:
-    #         original_rgb[int(y_sample), int(sample), :] = (255, 0, 0)
-    #     except IndexError as e:
-    #         pass
-    # plt.imshow(original_rgb.astype(np.int))
-    # plt.savefig(os.path.join(save_dir, '{}.png'.format(folder)))
-    # END DEBUG
+def suppression_mask_file(data_path, dicom_min, dicom_max):
+    """
+    suppression mask of a patient, just the searched slices are read from disk.
+    top level function, so it can be run by a process pool (see Loader3D.suppression_masks)
+    Args:
+        data_path (str): path to the raw volume
+        dicom_min (float): volumes_min of the config
+        dicom_max (float): volumes_max of the config
 
+    Returns:
+        (numpy array) bool mask with shape H, W, all true if no slice has a suitable spline
+    """
+    return volume_suppression_mask(np.load(data_path, mmap_mode='r'), dicom_min, dicom_max, name=data_path)
+
+
+def volume_suppression_mask(volume, dicom_min, dicom_max, name=''):
+    """
+    suppression mask of a raw volume (not rescaled), just the searched slices are read
+    Args:
+        volume (numpy array): raw volume with shape Z, H, W, can be memory mapped
+        dicom_min (float): volumes_min of the config
+        dicom_max (float): volumes_max of the config
+        name (str): patient name for the logs
+
+    Returns:
+        (numpy array) bool mask with shape H, W, all true if no slice has a suitable spline
+    """
+    slices = processing.normalize_volume(volume[suppression_slices(volume.shape[0])], dicom_min, dicom_max)
+    mask = suppression_mask(slices)
+    if mask is None:
+        logging.info(f"found patient {name} where preprocessing was not feasible.")
+        return np.ones(volume.shape[-2:], bool)
+    return mask
+
+
+def background_suppression(data, folder):
+    """
+    detect the best spline from a set of 40 central slices of the volume,
+    draw the parallel splines to select the most relevant zone of the volume
+    suppress all the data out of this zone
+    :param data:
+    :return:
+    """
+    mask = suppression_mask(data[suppression_slices(data.shape[0])])
+    if mask is None:
+        print(f"found patient {folder} where preprocessing was not feasible.")
+        return data
+
+    data[:, np.bitwise_not(mask)] = 0  # using mask to suppress data
     return data
 
 #   END BACKGROUND SUPPRESSION
@@ -494,7 +502,8 @@ class Splitter:
 
 def load_dataset(config, rank, world_size, is_distributed, train_type="2D", is_competitor=False):
     from loaders.dataset2D import AlveolarDataloader
-    from loaders.dataset3D import Loader3D
+    from loaders.dataset3D import Loader3D, SubjectLoader
+    from loaders.pipeline import PatchPipeline
     loader_config = config.get('data-loader', None)
     train_config = config.get('trainer', None)
 
@@ -535,24 +544,31 @@ def load_dataset(config, rank, world_size, is_distributed, train_type="2D", is_c
             )
     elif train_type == "3D":
         data_utils = Loader3D(loader_config, train_config.get("do_train", None), train_config.get("additional_dataset", None), is_competitor)
-        train_d, test_d, val_d = data_utils.split_dataset()
+        train_d, test_d, val_d = data_utils.split_dataset(rank, world_size)
         splitter = None
 
         if config['trainer']['do_train']:
             samples_per_volume = int(np.prod([np.round(i / j) for i, j in zip(loader_config['resize_shape'], loader_config['patch_shape'])]))
-            train_queue = tio.Queue(
+            sampler = data_utils.get_sampler(loader_config.get('sampler_type', 'grid'), loader_config.get('grid_overlap', 0))
+            # every rank gets all the subjects, the pipeline splits them balancing the patches
+            train_loader = PatchPipeline(
                 train_d,
-                max_length=samples_per_volume * 4,  # queue len
-                samples_per_volume=samples_per_volume,
-                sampler=data_utils.get_sampler(loader_config.get('sampler_type', 'grid'), loader_config.get('grid_overlap', 0)),
+                sampler=sampler,
+                samples_per_volume=data_utils.patches_per_subject(sampler, samples_per_volume),
+                batch_size=loader_config['batch_size'] // world_size,
+                patch_shape=loader_config['patch_shape'],
                 num_workers=loader_config['num_workers'],
+                slots=loader_config.get('patch_slots', None),
+                worker_subjects=loader_config.get('worker_subjects', 2),
+                seed=config.get('seed', 47),
+                rank=rank,
+                world_size=world_size,
+                augment=data_utils.batch_transforms,
             )
-            sampler = DistributedSampler(train_queue, shuffle=False) if is_distributed else None
-            train_loader = data.DataLoader(train_queue, loader_config['batch_size'] // world_size, num_workers=0, sampler=sampler)
 
-        if rank == 0:
-            test_loader = [(test_p, data.DataLoader(test_p, loader_config['batch_size'], num_workers=loader_config['num_workers'])) for test_p in test_d]
-            val_loader = [(val_p, data.DataLoader(val_p, loader_config['batch_size'], num_workers=loader_config['num_workers'])) for val_p in val_d]
+        # every rank evaluates its share of the subjects
+        test_loader = SubjectLoader(test_d, data_utils.lazy)
+        val_loader = SubjectLoader(val_d, data_utils.lazy)
     else:
         raise Exception(f"type {train_type} not recognized!")
 